@@ -0,0 +1,216 @@
+"""Throughput benchmarks for SaveMyNode.
+
+Generates a synthetic XFS image (see xfs_image.py) and reports, for
+XFSFileRecovery, inodes/s and MB/s of inode tables scanned, MB/s of deleted
+file data extracted and the peak RSS. Optionally times the signature carver
+over the same image and the btrfs dry-run script against the stand-in btrfs
+tools in fake_btrfs/, which replay canned output instead of touching a
+device.
+
+Results can be saved with --json and compared against a saved run with
+--baseline: throughputs that fall, or a peak RSS that grows, by more than
+--tolerance make the run exit with status 1.
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from xfs_image import generate_xfs_image, INODESIZE
+from recover_xfs import XFSFileRecovery
+from output_pipeline import OutputPipeline
+import carver
+from integrity import HASH_ALGORITHMS
+
+MiB = 1024 * 1024
+FAKE_BTRFS_DIR = os.path.join(BENCH_DIR, "fake_btrfs")
+DRY_RUN_SCRIPT = os.path.join(REPO_DIR, "scripts", "btrfs", "dry-run.sh")
+
+def peak_rss_mb():
+    """Peak resident set size of this process and its finished children, in MiB (Linux reports KiB)."""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+@contextlib.contextmanager
+def quiet():
+    """Keep the progress messages of the code under test out of the timings."""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+@contextlib.contextmanager
+def working_directory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+def bench_xfs(image, workdir, args):
+    """Time the inode scan and the extraction of one XFSFileRecovery run."""
+    output_dir = os.path.join(workdir, "xfs")
+    os.makedirs(output_dir)
+    recovery = XFSFileRecovery(image.path, workers=args.workers, hash_algorithm=args.hash,
+                               manifest_path=os.path.join(output_dir, "manifest.jsonl"),
+                               sorted_reads=args.sorted_reads, direct_io=args.direct, queue_depth=args.queue_depth)
+    with working_directory(output_dir), quiet():
+        try:
+            recovery.open_image()
+            recovery.output = OutputPipeline(recovery.reader.fileno(), recovery.hash_algorithm,
+                                             recovery.manifest_path, drop_cache=recovery.direct_io).open()
+            recovery.read_superblock()
+
+            start = time.perf_counter()
+            candidates = list(recovery.iter_candidates())
+            scan_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            recovery.read_inodes(candidates)
+            extract_time = time.perf_counter() - start
+        finally:
+            if recovery.output:
+                recovery.output.close()
+            recovery.close_image()
+
+    extracted = sum(os.path.getsize(os.path.join(output_dir, name)) for name in os.listdir(output_dir)
+                    if name.startswith("recovered_file_"))
+    expected = sum(1 for f in image.files if f.deleted)
+    if len(candidates) != expected:
+        print(f"warning: found {len(candidates)} deleted inodes, the image has {expected}", file=sys.stderr)
+    return {
+        "inodes": image.inodes,
+        "candidates": len(candidates),
+        "scan_seconds": scan_time,
+        "inodes_per_s": image.inodes / scan_time,
+        "scan_mb_per_s": image.inodes * INODESIZE / MiB / scan_time,
+        "extract_seconds": extract_time,
+        "extract_mb_per_s": extracted / MiB / extract_time,
+    }
+
+def bench_carve(image, workdir, args):
+    """Time a signature carve over the whole image."""
+    start = time.perf_counter()
+    with quiet():
+        carved = carver.carve_image(image.path, os.path.join(workdir, "carved"), hash_algorithm=args.hash,
+                                    manifest_path=os.path.join(workdir, "carved.jsonl"), direct_io=args.direct)
+    carve_time = time.perf_counter() - start
+    return {
+        "carved": len(carved),
+        "carve_seconds": carve_time,
+        "carve_mb_per_s": image.size / MiB / carve_time,
+    }
+
+def write_btrfs_fixtures(directory, roots, files):
+    """Write find-root and restore fixtures with `roots` tree roots holding `files` files each."""
+    os.makedirs(directory)
+    bytenrs = [30 * MiB - i * 16384 for i in range(roots)]
+    with open(os.path.join(directory, "find-root.txt"), "w") as f:
+        f.write(f"Superblock thinks the generation is {roots + 1}\n")
+        for i, bytenr in enumerate(bytenrs):
+            f.write(f"Well block {bytenr}(gen: {roots - i} level: 0) seems good, "
+                    f"but generation/level doesn't match, want gen: {roots + 1} level: 0\n")
+    with open(os.path.join(directory, "restore.txt"), "w") as f:
+        for bytenr in bytenrs:
+            for n in range(files):
+                f.write(f"{bytenr} /home/user/dir{n % 8}/file{n}.txt\n")
+
+def bench_btrfs(workdir, args):
+    """Time a depth 1 dry run over every root of the fake btrfs tools."""
+    fixtures = os.path.join(workdir, "btrfs-fixtures")
+    write_btrfs_fixtures(fixtures, args.btrfs_roots, args.btrfs_files)
+    device = os.path.join(workdir, "btrfs.img")
+    with open(device, "wb") as f:
+        f.truncate(MiB)  # No superblock: the script falls back to btrfs-find-root
+
+    env = dict(os.environ, PATH=FAKE_BTRFS_DIR + os.pathsep + os.environ.get("PATH", ""),
+               FAKE_BTRFS_FIXTURES=fixtures)
+    start = time.perf_counter()
+    result = subprocess.run(["bash", DRY_RUN_SCRIPT, "1", device, "home/user/.*", "0", "/"], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    elapsed = time.perf_counter() - start
+    restored = result.stdout.decode().count("/home/user/")
+    return {
+        "roots": args.btrfs_roots,
+        "restored": restored,
+        "dry_run_seconds": elapsed,
+        "roots_per_s": args.btrfs_roots / elapsed,
+    }
+
+def regressions(results, baseline, tolerance):
+    """Yield a message for every metric that is worse than the baseline by more than `tolerance`."""
+    for section, metrics in baseline.items():
+        for name, old in metrics.items():
+            new = results.get(section, {}).get(name)
+            if new is None or not old:
+                continue
+            if name.endswith("_per_s") and new < old * (1 - tolerance):
+                yield f"{section}.{name}: {new:.1f} < {old:.1f}"
+            elif name == "peak_rss_mb" and new > old * (1 + tolerance):
+                yield f"{section}.{name}: {new:.1f} > {old:.1f}"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark SaveMyNode on a synthetic XFS image.")
+    parser.add_argument("--size", type=int, default=256, help="image size in MiB")
+    parser.add_argument("--agcount", type=int, default=4)
+    parser.add_argument("--density", type=float, default=8, help="files per MiB")
+    parser.add_argument("--fragmentation", type=float, default=4, help="average extents per file")
+    parser.add_argument("--deleted-ratio", type=float, default=0.25)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-j", "--workers", type=int, default=1)
+    parser.add_argument("-Q", "--queue-depth", type=int, default=1)
+    parser.add_argument("--sorted-reads", action="store_true")
+    parser.add_argument("--direct", action="store_true")
+    parser.add_argument("--hash", choices=HASH_ALGORITHMS + ("none",), default="none",
+                        help="digest computed during extraction (default: %(default)s)")
+    parser.add_argument("--carve", action="store_true", help="also time the signature carver")
+    parser.add_argument("--btrfs-roots", type=int, default=100,
+                        help="roots replayed by the fake btrfs tools; 0 skips the btrfs benchmark")
+    parser.add_argument("--btrfs-files", type=int, default=50, help="files under every replayed root")
+    parser.add_argument("--workdir", help="directory for the image and outputs (default: a temporary one)")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown (default: %(default)s)")
+    args = parser.parse_args(argv)
+    args.hash = None if args.hash == "none" else args.hash
+
+    workdir = tempfile.mkdtemp(prefix="savemynode-bench-", dir=args.workdir)
+    try:
+        image = generate_xfs_image(os.path.join(workdir, "xfs.img"), args.size * MiB, args.agcount,
+                                   args.density, args.fragmentation, args.deleted_ratio, seed=args.seed)
+        results = {"xfs": bench_xfs(image, workdir, args)}
+        results["xfs"]["peak_rss_mb"] = peak_rss_mb()
+        if args.carve:
+            results["carve"] = bench_carve(image, workdir, args)
+        if args.btrfs_roots:
+            results["btrfs"] = bench_btrfs(workdir, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for section, metrics in results.items():
+        print(f"{section}:")
+        for name, value in metrics.items():
+            print(f"  {name:18} {value:.2f}" if isinstance(value, float) else f"  {name:18} {value}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            failed = list(regressions(results, json.load(f), args.tolerance))
+        for message in failed:
+            print(f"REGRESSION {message}")
+        return 1 if failed else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+"""Stand-in for btrfs-progs that replays canned output.
+
+The fixtures live in $FAKE_BTRFS_FIXTURES (default: the fixtures directory
+next to this file):
+
+  find-root.txt  printed as is by btrfs-find-root
+  restore.txt    "<root bytenr> <path>" lines: the files `btrfs restore`
+                 finds under each tree root
+  dump-super.txt printed as is by `btrfs inspect-internal dump-super`;
+                 without it the command fails as on an unreadable device
+
+$FAKE_BTRFS_DELAY adds a delay in seconds to every command, to stand in for
+device latency. With $FAKE_BTRFS_LOG set, every command line is appended
+to that file.
+"""
+import os
+import re
+import sys
+import time
+
+FIXTURES = os.environ.get("FAKE_BTRFS_FIXTURES", os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures"))
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return f.read()
+
+def find_root(args):
+    sys.stdout.write(fixture("find-root.txt"))
+    return 0
+
+def dump_super(args):
+    try:
+        sys.stdout.write(fixture("dump-super.txt"))
+    except FileNotFoundError:
+        print("ERROR: bad magic on superblock", file=sys.stderr)
+        return 1
+    return 0
+
+def restore(args):
+    root = None
+    dry_run = False
+    regex = None
+    positional = []
+    args = iter(args)
+    for arg in args:
+        if arg == "-t":
+            root = int(next(args))
+        elif arg == "--path-regex":
+            regex = re.compile(next(args))
+        elif arg.startswith("-") and not arg.startswith("--"):
+            dry_run = dry_run or "D" in arg
+        elif not arg.startswith("-"):
+            positional.append(arg)
+    if len(positional) != 2:
+        print("usage: btrfs restore [options] <device> <path>", file=sys.stderr)
+        return 1
+    dst = positional[1]
+
+    entries = [line.split(" ", 1) for line in fixture("restore.txt").splitlines() if line.strip()]
+    roots = {int(entry_root) for entry_root, _ in entries}
+    if root is None:
+        root = max(roots, default=0)
+    elif root not in roots:
+        print(f"Couldn't read tree root at {root}", file=sys.stderr)
+        return 1
+
+    for entry_root, path in entries:
+        if int(entry_root) != root or (regex and not regex.search(path)):
+            continue
+        target = dst.rstrip("/") + path
+        print(f"Restoring {target}")
+        if not dry_run:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "w") as f:
+                f.write(f"{root} {path}\n")
+    return 0
+
+def main():
+    time.sleep(float(os.environ.get("FAKE_BTRFS_DELAY", "0")))
+    command, args = sys.argv[1], sys.argv[2:]
+    if os.environ.get("FAKE_BTRFS_LOG"):
+        with open(os.environ["FAKE_BTRFS_LOG"], "a") as log:
+            log.write(" ".join([command] + args) + "\n")
+    if command == "btrfs-find-root":
+        return find_root(args)
+    if command == "btrfs" and args[:1] == ["restore"]:
+        return restore(args[1:])
+    if command == "btrfs" and args[:2] == ["inspect-internal", "dump-super"]:
+        return dump_super(args[2:])
+    print(f"{command}: unsupported command {' '.join(args)}", file=sys.stderr)
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,250 @@
+"""Generate synthetic XFS images for benchmarks and tests.
+
+The images are v4 XFS filesystems as far as SaveMyNode reads them: every
+AG has a superblock, an AGF with by-block and by-size free space btrees, an
+AGI with an inode btree, and inode chunks holding regular files whose data
+is written to their extents. A share of the files is deleted the way XFS
+leaves them: link count and extent count zeroed, extent records and data
+still in place, blocks back in the free space btrees.
+"""
+import argparse
+import os
+import random
+import struct
+import sys
+import uuid
+from collections import namedtuple
+
+BLOCKSIZE = 4096
+INODESIZE = 512
+SECTSIZE = 512
+INODES_PER_CHUNK = 64
+CHUNK_BLOCKS = INODES_PER_CHUNK * INODESIZE // BLOCKSIZE
+SBTREE_HEADER_SIZE = 16
+# Extent records that fit in the data fork of a 512 byte v2 inode
+MAX_FORK_EXTENTS = (INODESIZE - 100) // 16
+# Share of the allocations that leave a free block behind them
+GAP_RATIO = 0.2
+
+XFS_IBT_MAGIC = 0x49414254  # "IABT"
+XFS_ABTB_MAGIC = 0x41425442  # "ABTB"
+XFS_ABTC_MAGIC = 0x41425443  # "ABTC"
+S_IFREG = 0o100000
+
+GeneratedFile = namedtuple("GeneratedFile", "ino size extents deleted")
+GeneratedImage = namedtuple("GeneratedImage", "path size agcount inodes files")
+
+def _log2(n):
+    return max(n - 1, 1).bit_length()
+
+def _pack_bmbt(offset, start_block, block_count):
+    l0 = (offset << 9) | (start_block >> 43)
+    l1 = ((start_block & ((1 << 43) - 1)) << 21) | block_count
+    return struct.pack(">QQ", l0, l1)
+
+def _sbtree_blocks(nrecs, recsize, keysize):
+    """Number of blocks of a short-form btree of at most two levels holding `nrecs` records."""
+    leaves = max(1, -(-nrecs // ((BLOCKSIZE - SBTREE_HEADER_SIZE) // recsize)))
+    if leaves > (BLOCKSIZE - SBTREE_HEADER_SIZE) // (keysize + 4):
+        raise ValueError("too many records for a two-level btree")
+    return leaves + (leaves > 1)
+
+def _sbtree(magic, records, keysize, agbno):
+    """Return (blocks, levels) of a short-form btree over packed `records`, rooted at `agbno`.
+
+    The blocks are laid out consecutively, root first. The key of a leaf is
+    the first `keysize` bytes of its first record.
+    """
+    per_leaf = (BLOCKSIZE - SBTREE_HEADER_SIZE) // (len(records[0]) if records else 1)
+    leaves = [records[i:i + per_leaf] for i in range(0, len(records), per_leaf)] or [[]]
+
+    def block(level, numrecs, body):
+        data = bytearray(BLOCKSIZE)
+        struct.pack_into(">IHHII", data, 0, magic, level, numrecs, 0xffffffff, 0xffffffff)
+        data[SBTREE_HEADER_SIZE:SBTREE_HEADER_SIZE + len(body)] = body
+        return data
+
+    leaf_blocks = [block(0, len(leaf), b"".join(leaf)) for leaf in leaves]
+    if len(leaf_blocks) == 1:
+        return leaf_blocks, 1
+    maxrecs = (BLOCKSIZE - SBTREE_HEADER_SIZE) // (keysize + 4)
+    keys = b"".join(leaf[0][:keysize] for leaf in leaves).ljust(maxrecs * keysize, b"\0")
+    ptrs = b"".join(struct.pack(">I", agbno + 1 + i) for i in range(len(leaves)))
+    return [block(1, len(leaves), keys + ptrs)] + leaf_blocks, 2
+
+def _merge(extents):
+    """Sort (agbno, count) extents and merge the adjacent ones."""
+    merged = []
+    for agbno, count in sorted(extents):
+        if merged and agbno <= merged[-1][0] + merged[-1][1]:
+            start, length = merged[-1]
+            merged[-1] = (start, max(length, agbno + count - start))
+        else:
+            merged.append((agbno, count))
+    return merged
+
+def file_block(ino, index):
+    """Content of block `index` of the file with inode `ino`."""
+    stamp = struct.pack(">QQ", ino, index)
+    return stamp * (BLOCKSIZE // len(stamp))
+
+def file_content(generated):
+    """Expected content of a GeneratedFile, with holes read as zeros."""
+    data = bytearray(-(-generated.size // BLOCKSIZE) * BLOCKSIZE)
+    for offset, _, count in generated.extents:
+        for b in range(count):
+            data[(offset + b) * BLOCKSIZE:(offset + b + 1) * BLOCKSIZE] = file_block(generated.ino, offset + b)
+    return bytes(data[:generated.size])
+
+def generate_xfs_image(path, size=256 * 1024 * 1024, agcount=4, inode_density=8, fragmentation=4,
+                       deleted_ratio=0.25, file_size=64 * 1024, seed=0):
+    """Write a synthetic XFS image and return a GeneratedImage describing it.
+
+    `inode_density` is the number of files per MiB of image, `fragmentation`
+    the average number of extents per file, `deleted_ratio` the share of the
+    files that are deleted and `file_size` the average file size. Files that
+    do not fit are truncated. The image is sparse; only metadata and file
+    data take space.
+    """
+    rng = random.Random(seed)
+    agblocks = size // BLOCKSIZE // agcount
+    agblklog = _log2(agblocks)
+    inopblog = _log2(BLOCKSIZE // INODESIZE)
+    files_per_ag = max(1, int(inode_density * size / (1024 * 1024) / agcount))
+    chunks_per_ag = -(-files_per_ag // INODES_PER_CHUNK)
+    inodes_per_ag = chunks_per_ag * INODES_PER_CHUNK
+    fs_uuid = uuid.UUID(int=rng.getrandbits(128)).bytes
+
+    files = []
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, agblocks * agcount * BLOCKSIZE)
+        for agno in range(agcount):
+            ag = agno * agblocks * BLOCKSIZE
+
+            # Split each file into extents, then allocate the pieces of all
+            # files in shuffled order so that files end up fragmented
+            layout = []
+            for _ in range(files_per_ag):
+                blocks = int(rng.expovariate(1 / file_size)) // BLOCKSIZE + 1
+                count = max(1, min(MAX_FORK_EXTENTS, blocks, int(rng.expovariate(1 / fragmentation)) + 1))
+                bounds = [0] + sorted(rng.sample(range(1, blocks), count - 1)) + [blocks]
+                layout.append([(bounds[i], bounds[i + 1] - bounds[i]) for i in range(count)])
+            pieces = [(index, i) for index, extents in enumerate(layout) for i in range(len(extents))]
+            rng.shuffle(pieces)
+
+            # Headers in block 0, then the btrees, the inode chunks and the data.
+            # Every free extent ends at a piece or at the end of the AG.
+            inobt_root = 1
+            bnobt_root = inobt_root + _sbtree_blocks(chunks_per_ag, 16, 4)
+            free_btree_blocks = _sbtree_blocks(len(pieces) + 1, 8, 8)
+            cntbt_root = bnobt_root + free_btree_blocks
+            chunks_start = -(-(cntbt_root + free_btree_blocks) // CHUNK_BLOCKS) * CHUNK_BLOCKS
+            data_start = chunks_start + chunks_per_ag * CHUNK_BLOCKS
+            if data_start >= agblocks:
+                raise ValueError("inode density too high for the AG size")
+
+            placed = {}
+            position = data_start
+            free_extents = []
+            for index, i in pieces:
+                count = layout[index][i][1]
+                if position + count > agblocks:
+                    break
+                placed[(index, i)] = position
+                position += count
+                if rng.random() < GAP_RATIO:
+                    free_extents.append((position, 1))
+                    position += 1
+            if position < agblocks:
+                free_extents.append((position, agblocks - position))
+
+            inode_chunks = bytearray(chunks_per_ag * CHUNK_BLOCKS * BLOCKSIZE)
+            free_inodes = [0] * chunks_per_ag
+            for index in range(inodes_per_ag):
+                agino = (chunks_start << inopblog) + index
+                ino = (agno << (agblklog + inopblog)) + agino
+                extents = layout[index] if index < files_per_ag else []
+                file_extents = [(offset, placed[(index, i)], count)
+                                for i, (offset, count) in enumerate(extents) if (index, i) in placed]
+                deleted = rng.random() < deleted_ratio
+                if not file_extents or deleted:
+                    free_inodes[index // INODES_PER_CHUNK] |= 1 << (index % INODES_PER_CHUNK)
+                if not file_extents:
+                    continue
+                last_offset, _, last_count = file_extents[-1]
+                length = (last_offset + last_count) * BLOCKSIZE - rng.randrange(BLOCKSIZE)
+
+                off = index * INODESIZE
+                struct.pack_into(">HHBB", inode_chunks, off, 0x494E, 0 if deleted else S_IFREG | 0o644, 2, 2)
+                struct.pack_into(">I", inode_chunks, off + 16, 0 if deleted else 1)
+                struct.pack_into(">QQI", inode_chunks, off + 56, length, sum(c for _, _, c in file_extents),
+                                 0 if deleted else len(file_extents))
+                inode_chunks[off + 100:off + 100 + 16 * len(file_extents)] = b"".join(
+                    _pack_bmbt(offset, (agno << agblklog) + agbno, count) for offset, agbno, count in file_extents)
+
+                for offset, agbno, count in file_extents:
+                    os.pwrite(fd, b"".join(file_block(ino, offset + b) for b in range(count)),
+                              ag + agbno * BLOCKSIZE)
+                    if deleted:
+                        free_extents.append((agbno, count))
+                files.append(GeneratedFile(ino, length, file_extents, deleted))
+            os.pwrite(fd, inode_chunks, ag + chunks_start * BLOCKSIZE)
+
+            free_extents = _merge(free_extents)
+            inobt, inobt_levels = _sbtree(XFS_IBT_MAGIC, [
+                struct.pack(">IHHQ", (chunks_start << inopblog) + c * INODES_PER_CHUNK, 0,
+                            (INODES_PER_CHUNK << 8) | bin(free_inodes[c]).count("1"), free_inodes[c])
+                for c in range(chunks_per_ag)], 4, inobt_root)
+            bnobt, bnobt_levels = _sbtree(XFS_ABTB_MAGIC, [
+                struct.pack(">II", agbno, count) for agbno, count in free_extents], 8, bnobt_root)
+            cntbt, cntbt_levels = _sbtree(XFS_ABTC_MAGIC, [
+                struct.pack(">II", agbno, count)
+                for agbno, count in sorted(free_extents, key=lambda extent: (extent[1], extent[0]))], 8, cntbt_root)
+            for root, blocks in ((inobt_root, inobt), (bnobt_root, bnobt), (cntbt_root, cntbt)):
+                os.pwrite(fd, b"".join(blocks), ag + root * BLOCKSIZE)
+
+            headers = bytearray(BLOCKSIZE)
+            struct.pack_into(">IIQ", headers, 0, 0x58465342, BLOCKSIZE, agblocks * agcount)
+            headers[32:48] = fs_uuid
+            struct.pack_into(">Q", headers, 56, chunks_start << inopblog)
+            struct.pack_into(">II", headers, 84, agblocks, agcount)
+            struct.pack_into(">HHHH", headers, 100, 4, SECTSIZE, INODESIZE, BLOCKSIZE // INODESIZE)
+            struct.pack_into(">5B", headers, 120, _log2(BLOCKSIZE), _log2(SECTSIZE), _log2(INODESIZE),
+                             inopblog, agblklog)
+            struct.pack_into(">QQ", headers, 128, agcount * inodes_per_ag,
+                             sum(bin(mask).count("1") for mask in free_inodes))
+            struct.pack_into(">IIIIIIIII", headers, SECTSIZE, 0x58414746, 1, agno, agblocks,
+                             bnobt_root, cntbt_root, 0, bnobt_levels, cntbt_levels)
+            struct.pack_into(">II", headers, SECTSIZE + 52, sum(count for _, count in free_extents),
+                             max((count for _, count in free_extents), default=0))
+            struct.pack_into(">IIIIIII", headers, 2 * SECTSIZE, 0x58414749, 1, agno, agblocks,
+                             inodes_per_ag, inobt_root, inobt_levels)
+            struct.pack_into(">I", headers, 2 * SECTSIZE + 28, sum(bin(mask).count("1") for mask in free_inodes))
+            os.pwrite(fd, headers, ag)
+    finally:
+        os.close(fd)
+
+    return GeneratedImage(path, agblocks * agcount * BLOCKSIZE, agcount, agcount * inodes_per_ag, files)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic XFS image with deleted files.")
+    parser.add_argument("path")
+    parser.add_argument("--size", type=int, default=256, help="image size in MiB")
+    parser.add_argument("--agcount", type=int, default=4)
+    parser.add_argument("--density", type=float, default=8, help="files per MiB")
+    parser.add_argument("--fragmentation", type=float, default=4, help="average extents per file")
+    parser.add_argument("--deleted-ratio", type=float, default=0.25)
+    parser.add_argument("--file-size", type=int, default=64 * 1024, help="average file size in bytes")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    image = generate_xfs_image(args.path, args.size * 1024 * 1024, args.agcount, args.density,
+                               args.fragmentation, args.deleted_ratio, args.file_size, args.seed)
+    deleted = [f for f in image.files if f.deleted]
+    print(f"Wrote {image.path}: {image.size} bytes, {image.agcount} AGs, {image.inodes} inodes, "
+          f"{len(image.files)} files, {len(deleted)} deleted ({sum(f.size for f in deleted)} bytes)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,213 @@
+import struct
+from bisect import bisect_right
+from collections import namedtuple
+
+# Primary superblock location and size
+BTRFS_SUPER_INFO_OFFSET = 0x10000
+BTRFS_SUPER_INFO_SIZE = 4096
+BTRFS_MAGIC = b"_BHRfS_M"
+# Superblock copies, and the start of the device btrfs never allocates
+BTRFS_SUPER_MIRRORS = (0x10000, 0x4000000, 0x4000000000)
+BTRFS_RESERVED_BYTES = 1024 * 1024
+
+# Tree node layout
+BTRFS_HEADER_SIZE = 101
+BTRFS_ITEM_SIZE = 25  # key, data offset, data size
+BTRFS_KEY_PTR_SIZE = 33  # key, block pointer, generation
+BTRFS_MAX_LEVEL = 8
+
+# Tree object ids and item key types
+BTRFS_EXTENT_TREE_OBJECTID = 2
+BTRFS_FS_TREE_OBJECTID = 5
+BTRFS_ROOT_ITEM_KEY = 132
+BTRFS_EXTENT_ITEM_KEY = 168
+BTRFS_METADATA_ITEM_KEY = 169
+BTRFS_CHUNK_ITEM_KEY = 228
+
+# Chunk profile bits
+BTRFS_BLOCK_GROUP_RAID0 = 1 << 3
+BTRFS_BLOCK_GROUP_RAID10 = 1 << 6
+BTRFS_BLOCK_GROUP_RAID5 = 1 << 7
+BTRFS_BLOCK_GROUP_RAID6 = 1 << 8
+BTRFS_BLOCK_GROUP_STRIPED = (BTRFS_BLOCK_GROUP_RAID0 | BTRFS_BLOCK_GROUP_RAID10 |
+                             BTRFS_BLOCK_GROUP_RAID5 | BTRFS_BLOCK_GROUP_RAID6)
+
+BTRFS_CHUNK_SIZE = 48
+BTRFS_STRIPE_SIZE = 32
+
+class BtrfsSuperblock:
+    def __init__(self, data):
+        self.fsid = bytes(data[0x20:0x30])
+        self.bytenr = struct.unpack_from("<Q", data, 0x30)[0]
+        self.magic = bytes(data[0x40:0x48])
+        self.generation = struct.unpack_from("<Q", data, 0x48)[0]
+        self.root = struct.unpack_from("<Q", data, 0x50)[0]
+        self.chunk_root = struct.unpack_from("<Q", data, 0x58)[0]
+        self.total_bytes = struct.unpack_from("<Q", data, 0x70)[0]
+        self.bytes_used = struct.unpack_from("<Q", data, 0x78)[0]
+        self.sectorsize = struct.unpack_from("<I", data, 0x90)[0]
+        self.nodesize = struct.unpack_from("<I", data, 0x94)[0]
+        self.sys_chunk_array_size = struct.unpack_from("<I", data, 0xA0)[0]
+        self.chunk_root_generation = struct.unpack_from("<Q", data, 0xA4)[0]
+        self.csum_type = struct.unpack_from("<H", data, 0xC4)[0]
+        self.root_level = struct.unpack_from("<B", data, 0xC6)[0]
+        self.chunk_root_level = struct.unpack_from("<B", data, 0xC7)[0]
+        self.devid = struct.unpack_from("<Q", data, 0xC9)[0]  # First field of dev_item
+        self.label = bytes(data[0x12B:0x22B]).split(b"\0", 1)[0].decode(errors="replace")
+        self.sys_chunk_array = bytes(data[0x32B:0x32B + min(self.sys_chunk_array_size, 2048)])
+
+    def is_valid(self):
+        return self.magic == BTRFS_MAGIC
+
+    def display_info(self):
+        print("Btrfs Superblock Information:")
+        print(f"  Label: {self.label}")
+        print(f"  FSID: {self.fsid.hex()}")
+        print(f"  Generation: {self.generation}")
+        print(f"  Node Size: {self.nodesize} bytes")
+        print(f"  Sector Size: {self.sectorsize} bytes")
+        print(f"  Total Bytes: {self.total_bytes}")
+
+def read_superblock(reader):
+    return BtrfsSuperblock(reader.view(BTRFS_SUPER_INFO_OFFSET, BTRFS_SUPER_INFO_SIZE))
+
+class BtrfsChunk(namedtuple("BtrfsChunk", "logical length type num_stripes sub_stripes stripes")):
+    """A chunk item: one logical range and the (devid, physical offset) of its stripes."""
+
+    def is_mirrored(self):
+        """True if every stripe holds the whole chunk (single, DUP, RAID1)."""
+        return not self.type & BTRFS_BLOCK_GROUP_STRIPED
+
+    def stripe_length(self):
+        """Bytes of the device taken by each stripe."""
+        if self.type & BTRFS_BLOCK_GROUP_RAID0:
+            data_stripes = self.num_stripes
+        elif self.type & BTRFS_BLOCK_GROUP_RAID10:
+            data_stripes = self.num_stripes // max(self.sub_stripes, 1)
+        elif self.type & BTRFS_BLOCK_GROUP_RAID5:
+            data_stripes = self.num_stripes - 1
+        elif self.type & BTRFS_BLOCK_GROUP_RAID6:
+            data_stripes = self.num_stripes - 2
+        else:
+            data_stripes = 1
+        return self.length // max(data_stripes, 1)
+
+def parse_chunk(data, offset, logical):
+    """Parse the chunk item at `offset` and return (BtrfsChunk, item size)."""
+    length, _, _, chunk_type = struct.unpack_from("<QQQQ", data, offset)
+    num_stripes, sub_stripes = struct.unpack_from("<HH", data, offset + 44)
+    stripes = [struct.unpack_from("<QQ", data, offset + BTRFS_CHUNK_SIZE + i * BTRFS_STRIPE_SIZE)
+               for i in range(num_stripes)]
+    size = BTRFS_CHUNK_SIZE + num_stripes * BTRFS_STRIPE_SIZE
+    return BtrfsChunk(logical, length, chunk_type, num_stripes, sub_stripes, stripes), size
+
+class ChunkMap:
+    """Logical to physical address map of one device, built from the chunk items."""
+
+    def __init__(self, devid):
+        self.devid = devid
+        self.chunks = {}
+        self._starts = None
+
+    def add(self, chunk):
+        self.chunks[chunk.logical] = chunk
+        self._starts = None
+
+    def __iter__(self):
+        return iter(sorted(self.chunks.values()))
+
+    def lookup(self, logical):
+        if self._starts is None:
+            self._starts = sorted(self.chunks)
+        i = bisect_right(self._starts, logical) - 1
+        if i < 0:
+            return None
+        chunk = self.chunks[self._starts[i]]
+        return chunk if logical < chunk.logical + chunk.length else None
+
+    def physical(self, logical):
+        """Return the device offset of a logical address, or None if it is not on this device."""
+        chunk = self.lookup(logical)
+        if chunk is None or not chunk.is_mirrored():
+            return None
+        for devid, offset in chunk.stripes:
+            if devid == self.devid:
+                return offset + logical - chunk.logical
+        return None
+
+def read_node(reader, sb, chunks, logical):
+    """Return the tree block at a logical address, or None if it is unreadable."""
+    physical = chunks.physical(logical)
+    if physical is None:
+        return None
+    node = reader.view(physical, sb.nodesize)
+    if len(node) < BTRFS_HEADER_SIZE or bytes(node[32:48]) != sb.fsid:
+        return None
+    if struct.unpack_from("<Q", node, 48)[0] != logical:
+        return None
+    return node
+
+def walk_tree(reader, sb, chunks, bytenr, level):
+    """Yield (objectid, type, offset, data) for every leaf item of a tree, in key order.
+
+    Unreadable blocks and blocks at an unexpected level are skipped.
+    """
+    stack = [(bytenr, level)]
+    seen = set()
+    while stack:
+        bytenr, expected_level = stack.pop()
+        if bytenr in seen:
+            continue
+        seen.add(bytenr)
+        node = read_node(reader, sb, chunks, bytenr)
+        if node is None:
+            continue
+        nritems, node_level = struct.unpack_from("<IB", node, 96)
+        if node_level != expected_level or node_level >= BTRFS_MAX_LEVEL:
+            continue
+
+        if node_level == 0:
+            nritems = min(nritems, (len(node) - BTRFS_HEADER_SIZE) // BTRFS_ITEM_SIZE)
+            for i in range(nritems):
+                objectid, item_type, offset, data_offset, data_size = struct.unpack_from(
+                    "<QBQII", node, BTRFS_HEADER_SIZE + i * BTRFS_ITEM_SIZE)
+                data_start = BTRFS_HEADER_SIZE + data_offset
+                yield objectid, item_type, offset, node[data_start:data_start + data_size]
+            continue
+
+        nritems = min(nritems, (len(node) - BTRFS_HEADER_SIZE) // BTRFS_KEY_PTR_SIZE)
+        ptrs = [struct.unpack_from("<Q", node, BTRFS_HEADER_SIZE + i * BTRFS_KEY_PTR_SIZE + 17)[0]
+                for i in range(nritems)]
+        # Push right-to-left so leaves come out in key order
+        for ptr in reversed(ptrs):
+            stack.append((ptr, node_level - 1))
+
+def load_chunk_map(reader, sb):
+    """Build the chunk map from the superblock's system chunks and the chunk tree."""
+    chunks = ChunkMap(sb.devid)
+    array_data = sb.sys_chunk_array
+    offset = 0
+    while offset + 17 + BTRFS_CHUNK_SIZE <= len(array_data):
+        _, item_type, logical = struct.unpack_from("<QBQ", array_data, offset)
+        if item_type != BTRFS_CHUNK_ITEM_KEY:
+            break
+        chunk, size = parse_chunk(array_data, offset + 17, logical)
+        chunks.add(chunk)
+        offset += 17 + size
+
+    for _, item_type, logical, data in walk_tree(reader, sb, chunks, sb.chunk_root, sb.chunk_root_level):
+        if item_type == BTRFS_CHUNK_ITEM_KEY and len(data) >= BTRFS_CHUNK_SIZE:
+            chunks.add(parse_chunk(data, 0, logical)[0])
+    return chunks
+
+def find_tree_root(reader, sb, chunks, objectid, root=None, level=None):
+    """Return (bytenr, level) of a tree from the ROOT_ITEM in the root tree, or None.
+
+    The current root tree is searched unless an older one is given as `root` and `level`.
+    """
+    if root is None:
+        root, level = sb.root, sb.root_level
+    for item_objectid, item_type, _, data in walk_tree(reader, sb, chunks, root, level):
+        if item_objectid == objectid and item_type == BTRFS_ROOT_ITEM_KEY and len(data) >= 239:
+            return struct.unpack_from("<Q", data, 176)[0], data[238]
+    return None
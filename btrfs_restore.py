@@ -0,0 +1,312 @@
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import btrfs
+import btrfs_roots
+from content_store import ContentStore, DEFAULT_STORE_NAME
+from image_reader import ImageReader
+from integrity import DEFAULT_HASH_ALGORITHM
+from manifest import RunManifest, DEFAULT_MANIFEST_NAME
+from path_regex import normalize, path_matcher, path_regexes, path_selector, prune, read_paths
+
+# `btrfs restore` runs at once; each one mostly waits on the device
+DEFAULT_JOBS = 4
+
+# Outcome of restoring one root: the paths it matched, relative to the filesystem root, and
+# the staging directory holding its files (None for a dry run)
+RootResult = namedtuple("RootResult", "root paths staging returncode")
+
+def restore_command(device, root, regex, destination, dry_run=False):
+    """Return the `btrfs restore` command restoring the paths matching `regex` from tree root `root`."""
+    command = ["btrfs", "restore", "-t", str(root), "-Divv" if dry_run else "-ivv",
+               "--path-regex", f"^/{regex}$", device, destination]
+    if os.geteuid() != 0:
+        command.insert(0, "sudo")
+    return command
+
+def restored_paths(output, destination):
+    """Return the paths `btrfs restore` reported restoring, relative to the filesystem root."""
+    prefix = destination.rstrip("/")
+    paths = []
+    for line in output.splitlines():
+        if not line.startswith("Restoring "):
+            continue
+        path = line[len("Restoring "):]
+        if prefix and path.startswith(prefix + "/"):
+            path = path[len(prefix):]
+        paths.append(normalize(path))
+    return paths
+
+class ParallelRestore:
+    """Runs `btrfs restore` for many tree roots at once, newest first, until enough has been found.
+
+    Every root is swept once per regex in `regex`, a string or a list of
+    them, e.g. chunks of a long path list compiled by path_regex.
+
+    Up to `jobs` roots are restored concurrently, each into its own staging
+    directory under `destination` (or as a dry run when there is none).
+    Matched paths are merged as the roots finish: `paths` maps every path
+    to the roots it was found in, in the order the roots were given, which
+    should be newest first.
+
+    Results are handed back in that order too, each as soon as every
+    earlier root is done, so files restored from newer roots are ingested
+    first and their names win. Once every path in `targets` has been found
+    in `versions` roots, no further root is started and later results are
+    dropped. Targets may hold wildcards; one ending in "/" is found by any
+    path under it. With no targets, or `versions` 0, every root is searched.
+
+    A root is skipped if it was already explored, or if `tree_of(root)`,
+    the filesystem tree it points to, was: its listing would be identical.
+    Restores still running when the search ends are terminated.
+
+    With `select`, e.g. from path_regex.path_selector, only the restored
+    paths it accepts are kept; the others are deleted from staging.
+    """
+
+    def __init__(self, device, regex, destination=None, jobs=DEFAULT_JOBS, targets=(), versions=0, tree_of=None,
+                 select=None):
+        self.device = device
+        self.regexes = [regex] if isinstance(regex, str) else list(regex)
+        self.destination = destination
+        self.jobs = max(1, jobs)
+        self.targets = [normalize(target) for target in targets]
+        self._matchers = [path_matcher(target) for target in self.targets]
+        self.versions = versions
+        self.tree_of = tree_of
+        self.select = select
+        self.paths = {}
+        self.found = Counter()
+        self.failed = []
+        self.skipped = []
+        self._roots = set()
+        self._trees = set()
+        # The `btrfs restore` processes running, terminated once the search is over
+        self._lock = threading.Lock()
+        self._running = set()
+        self._stopped = False
+
+    def satisfied(self):
+        return bool(self.targets) and self.versions > 0 and all(
+            self.found[target] >= self.versions for target in self.targets)
+
+    def explored(self, root):
+        """True if `root`, or the filesystem tree it points to, has already been explored."""
+        if root in self._roots:
+            return True
+        self._roots.add(root)
+        tree = self.tree_of(root) if self.tree_of else None
+        if tree is None:
+            return False
+        if tree in self._trees:
+            return True
+        self._trees.add(tree)
+        return False
+
+    def restore_root(self, root):
+        staging = None
+        if self.destination is not None:
+            staging = tempfile.mkdtemp(prefix=f".restore.{root}.", dir=self.destination)
+        target = staging or "/"
+        paths = []
+        returncode = 0
+        for regex in self.regexes:
+            with self._lock:
+                if self._stopped:
+                    # Dropped by run() along with its staging directory
+                    return RootResult(root, paths, staging, returncode)
+                process = subprocess.Popen(restore_command(self.device, root, regex, target,
+                                                           dry_run=staging is None),
+                                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                self._running.add(process)
+            try:
+                output = process.communicate()[0]
+            finally:
+                with self._lock:
+                    self._running.discard(process)
+            paths += restored_paths(output.decode(errors="replace"), "" if staging is None else staging)
+            returncode = returncode or process.returncode
+        if self.select is not None:
+            paths = [path for path in paths if self.select(path)]
+            if staging:
+                prune(staging, self.select)
+        return RootResult(root, paths, staging, returncode)
+
+    def run(self, roots):
+        """Restore the roots in `roots` until satisfied, yielding a RootResult per root in the given order."""
+        roots = iter(roots)
+        pending = {}
+        done = {}
+        submitted = position = 0
+        self._stopped = False
+        pool = ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="btrfs-restore")
+        try:
+            while True:
+                # Roots are only started while the outcome is still open
+                while len(pending) < self.jobs and not self.satisfied():
+                    root = next(roots, None)
+                    if root is None:
+                        break
+                    if self.explored(root):
+                        self.skipped.append(root)
+                        continue
+                    pending[pool.submit(self.restore_root, root)] = submitted
+                    submitted += 1
+                if not pending:
+                    break
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    done[pending.pop(future)] = future.result()
+                while position in done and not self.satisfied():
+                    result = done.pop(position)
+                    position += 1
+                    self.merge(result)
+                    yield result
+                if self.satisfied():
+                    break
+        finally:
+            # Older roots can take minutes to restore: their results would be dropped anyway
+            self.stop()
+            pool.shutdown(wait=True, cancel_futures=True)
+            # Restores that finished, or were running, after the targets were found
+            for future in pending:
+                if not future.cancelled() and future.exception() is None:
+                    done[pending[future]] = future.result()
+            for result in done.values():
+                if result.staging:
+                    shutil.rmtree(result.staging, ignore_errors=True)
+
+    def stop(self):
+        """Terminate the running restores and keep any more from starting."""
+        with self._lock:
+            self._stopped = True
+            for process in self._running:
+                process.terminate()
+
+    def merge(self, result):
+        if result.returncode != 0 and not result.paths:
+            self.failed.append(result.root)
+        for path in result.paths:
+            self.paths.setdefault(path, []).append(result.root)
+        for target, matcher in zip(self.targets, self._matchers):
+            if any(matcher.fullmatch(path) for path in result.paths):
+                self.found[target] += 1
+
+def read_roots(path):
+    with (sys.stdin if path == "-" else open(path)) as f:
+        return [int(line) for line in f if line.strip()]
+
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return {int(line) for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Restore files from many btrfs tree roots in parallel.")
+    parser.add_argument("device")
+    parser.add_argument("regex", help="path regex, as built by generate-regex.sh, without the leading /; "
+                                      "or @FILE, a list of paths and globs that are all looked for")
+    parser.add_argument("--roots", default="-", help="file listing the tree roots, newest first (default: stdin)")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS,
+                        help="roots restored at once (default: %(default)s)")
+    parser.add_argument("--destination", help="restore into this directory; without it, only list the matches")
+    parser.add_argument("--manifest", help="JSON Lines file the restored files are added to "
+                                           "(default: DESTINATION/%s)" % DEFAULT_MANIFEST_NAME)
+    parser.add_argument("--checkpoint", help="file listing the roots already restored, appended to as roots finish")
+    parser.add_argument("--resume", action="store_true", help="skip the roots listed in the checkpoint")
+    parser.add_argument("--target", action="append", default=[],
+                        help="path being looked for, ending in / for a directory; stop once every target is found")
+    parser.add_argument("--versions", type=int, default=1,
+                        help="roots a target must be found in before stopping; 0 searches every root "
+                             "(default: %(default)s)")
+    parser.add_argument("--no-prune", action="store_true",
+                        help="restore every root, even those pointing to an already explored filesystem tree")
+    args = parser.parse_args(argv)
+
+    regexes, targets, select = args.regex, args.target, None
+    if args.regex.startswith("@"):
+        paths = read_paths(args.regex[1:])
+        regexes = path_regexes(paths)
+        targets = targets + paths
+        # The regexes also let through siblings of the globbed directories
+        select = path_selector(paths)
+    roots = read_roots(args.roots)
+    if args.checkpoint:
+        if args.resume:
+            finished = read_checkpoint(args.checkpoint)
+            roots = [root for root in roots if root not in finished]
+        else:
+            open(args.checkpoint, "w").close()
+
+    with open_trees(args.device, not args.no_prune) as tree_of:
+        restore = ParallelRestore(args.device, regexes, args.destination, args.jobs, targets, args.versions,
+                                  tree_of, select)
+        if args.destination is None:
+            for result in restore.run(roots):
+                for path in result.paths:
+                    # Each path once, from the newest root that has it
+                    if restore.paths[path] == [result.root]:
+                        print(path, flush=True)
+            report(restore, sys.stderr)
+            return 0
+        return restore_into(args, restore, roots)
+
+def restore_into(args, restore, roots):
+    """Restore `roots` into the destination, folding every root's files into its content store."""
+    store = ContentStore(os.path.join(args.destination, DEFAULT_STORE_NAME))
+    files = 0
+    with RunManifest(args.manifest or os.path.join(args.destination, DEFAULT_MANIFEST_NAME)) as manifest:
+        for result in restore.run(roots):
+            files += store.ingest(result.staging, args.destination, DEFAULT_HASH_ALGORITHM, manifest,
+                                  version=str(result.root))
+            shutil.rmtree(result.staging, ignore_errors=True)
+            if args.checkpoint:
+                # A single short append per root: an interruption leaves every earlier line intact
+                with open(args.checkpoint, "a") as f:
+                    f.write(f"{result.root}\n")
+    print(f"Restored {files} files ({len(restore.paths)} paths): {store.blobs} new, {store.duplicates} duplicates.")
+    report(restore, sys.stdout)
+    return 0
+
+def report(restore, out):
+    if restore.satisfied():
+        print(f"Every target found in {restore.versions} root(s); later roots were not searched.", file=out)
+    if restore.skipped:
+        print(f"Skipped {len(restore.skipped)} roots pointing to an already explored tree.", file=out)
+    if restore.failed:
+        print(f"btrfs restore failed for roots {', '.join(map(str, restore.failed))}", file=sys.stderr)
+
+@contextmanager
+def open_trees(device, prune=True):
+    """Yield a function mapping a root to the filesystem tree it points to, or None if it can't be read."""
+    if not prune:
+        yield None
+        return
+    try:
+        reader = ImageReader(device).open()
+    except OSError:
+        # Typically not root: restores still run through sudo, just without pruning
+        yield None
+        return
+    try:
+        sb = btrfs.read_superblock(reader)
+        chunks = btrfs.load_chunk_map(reader, sb) if sb.is_valid() and sb.nodesize else None
+        if not chunks or not chunks.chunks:
+            yield None
+        else:
+            yield lambda root: btrfs_roots.fs_tree_of(reader, sb, chunks, root)
+    finally:
+        reader.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
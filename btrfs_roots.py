@@ -0,0 +1,143 @@
+import argparse
+import struct
+import sys
+from collections import namedtuple
+
+import btrfs
+from crc import crc32c
+from image_reader import ImageReader
+
+try:
+    import numpy as np
+except ImportError:  # Headers are then checked one block at a time
+    np = None
+
+BTRFS_ROOT_TREE_OBJECTID = 1
+BTRFS_BLOCK_GROUP_METADATA = 1 << 2
+BTRFS_CSUM_TYPE_CRC32 = 0
+BTRFS_CSUM_SIZE = 32
+
+# Metadata read per step of the scan
+SCAN_WINDOW = 32 * 1024 * 1024
+
+# A tree node found on disk: its logical address, the transaction that wrote it and its level
+TreeNode = namedtuple("TreeNode", "bytenr generation level")
+
+def metadata_stripes(sb, chunks):
+    """Yield (logical, physical, length) for the metadata chunks stored on this device."""
+    for chunk in chunks:
+        if not chunk.type & BTRFS_BLOCK_GROUP_METADATA:
+            continue
+        physical = chunks.physical(chunk.logical)
+        if physical is not None:
+            yield chunk.logical, physical, chunk.length
+
+def checksum_ok(sb, node):
+    """True if a tree block's checksum matches. Only crc32c is checked; other types pass."""
+    if sb.csum_type != BTRFS_CSUM_TYPE_CRC32:
+        return True
+    return crc32c(node[BTRFS_CSUM_SIZE:]) == struct.unpack_from("<I", node, 0)[0]
+
+def scan_tree_nodes(reader, sb, chunks, owner=BTRFS_ROOT_TREE_OBJECTID):
+    """Yield a TreeNode for every block of `owner`'s tree found in the metadata chunks, in disk order.
+
+    A block counts when it carries the filesystem's fsid, records its own
+    logical address and `owner`, and its checksum matches. Headers are
+    compared a whole window of blocks at a time; only matches are
+    checksummed. Being a generator, the scan stops when the caller does.
+    """
+    nodesize = sb.nodesize
+    if not nodesize:
+        return
+    window = max(SCAN_WINDOW // nodesize, 1) * nodesize
+    for logical, physical, length in metadata_stripes(sb, chunks):
+        for start in range(0, length, window):
+            data = reader.view(physical + start, min(window, length - start))
+            count = len(data) // nodesize
+            if np is not None:
+                matches = _matching_blocks(data, count, nodesize, sb.fsid, logical + start, owner)
+            else:
+                matches = [i for i in range(count)
+                           if _header_matches(data, i * nodesize, sb.fsid, logical + start + i * nodesize, owner)]
+            found = []
+            for i in matches:
+                node = data[i * nodesize:(i + 1) * nodesize]
+                if checksum_ok(sb, node):
+                    generation = struct.unpack_from("<Q", node, 80)[0]
+                    found.append(TreeNode(logical + start + i * nodesize, generation, node[100]))
+            # Decoded before yielding: the caller may read from `reader` and move its window
+            yield from found
+
+def _header_matches(data, offset, fsid, bytenr, owner):
+    return (bytes(data[offset + 32:offset + 48]) == fsid and
+            struct.unpack_from("<Q", data, offset + 48)[0] == bytenr and
+            struct.unpack_from("<Q", data, offset + 88)[0] == owner)
+
+def _matching_blocks(data, count, nodesize, fsid, logical, owner):
+    blocks = np.frombuffer(data, dtype=np.uint8, count=count * nodesize).reshape(count, nodesize)
+    mask = (blocks[:, 32:48] == np.frombuffer(fsid, dtype=np.uint8)).all(axis=1)
+    if not mask.any():
+        return []
+    bytenrs = blocks[:, 48:56].copy().view("<u8")[:, 0]
+    owners = blocks[:, 88:96].copy().view("<u8")[:, 0]
+    mask &= bytenrs == logical + np.arange(count, dtype=np.uint64) * np.uint64(nodesize)
+    mask &= owners == owner
+    return np.flatnonzero(mask).tolist()
+
+def find_tree_roots(reader, sb, chunks=None, all_nodes=False, owner=BTRFS_ROOT_TREE_OBJECTID):
+    """Yield older roots of a tree as TreeNodes, newest generation first.
+
+    The metadata is scanned once. For every generation older than the
+    superblock's, the highest node written in it is that generation's root,
+    which is what `btrfs-find-root` reports. With `all_nodes`, like its -a
+    flag, every node found is a candidate. The current root is left out:
+    it cannot hold anything deleted. Consumers can stop as soon as they
+    have enough roots.
+    """
+    if chunks is None:
+        chunks = btrfs.load_chunk_map(reader, sb)
+    nodes = [node for node in scan_tree_nodes(reader, sb, chunks, owner)
+             if node.generation < sb.generation and node.bytenr != sb.root]
+    if not all_nodes:
+        roots = {}
+        for node in nodes:
+            best = roots.get(node.generation)
+            if best is None or node.level > best.level:
+                roots[node.generation] = node
+        nodes = list(roots.values())
+    yield from sorted(nodes, key=lambda node: (node.generation, node.level, node.bytenr), reverse=True)
+
+def fs_tree_of(reader, sb, chunks, bytenr):
+    """Return the bytenr of the filesystem tree that the root tree at `bytenr` points to, or None.
+
+    `btrfs restore -t` restores that tree, so two roots pointing to the same
+    one restore the same files.
+    """
+    node = btrfs.read_node(reader, sb, chunks, bytenr)
+    if node is None:
+        return None
+    found = btrfs.find_tree_root(reader, sb, chunks, btrfs.BTRFS_FS_TREE_OBJECTID, bytenr, node[100])
+    return found[0] if found else None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find older btrfs tree roots without btrfs-find-root.")
+    parser.add_argument("device")
+    parser.add_argument("-D", "--depth", type=int, default=1,
+                        help="2 lists every root tree node, not just the root of each generation")
+    parser.add_argument("-n", "--limit", type=int, help="stop after this many roots")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print generation and level too")
+    args = parser.parse_args(argv)
+
+    with ImageReader(args.device) as reader:
+        sb = btrfs.read_superblock(reader)
+        if not sb.is_valid():
+            print(f"{args.device} is not a btrfs filesystem", file=sys.stderr)
+            return 1
+        for count, node in enumerate(find_tree_roots(reader, sb, all_nodes=args.depth >= 2)):
+            if args.limit is not None and count >= args.limit:
+                break
+            print(f"{node.bytenr} {node.generation} {node.level}" if args.verbose else node.bytenr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
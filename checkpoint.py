@@ -0,0 +1,123 @@
+import json
+import os
+import struct
+import time
+
+DEFAULT_CHECKPOINT_NAME = "recovery_checkpoint.json"
+# Shortest time between two progress saves; finished AGs are always saved
+DEFAULT_CHECKPOINT_INTERVAL = 30.0
+
+class Checkpoint:
+    """Progress of a recovery run, saved so that an interrupted run can resume.
+
+    The state is a small JSON document: the filesystem it belongs to, the
+    AGs whose inodes have been swept and how many candidates have been
+    extracted. The candidates of finished AGs are appended to a sidecar file
+    (`<path>.candidates`) as (ino, inode) records, so a save never rewrites
+    them; the state records how many bytes of the sidecar are valid.
+
+    The state file is replaced atomically: a crash leaves either the old or
+    the new checkpoint, never a partial one. Progress saves are throttled to
+    one per `interval` seconds.
+    """
+
+    def __init__(self, path=DEFAULT_CHECKPOINT_NAME, interval=DEFAULT_CHECKPOINT_INTERVAL):
+        self.path = path
+        self.candidates_path = path + ".candidates"
+        self.interval = interval
+        self.state = {}
+        self._candidates = None
+        self._last_save = time.monotonic()
+
+    def load(self):
+        """Read the saved state. Returns False if there is none."""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            self.state = {}
+            return False
+        return True
+
+    def start(self, uuid, inodesize, resume=False, filters=()):
+        """Begin checkpointing a run on the filesystem `uuid`, continuing the saved one if `resume`.
+
+        `filters` describes how the candidates were selected. Raises
+        ValueError if the saved checkpoint belongs to another filesystem or
+        was made with other filters.
+        """
+        filters = list(filters)
+        if resume and self.load():
+            if self.state.get("uuid") != uuid.hex() or self.state.get("inodesize") != inodesize:
+                raise ValueError(f"{self.path} belongs to another filesystem")
+            if self.state.get("filters", []) != filters:
+                raise ValueError(f"{self.path} was made with other filters")
+        else:
+            self.state = {"uuid": uuid.hex(), "inodesize": inodesize, "filters": filters, "ags": [],
+                          "candidates_size": 0, "extracted": 0, "files": 0, "bytes": 0}
+        self._candidates = open(self.candidates_path, "r+b" if resume and self.state["ags"] else "w+b")
+        # Drop records appended after the last save
+        self._candidates.truncate(self.state["candidates_size"])
+        self._candidates.seek(0, os.SEEK_END)
+        self.save(force=True)
+        return self
+
+    def close(self):
+        if self._candidates:
+            self._candidates.close()
+            self._candidates = None
+
+    def remove(self):
+        """Delete the checkpoint once its run has finished."""
+        self.close()
+        for path in (self.path, self.candidates_path):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def ags(self):
+        return self.state["ags"]
+
+    def ag_candidates(self):
+        """Return {agno: [(ino, inode_data)]} for every AG swept before the checkpoint."""
+        record = struct.Struct(">QI")
+        result = {agno: [] for agno in self.state["ags"]}
+        self._candidates.seek(0)
+        data = self._candidates.read(self.state["candidates_size"])
+        self._candidates.seek(0, os.SEEK_END)
+        position = 0
+        inodesize = self.state["inodesize"]
+        while position + record.size <= len(data):
+            ino, agno = record.unpack_from(data, position)
+            position += record.size
+            result[agno].append((ino, data[position:position + inodesize]))
+            position += inodesize
+        return result
+
+    def add_ag(self, agno, candidates):
+        """Record the candidates of a swept AG and save."""
+        self._candidates.write(b"".join(struct.pack(">QI", ino, agno) + bytes(inode_data)
+                                        for ino, inode_data in candidates))
+        self._candidates.flush()
+        os.fsync(self._candidates.fileno())
+        self.state["ags"].append(agno)
+        self.state["candidates_size"] = self._candidates.tell()
+        self.save(force=True)
+
+    def extracted(self, count, files, size):
+        """Record that the first `count` candidates have been extracted, saving at most every `interval`."""
+        self.state["extracted"] = count
+        self.state["files"] = files
+        self.state["bytes"] = size
+        self.save()
+
+    def save(self, force=False):
+        if not force and time.monotonic() - self._last_save < self.interval:
+            return False
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+        self._last_save = time.monotonic()
+        return True
@@ -0,0 +1,113 @@
+import argparse
+import errno
+import os
+import shutil
+import sys
+
+from integrity import HASH_ALGORITHMS, DEFAULT_HASH_ALGORITHM, hash_file
+from manifest import RunManifest, DEFAULT_MANIFEST_NAME
+
+DEFAULT_STORE_NAME = "blobs"
+
+class ContentStore:
+    """Recovered file contents kept once, under their digest.
+
+    A finished output file is moved to `<root>/<digest[:2]>/<digest[2:]>`,
+    or deleted if that blob already exists, and its name is put back as a
+    hard link to the blob. Recovering the same content again, from another
+    btrfs root or another stale copy of an XFS inode, then costs a link
+    instead of a second copy of the data. Names that cannot be linked (the
+    name already exists, or lies on another filesystem) are left out; the
+    manifest still maps them to their blob.
+    """
+
+    def __init__(self, root=DEFAULT_STORE_NAME):
+        self.root = root
+        self.blobs = 0
+        self.duplicates = 0
+        self.duplicate_bytes = 0
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def add(self, path, digest, name=None):
+        """Move the finished file at `path` into the store and link `name` (default: `path`) to it.
+
+        Returns (blob path, True if the content was new, True if `name` was linked).
+        """
+        blob = self.blob_path(digest)
+        new = not os.path.exists(blob)
+        if new:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.replace(path, blob)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.move(path, blob)
+            # Blobs are shared by every name linked to them
+            os.chmod(blob, 0o444)
+            self.blobs += 1
+        else:
+            self.duplicates += 1
+            self.duplicate_bytes += os.path.getsize(path)
+            os.unlink(path)
+
+        name = path if name is None else name
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(name)), exist_ok=True)
+            os.link(blob, name)
+            linked = True
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            linked = False
+        return blob, new, linked
+
+    def ingest(self, directory, destination, algorithm=DEFAULT_HASH_ALGORITHM, manifest=None, **fields):
+        """Move every file under `directory` into the store and link it under `destination`.
+
+        Meant for tools that write plain files, such as `btrfs restore`.
+        Names already present under `destination` (e.g. restored from a
+        newer root) are kept. Each file is added to `manifest` with `fields`.
+        Returns the number of files ingested.
+        """
+        count = 0
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                if os.path.islink(path) or not os.path.isfile(path):
+                    continue
+                name = os.path.join(destination, os.path.relpath(path, directory))
+                size = os.path.getsize(path)
+                digest = hash_file(path, algorithm)
+                blob, _, linked = self.add(path, digest, name)
+                if manifest:
+                    manifest.add(name, size, algorithm, digest, blob=os.path.abspath(blob), linked=linked, **fields)
+                count += 1
+        return count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Deduplicate recovered files into a content-addressed store.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = commands.add_parser("ingest", help="move the files of a directory into the store")
+    ingest_parser.add_argument("directory", help="directory holding freshly recovered files")
+    ingest_parser.add_argument("destination", help="directory the files are linked into by name")
+    ingest_parser.add_argument("--store", help="blob directory (default: DESTINATION/%s)" % DEFAULT_STORE_NAME)
+    ingest_parser.add_argument("--hash", choices=HASH_ALGORITHMS, default=DEFAULT_HASH_ALGORITHM)
+    ingest_parser.add_argument("--manifest", default=DEFAULT_MANIFEST_NAME,
+                               help="JSON Lines file the names, blobs and versions are added to")
+    ingest_parser.add_argument("--version", help="recorded with every file, e.g. the btrfs root it came from")
+
+    args = parser.parse_args(argv)
+    store = ContentStore(args.store or os.path.join(args.destination, DEFAULT_STORE_NAME))
+    fields = {} if args.version is None else {"version": args.version}
+    with RunManifest(args.manifest) as manifest:
+        count = store.ingest(args.directory, args.destination, args.hash, manifest, **fields)
+    print(f"Ingested {count} files: {store.blobs} new, {store.duplicates} duplicates "
+          f"({store.duplicate_bytes} bytes not stored again).")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {level: name for name, level in LEVELS.items()}
+
+DEFAULT_EVENTS_NAME = "recovery_events.jsonl"
+
+# Records buffered before they are written out
+DEFAULT_BATCH_SIZE = 512
+# Longest a buffered record waits, so that followers see progress
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+class EventSink:
+    """Structured run events, written as batched JSON Lines.
+
+    Every event has a name, a level and free-form fields. Events below
+    `level` are dropped; of the events below WARNING only one in `sample`
+    of each name is kept, so per-inode and per-extent events stay cheap on
+    large devices. Every event is counted whether it is written or not and
+    the counts go into the summary record written by `close()`.
+
+    `target` is a path (appended to), a file descriptor or a file object;
+    with no target nothing is written. Events carrying a `message` at or
+    above `console_level` are also printed, which is all a terminal user
+    sees by default.
+    """
+
+    def __init__(self, target=None, level=INFO, sample=1, console_level=INFO, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.target = target
+        self.level = level
+        self.sample = max(1, sample)
+        self.console_level = console_level
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.file = None
+        self.counts = Counter()
+        self.started = time.time()
+        self._batch = []
+        self._last_flush = time.monotonic()
+        self._owns_file = False
+
+    def open(self):
+        if self.file is not None:
+            return self
+        if isinstance(self.target, str):
+            self.file = open(self.target, "a", encoding="utf-8")
+            self._owns_file = True
+        elif isinstance(self.target, int):
+            self.file = os.fdopen(self.target, "w", encoding="utf-8", closefd=False)
+            self._owns_file = True
+        else:
+            self.file = self.target
+        return self
+
+    def close(self, **fields):
+        """Write the summary record, then flush and close the stream."""
+        self.summary(**fields)
+        self.flush()
+        if self._owns_file:
+            self.file.close()
+            self._owns_file = False
+        self.file = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def emit(self, event, level=INFO, message=None, **fields):
+        self.counts[event] += 1
+        if level >= self.console_level and message:
+            print(message, file=sys.stderr if level >= WARNING else sys.stdout)
+        if self.file is None or level < self.level:
+            return
+        if level < WARNING and (self.counts[event] - 1) % self.sample:
+            return
+
+        record = {"time": time.time(), "level": LEVEL_NAMES.get(level, level), "event": event}
+        record.update(fields)
+        if message:
+            record["message"] = message
+        self._batch.append(json.dumps(record))
+        if len(self._batch) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def debug(self, event, message=None, **fields):
+        self.emit(event, DEBUG, message, **fields)
+
+    def info(self, event, message=None, **fields):
+        self.emit(event, INFO, message, **fields)
+
+    def warning(self, event, message=None, **fields):
+        self.emit(event, WARNING, message, **fields)
+
+    def error(self, event, message=None, **fields):
+        self.emit(event, ERROR, message, **fields)
+
+    def summary(self, **fields):
+        """Write a summary record with the count of every event seen so far."""
+        if self.file is None:
+            return
+        record = {"time": time.time(), "level": "info", "event": "summary",
+                  "elapsed": time.time() - self.started, "counts": dict(self.counts)}
+        record.update(fields)
+        self._batch.append(json.dumps(record))
+
+    def flush(self):
+        if self._batch and self.file is not None:
+            self.file.write("\n".join(self._batch) + "\n")
+            self.file.flush()
+        self._batch = []
+        self._last_flush = time.monotonic()
+
+class EventBuffer(EventSink):
+    """Keeps events in memory instead of writing them, for another sink to replay.
+
+    Worker processes report through one, since their events belong in the
+    parent's stream.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, event, level=INFO, message=None, **fields):
+        self.counts[event] += 1
+        self.records.append((event, level, message, fields))
+
+    def drain(self):
+        """Return the events held so far and forget them."""
+        records, self.records = self.records, []
+        return records
+
+    @staticmethod
+    def replay(records, sink):
+        for event, level, message, fields in records:
+            sink.emit(event, level, message, **fields)
+
+def read_events(path):
+    """Return the records of an event stream as a list of dicts."""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def follow_events(path, start=0, poll_interval=0.2, stop=None):
+    """Yield the records of an event stream as they are written, until its summary.
+
+    Meant for front-ends that run a recovery in the background. Reading
+    begins at byte `start`, e.g. the size of the file before the run, since
+    streams are appended to. `stop` is an optional callable checked between
+    polls to give up early.
+    """
+    while not os.path.exists(path):
+        if stop and stop():
+            return
+        time.sleep(poll_interval)
+    with open(path, encoding="utf-8") as f:
+        f.seek(start)
+        pending = ""
+        while True:
+            chunk = f.readline()
+            if not chunk:
+                if stop and stop():
+                    return
+                time.sleep(poll_interval)
+                continue
+            pending += chunk
+            if not pending.endswith("\n"):
+                continue  # Partially written line
+            line, pending = pending, ""
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield record
+            if record.get("event") == "summary":
+                return
@@ -0,0 +1,126 @@
+import errno
+import mmap
+import os
+
+# Size of the aligned bounce buffer used when the kernel cannot copy for us
+DEFAULT_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Errors meaning "this copy method is not supported for these descriptors"
+_UNSUPPORTED = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF, errno.EPERM}
+
+COPY_METHODS = ("copy_file_range", "sendfile", "preadv")
+
+def data_ranges(fd, offset, length):
+    """Yield the (offset, length) pieces of a source range that hold data.
+
+    Sparse image files report their holes through SEEK_DATA/SEEK_HOLE; block
+    devices and filesystems without support report a single data range.
+    """
+    end = offset + length
+    while offset < end:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+            hole = os.lseek(fd, data, os.SEEK_HOLE)
+        except OSError as e:
+            if e.errno == errno.ENXIO:  # Nothing but hole up to EOF
+                return
+            yield offset, end - offset
+            return
+        if data >= end:
+            return
+        hole = min(hole, end)
+        yield data, hole - data
+        offset = hole
+
+class ExtentCopier:
+    """Copy byte ranges between file descriptors without a user-space round trip.
+
+    copy_file_range() is tried first, then sendfile(), then positional reads
+    into a reusable page-aligned buffer. The first method that fails as
+    unsupported is dropped for the rest of the run. Destination ranges that
+    are never written stay holes in the output file.
+    """
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, method=None):
+        self.buffer_size = buffer_size
+        methods = [m for m in COPY_METHODS if m == "preadv" or hasattr(os, m)]
+        if method is not None:
+            methods = methods[methods.index(method):]
+        self.methods = methods
+        self._buffer = None
+
+    @property
+    def method(self):
+        return self.methods[0]
+
+    def copy(self, src_fd, src_offset, dst_fd, dst_offset, length, hasher=None):
+        """Copy `length` bytes and return how many bytes of the range were covered.
+
+        Holes in the source are skipped, so they stay holes in the output.
+        With a StreamHasher the data goes through its buffers so it can be
+        hashed in the same pass, and skipped holes are hashed as zeros.
+        """
+        covered = 0
+        for data_offset, data_length in data_ranges(src_fd, src_offset, length):
+            delta = data_offset - src_offset
+            if hasher is not None:
+                hasher.feed_zeros(delta - covered)
+                copied = self._copy_hashed(src_fd, data_offset, dst_fd, dst_offset + delta, data_length, hasher)
+            else:
+                copied = self._copy_range(src_fd, data_offset, dst_fd, dst_offset + delta, data_length)
+            covered = delta + copied
+            if copied < data_length:  # Short source
+                return covered
+        if hasher is not None:
+            hasher.feed_zeros(length - covered)
+        return length
+
+    def _copy_range(self, src_fd, src_offset, dst_fd, dst_offset, length):
+        copied = 0
+        while copied < length:
+            count = min(length - copied, self.buffer_size)
+            try:
+                n = self._copy_once(src_fd, src_offset + copied, dst_fd, dst_offset + copied, count)
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED or len(self.methods) == 1:
+                    raise
+                self.methods.pop(0)
+                continue
+            if n == 0:  # End of the source
+                break
+            copied += n
+        return copied
+
+    def _copy_hashed(self, src_fd, src_offset, dst_fd, dst_offset, length, hasher):
+        copied = 0
+        while copied < length:
+            buffer = hasher.acquire()
+            count = min(length - copied, len(buffer))
+            n = os.preadv(src_fd, [buffer[:count]], src_offset + copied)
+            if n == 0:
+                hasher.release(buffer)
+                break
+            written = 0
+            while written < n:
+                written += os.pwrite(dst_fd, buffer[written:n], dst_offset + copied + written)
+            hasher.submit(buffer, n)
+            copied += n
+        return copied
+
+    def _copy_once(self, src_fd, src_offset, dst_fd, dst_offset, count):
+        if self.method == "copy_file_range":
+            return os.copy_file_range(src_fd, dst_fd, count, src_offset, dst_offset)
+
+        if self.method == "sendfile":
+            # sendfile() writes at the current position of the output
+            os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+            return os.sendfile(dst_fd, src_fd, src_offset, count)
+
+        if self._buffer is None:
+            # Anonymous mappings are page aligned
+            self._buffer = memoryview(mmap.mmap(-1, self.buffer_size))
+        n = os.preadv(src_fd, [self._buffer[:count]], src_offset)
+        written = 0
+        while written < n:
+            written += os.pwrite(dst_fd, self._buffer[written:n], dst_offset + written)
+        return n
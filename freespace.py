@@ -0,0 +1,192 @@
+import struct
+from array import array
+from bisect import bisect_right
+
+from xfs_ag import read_agf, agb_offset, sbtree_header_size, walk_sbtree
+from xfs_crc import XFS_AGF_CRC_OFF
+import btrfs
+
+# By-block free space btree magics (v4 and v5/CRC variants)
+XFS_ABTB_MAGICS = (0x41425442, 0x41423342)  # "ABTB", "AB3B"
+
+class IntervalSet:
+    """Sorted, non-overlapping [start, end) byte ranges.
+
+    The bounds live in two flat arrays of 64-bit integers rather than a list
+    of tuples, so a map with millions of free extents stays a few bytes per
+    extent. Lookups are binary searches.
+    """
+
+    def __init__(self, intervals=()):
+        self.starts = array("Q")
+        self.ends = array("Q")
+        for start, end in sorted(intervals):
+            self._append(start, end)
+
+    def _append(self, start, end):
+        if end <= start:
+            return
+        if self.ends and start <= self.ends[-1]:
+            # Overlapping or adjacent: extend the last interval
+            if end > self.ends[-1]:
+                self.ends[-1] = end
+            return
+        self.starts.append(start)
+        self.ends.append(end)
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __bool__(self):
+        return len(self.starts) > 0
+
+    def __eq__(self, other):
+        return isinstance(other, IntervalSet) and self.starts == other.starts and self.ends == other.ends
+
+    def __repr__(self):
+        return f"IntervalSet({list(self)})"
+
+    def __contains__(self, offset):
+        i = bisect_right(self.starts, offset) - 1
+        return i >= 0 and offset < self.ends[i]
+
+    def total(self):
+        """Number of bytes covered."""
+        return sum(self.ends) - sum(self.starts)
+
+    def overlap(self, start, end):
+        """Yield the pieces of [start, end) that are in the set."""
+        i = max(bisect_right(self.starts, start) - 1, 0)
+        while i < len(self.starts) and self.starts[i] < end:
+            piece_start = max(self.starts[i], start)
+            piece_end = min(self.ends[i], end)
+            if piece_start < piece_end:
+                yield piece_start, piece_end
+            i += 1
+
+    def covers(self, start, end):
+        """True if all of [start, end) is in the set."""
+        i = bisect_right(self.starts, start) - 1
+        return i >= 0 and end <= self.ends[i]
+
+    def union(self, other):
+        return IntervalSet(list(self) + list(other))
+
+    def intersection(self, other):
+        result = IntervalSet()
+        i = j = 0
+        while i < len(self.starts) and j < len(other.starts):
+            start = max(self.starts[i], other.starts[j])
+            end = min(self.ends[i], other.ends[j])
+            result._append(start, end)
+            if self.ends[i] < other.ends[j]:
+                i += 1
+            else:
+                j += 1
+        return result
+
+    def complement(self, start, end):
+        """The parts of [start, end) that are not in the set."""
+        result = IntervalSet()
+        position = start
+        for piece_start, piece_end in self.overlap(start, end):
+            result._append(position, piece_start)
+            position = piece_end
+        result._append(position, end)
+        return result
+
+    def difference(self, other):
+        if not self:
+            return IntervalSet()
+        return self.intersection(other.complement(self.starts[0], self.ends[-1]))
+
+def xfs_free_space(reader, sb, verifier=None, events=None):
+    """Return the free space of an XFS filesystem as byte ranges of the image.
+
+    Free extents are read from the by-block free space btree of every AG.
+    An AG whose AGF is damaged is reported as free as a whole: callers use
+    the map to skip allocated space, and skipping what may hold deleted
+    data is the worse mistake. So is an AGF rejected by the optional
+    CRCVerifier. Damaged AGFs are reported to the optional EventSink
+    `events`.
+    """
+    hdr = sbtree_header_size(sb)
+    intervals = []
+    for agno in range(sb.agcount):
+        # The last AG is usually shorter; past its end there is nothing to carve
+        agblocks = min(sb.agblocks, sb.dblocks - agno * sb.agblocks)
+        agf = read_agf(reader, sb, agno)
+        if not agf.is_valid():
+            if events:
+                events.warning("bad_agf", f"AG {agno}: bad AGF magic {hex(agf.magicnum)}; treating the whole AG "
+                                          "as free.", agno=agno, magic=agf.magicnum)
+            intervals.append((agb_offset(sb, agno, 0), agb_offset(sb, agno, agblocks)))
+            continue
+        if verifier and not verifier.check(reader.view(agb_offset(sb, agno, 0) + sb.sectsize, sb.sectsize),
+                                           XFS_AGF_CRC_OFF, "AGF", agno=agno):
+            intervals.append((agb_offset(sb, agno, 0), agb_offset(sb, agno, agblocks)))
+            continue
+        for block, numrecs in walk_sbtree(reader, sb, agno, agf.bno_root, XFS_ABTB_MAGICS, keysize=8,
+                                          verifier=verifier):
+            numrecs = min(numrecs, (len(block) - hdr) // 8)
+            for agbno, count in struct.iter_unpack(">II", block[hdr:hdr + numrecs * 8]):
+                if agbno + count <= agblocks:
+                    intervals.append((agb_offset(sb, agno, agbno), agb_offset(sb, agno, agbno + count)))
+    return IntervalSet(intervals)
+
+def btrfs_free_space(reader, sb):
+    """Return the free space of a single-device btrfs filesystem as byte ranges of the image.
+
+    Device space outside every chunk is free. Inside mirrored chunks (single,
+    DUP, RAID1) the logical ranges not covered by an extent tree item are
+    mapped back to the device. Striped chunks are kept whole. Returns None
+    when the chunk or extent tree cannot be read.
+    """
+    chunks = btrfs.load_chunk_map(reader, sb)
+    extent_root = btrfs.find_tree_root(reader, sb, chunks, btrfs.BTRFS_EXTENT_TREE_OBJECTID)
+    if extent_root is None:
+        return None
+
+    used = []
+    for objectid, item_type, offset, _ in btrfs.walk_tree(reader, sb, chunks, *extent_root):
+        if item_type == btrfs.BTRFS_EXTENT_ITEM_KEY:
+            used.append((objectid, objectid + offset))
+        elif item_type == btrfs.BTRFS_METADATA_ITEM_KEY:
+            used.append((objectid, objectid + sb.nodesize))
+    free_logical = IntervalSet((chunk.logical, chunk.logical + chunk.length) for chunk in chunks).difference(
+        IntervalSet(used))
+
+    allocated = []
+    free = []
+    for chunk in chunks:
+        stripe_length = chunk.stripe_length()
+        for devid, physical in chunk.stripes:
+            if devid != sb.devid:
+                continue
+            allocated.append((physical, physical + stripe_length))
+            if chunk.is_mirrored():
+                for start, end in free_logical.overlap(chunk.logical, chunk.logical + chunk.length):
+                    free.append((physical + start - chunk.logical, physical + end - chunk.logical))
+            else:
+                free.append((physical, physical + stripe_length))
+
+    reserved = IntervalSet([(0, btrfs.BTRFS_RESERVED_BYTES)] +
+                           [(mirror, mirror + btrfs.BTRFS_SUPER_INFO_SIZE) for mirror in btrfs.BTRFS_SUPER_MIRRORS])
+    unallocated = IntervalSet(allocated).complement(0, reader.size)
+    return unallocated.union(IntervalSet(free)).difference(reserved)
+
+def free_space(reader, events=None):
+    """Detect the filesystem of an image and return its free space, or None if unknown."""
+    # Imported here: recover_xfs itself depends on this module
+    from recover_xfs import XFSSuperblock, XFS_SUPERBLOCK_OFFSET, XFS_SUPERBLOCK_SIZE
+
+    xfs_sb = XFSSuperblock(reader.view(XFS_SUPERBLOCK_OFFSET, XFS_SUPERBLOCK_SIZE))
+    if xfs_sb.is_valid():
+        return xfs_free_space(reader, xfs_sb, events=events)
+    btrfs_sb = btrfs.read_superblock(reader)
+    if btrfs_sb.is_valid():
+        return btrfs_free_space(reader, btrfs_sb)
+    return None
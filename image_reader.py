@@ -0,0 +1,212 @@
+import mmap
+import os
+
+# Size of the window used when the image cannot be memory-mapped
+DEFAULT_BUFFER_SIZE = 64 * 1024 * 1024
+# Smallest read issued by DirectReader for random access
+DEFAULT_IO_SIZE = 1024 * 1024
+# O_DIRECT offsets, lengths and buffers are aligned to this; it covers both
+# 512-byte and 4K logical sector devices
+DIRECT_IO_ALIGNMENT = 4096
+
+class ImageReader:
+    """Read-only, zero-copy access to a disk image or block device.
+
+    The whole image is memory-mapped when possible and `view()` hands out
+    memoryview slices of the mapping, so reading an inode or an extent costs
+    no syscall and no copy. When the image cannot be mapped (empty files,
+    some character devices) it falls back to a large read-ahead window.
+    """
+
+    def __init__(self, path, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.fd = None
+        self.size = 0
+        self._map = None
+        self._map_view = None
+        self._window = None
+        self._window_offset = 0
+        self._window_len = 0
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_RDONLY)
+        # os.path.getsize() reports 0 for block devices, seeking to the end does not
+        self.size = os.lseek(self.fd, 0, os.SEEK_END)
+        try:
+            self._map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+            self._map_view = memoryview(self._map)
+        except (ValueError, OSError):
+            self._map = None
+            self._window = bytearray(self.buffer_size)
+        return self
+
+    def close(self):
+        if self._map is not None:
+            self._map_view.release()
+            try:
+                self._map.close()
+            except BufferError:
+                # A caller still holds a view; the mapping goes away with it
+                pass
+            self._map = None
+            self._map_view = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def fileno(self):
+        return self.fd
+
+    def advise(self, option, offset=0, length=0):
+        """Pass an access pattern hint (mmap.MADV_*) for the given range."""
+        if self._map is None or not hasattr(self._map, "madvise"):
+            return
+        page = mmap.PAGESIZE
+        start = offset - offset % page
+        if length == 0:
+            length = self.size - start
+        self._map.madvise(option, start, min(length + offset - start, self.size - start))
+
+    def view(self, offset, length):
+        """Return a memoryview of `length` bytes at `offset`.
+
+        The view is truncated at the end of the image. Views handed out by the
+        buffered fallback are only valid until the next call to `view()`.
+        """
+        if offset >= self.size or length <= 0:
+            return memoryview(b"")
+        length = min(length, self.size - offset)
+
+        if self._map is not None:
+            return self._map_view[offset:offset + length]
+
+        if length > len(self._window):
+            # Oversized request: read it directly rather than growing the window
+            return memoryview(os.pread(self.fd, length, offset))
+
+        window_end = self._window_offset + self._window_len
+        if not (self._window_offset <= offset and offset + length <= window_end):
+            self._window_offset = offset
+            self._window_len = os.preadv(self.fd, [self._window], offset)
+
+        start = offset - self._window_offset
+        return memoryview(self._window)[start:start + length]
+
+    def read(self, offset, length):
+        """Return a copy of `length` bytes at `offset`."""
+        return bytes(self.view(offset, length))
+
+class DirectReader(ImageReader):
+    """ImageReader for raw block devices that bypasses the page cache.
+
+    Metadata and sweep reads go through an O_DIRECT descriptor into one
+    reusable page-aligned window. Random reads fetch at least `io_size`
+    bytes; sweeps (after `advise(MADV_SEQUENTIAL)`) that continue right at
+    the end of the window fill all of it.
+    `fileno()` is a second, buffered descriptor for the kernel copy paths,
+    advised RANDOM; its pages are dropped again with `drop()`. Where O_DIRECT
+    is refused (tmpfs, some FUSE filesystems) reads fall back to the
+    buffered descriptor followed by POSIX_FADV_DONTNEED.
+    """
+
+    def __init__(self, path, io_size=DEFAULT_IO_SIZE, buffer_size=DEFAULT_BUFFER_SIZE):
+        super().__init__(path, buffer_size=max(buffer_size, io_size))
+        self.io_size = _align_up(io_size)
+        self.direct_fd = None
+        self._sequential = False
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_RDONLY)
+        self.size = os.lseek(self.fd, 0, os.SEEK_END)
+        try:
+            self.direct_fd = os.open(self.path, os.O_RDONLY | os.O_DIRECT)
+        except (AttributeError, OSError):
+            self.direct_fd = None
+        # Anonymous mappings are page aligned, as O_DIRECT requires. The slack
+        # lets a full buffer_size request at an unaligned offset still fit.
+        self._window = memoryview(mmap.mmap(-1, _align_up(self.buffer_size) + 2 * DIRECT_IO_ALIGNMENT))
+        self._window_len = 0
+        self._fadvise(os.POSIX_FADV_RANDOM)
+        return self
+
+    def close(self):
+        if self.direct_fd is not None:
+            os.close(self.direct_fd)
+            self.direct_fd = None
+        self._window = None
+        super().close()
+
+    def advise(self, option, offset=0, length=0):
+        """Map mmap.MADV_* hints onto posix_fadvise() and the read size."""
+        if option == getattr(mmap, "MADV_SEQUENTIAL", None):
+            self._sequential = True
+            self._fadvise(os.POSIX_FADV_SEQUENTIAL, offset, length)
+        elif option == getattr(mmap, "MADV_RANDOM", None):
+            self._sequential = False
+            self._fadvise(os.POSIX_FADV_RANDOM, offset, length)
+        elif option == getattr(mmap, "MADV_DONTNEED", None):
+            self.drop(offset, length)
+
+    def drop(self, offset=0, length=0):
+        """Evict a range that was read through the buffered descriptor."""
+        self._fadvise(os.POSIX_FADV_DONTNEED, offset, length)
+
+    def view(self, offset, length):
+        """Return a memoryview of `length` bytes at `offset`.
+
+        Views are only valid until the next call to `view()`.
+        """
+        if offset >= self.size or length <= 0:
+            return memoryview(b"")
+        length = min(length, self.size - offset)
+
+        window_end = self._window_offset + self._window_len
+        if self._window_offset <= offset and offset + length <= window_end:
+            start = offset - self._window_offset
+            return self._window[start:start + length]
+
+        aligned_offset = offset - offset % DIRECT_IO_ALIGNMENT
+        aligned_length = _align_up(offset + length - aligned_offset)
+        if aligned_length > len(self._window):
+            # Oversized request: read it into its own aligned buffer
+            buffer = memoryview(mmap.mmap(-1, aligned_length))
+            n = self._read_into(buffer, aligned_offset)
+            start = offset - aligned_offset
+            return buffer[start:min(start + length, n)]
+
+        # Only a sweep running off the end of the window refills all of it; anything else
+        # (e.g. a carver measuring a hit) would drag the window away from where the sweep is
+        streaming = self._sequential and aligned_offset == window_end
+        read_length = len(self._window) if streaming else max(aligned_length, self.io_size)
+        self._window_offset = aligned_offset
+        self._window_len = self._read_into(self._window[:min(read_length, len(self._window))], aligned_offset)
+        start = offset - aligned_offset
+        return self._window[start:min(start + length, self._window_len)]
+
+    def _read_into(self, buffer, offset):
+        fd = self.direct_fd if self.direct_fd is not None else self.fd
+        total = 0
+        while total < len(buffer):
+            n = os.preadv(fd, [buffer[total:]], offset + total)
+            if n == 0:
+                break
+            total += n
+            if n % DIRECT_IO_ALIGNMENT:  # Short read at the end of the device
+                break
+        if self.direct_fd is None:
+            self.drop(offset, total)
+        return total
+
+    def _fadvise(self, advice, offset=0, length=0):
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(self.fd, offset, length, advice)
+
+def _align_up(length):
+    return -(-length // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT
@@ -0,0 +1,196 @@
+import bisect
+import hashlib
+import mmap
+import queue
+import threading
+
+HASH_ALGORITHMS = ("blake2b", "sha256", "md5")
+DEFAULT_HASH_ALGORITHM = "blake2b"
+
+DEFAULT_BUFFER_SIZE = 8 * 1024 * 1024
+DEFAULT_DEPTH = 4
+# Pieces held back, across all files, until the pieces before them are written
+DEFAULT_MAX_PENDING = 64 * 1024 * 1024
+
+class _PieceState:
+    def __init__(self, algorithm, covered):
+        self.hash = hashlib.new(algorithm)
+        self.covered = covered  # Sorted, merged (start, end) ranges of the file that will be written
+        self.starts = [start for start, _ in covered]
+        self.position = 0
+        self.pending = {}
+
+class PieceHasher:
+    """Hash files filled out of order (see ReadScheduler) from their pieces as they are written.
+
+    The ranges of every file are given up front with `expect()`. A piece
+    is hashed as soon as everything before it in its file has been, any
+    range no piece covers as zeros, so a file written front to back is
+    never read back. Pieces that arrive early are copied and held, up to
+    `max_pending` bytes over all files; a file that would need more, or
+    whose pieces overlap, is left for `hexdigest()` to report as unknown.
+    """
+
+    def __init__(self, algorithm=DEFAULT_HASH_ALGORITHM, max_pending=DEFAULT_MAX_PENDING):
+        if algorithm not in hashlib.algorithms_available:
+            raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self.max_pending = max_pending
+        self.pending_bytes = 0
+        self._files = {}
+
+    def expect(self, requests):
+        """Register the (dst_offset, length) of every request, each having a `path`."""
+        ranges = {}
+        for request in requests:
+            ranges.setdefault(request.path, []).append((request.dst_offset, request.dst_offset + request.length))
+        for path, spans in ranges.items():
+            covered = []
+            for start, end in sorted(spans):
+                if covered and start <= covered[-1][1]:
+                    covered[-1] = (covered[-1][0], max(covered[-1][1], end))
+                else:
+                    covered.append((start, end))
+            self._files[path] = _PieceState(self.algorithm, covered)
+
+    def update(self, path, offset, data):
+        """Account for `data` written at `offset` of the file at `path`."""
+        state = self._files.get(path)
+        if state is None:
+            return
+        if offset < state.position or offset in state.pending:
+            self._give_up(path)
+        elif self._next(state, offset):
+            self._feed(state, offset, data)
+            # Pieces held back may follow now
+            while state.pending:
+                offset = min(state.pending)
+                if not self._next(state, offset):
+                    break
+                piece = state.pending.pop(offset)
+                self.pending_bytes -= len(piece)
+                self._feed(state, offset, piece)
+        elif self.pending_bytes + len(data) > self.max_pending:
+            self._give_up(path)
+        else:
+            state.pending[offset] = bytes(data)
+            self.pending_bytes += len(data)
+
+    def hexdigest(self, path, size):
+        """Return the digest of the file's first `size` bytes, or None if its pieces couldn't all be hashed."""
+        state = self._files.get(path)
+        if state is None:
+            return None
+        self._give_up(path)
+        if state.pending or state.position > size:
+            return None
+        self._zeros(state, size - state.position)
+        return state.hash.hexdigest()
+
+    def _next(self, state, offset):
+        # True if nothing will be written between what was hashed and `offset`
+        if offset == state.position:
+            return True
+        i = bisect.bisect_right(state.starts, state.position) - 1
+        if i >= 0 and state.covered[i][1] > state.position:
+            return False  # Inside a range still being written
+        return state.starts[i + 1] >= offset if i + 1 < len(state.starts) else True
+
+    def _feed(self, state, offset, data):
+        self._zeros(state, offset - state.position)
+        state.hash.update(data)
+        state.position = offset + len(data)
+
+    def _zeros(self, state, length):
+        zeros = bytes(min(length, DEFAULT_BUFFER_SIZE))
+        while length > 0:
+            n = min(length, len(zeros))
+            state.hash.update(zeros[:n])
+            length -= n
+
+    def _give_up(self, path):
+        state = self._files.pop(path)
+        self.pending_bytes -= sum(len(piece) for piece in state.pending.values())
+
+def hash_file(path, algorithm=DEFAULT_HASH_ALGORITHM, buffer_size=DEFAULT_BUFFER_SIZE):
+    """Digest of a file read back from disk, for files not written front to back."""
+    file_hash = hashlib.new(algorithm)
+    buffer = memoryview(bytearray(buffer_size))
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            file_hash.update(buffer[:n])
+    return file_hash.hexdigest()
+
+class StreamHasher:
+    """Hash recovered data on a background thread while it is being written.
+
+    Writers borrow one of a few page-aligned buffers with `acquire()`, fill
+    and write it, then `submit()` it. The hasher thread digests the buffer
+    and hands it back to the pool, so hashing of one chunk overlaps with the
+    I/O of the next and no byte is ever read back from disk. hashlib
+    releases the GIL on large updates, so the two threads run concurrently.
+    """
+
+    def __init__(self, algorithm=DEFAULT_HASH_ALGORITHM, buffer_size=DEFAULT_BUFFER_SIZE, depth=DEFAULT_DEPTH):
+        if algorithm not in hashlib.algorithms_available:
+            raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self.buffer_size = buffer_size
+        self._hash = None
+        self._zeros = memoryview(bytes(buffer_size))
+        self._free = queue.Queue()
+        for _ in range(depth):
+            # Anonymous mappings are page aligned
+            self._free.put(memoryview(mmap.mmap(-1, buffer_size)))
+        self._pending = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def start(self):
+        """Begin hashing a new file."""
+        self._hash = hashlib.new(self.algorithm)
+
+    def acquire(self):
+        """Borrow a buffer of `buffer_size` bytes to read the next chunk into."""
+        return self._free.get()
+
+    def submit(self, buffer, length):
+        """Queue the first `length` bytes of a borrowed buffer for hashing."""
+        self._pending.put((buffer, length))
+
+    def release(self, buffer):
+        """Return a borrowed buffer without hashing it."""
+        self._free.put(buffer)
+
+    def feed_zeros(self, length):
+        """Account for a hole: `length` zero bytes that are never written."""
+        while length > 0:
+            n = min(length, self.buffer_size)
+            self._pending.put((self._zeros, n))
+            length -= n
+
+    def hexdigest(self):
+        """Wait for queued chunks and return the digest of the current file."""
+        done = queue.Queue(maxsize=1)
+        self._pending.put(done)
+        return done.get()
+
+    def close(self):
+        self._pending.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            if isinstance(item, queue.Queue):
+                item.put(self._hash.hexdigest())
+                continue
+            buffer, length = item
+            self._hash.update(buffer[:length])
+            if buffer is not self._zeros:
+                self._free.put(buffer)
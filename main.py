@@ -3,9 +3,16 @@ from gi.repository import GLib
 import os
 import cairo
 import subprocess
+import threading
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, Gdk
 import re
+import shlex
+import tempfile
+from carver import FILE_TYPE_CATEGORIES, carve_image, types_for_categories
+from events import EventSink, follow_events, DEFAULT_EVENTS_NAME
+from manifest import DEFAULT_MANIFEST_NAME
+from path_regex import read_paths
 
 class SaveMyNodeApp(Gtk.Window):
     def __init__(self):
@@ -310,13 +317,99 @@ class SaveMyNodeApp(Gtk.Window):
         partition_recovery_button.connect("clicked", self.on_partition_recovery_clicked)
         button_box.pack_start(partition_recovery_button, False, False, 0)
 
-        partition_recovery_button = Gtk.Button(label="Dry Run")
+        dry_run_button = Gtk.Button(label="Dry Run")
+        dry_run_button.connect("clicked", self.on_dry_run_clicked)
+        button_box.pack_start(dry_run_button, False, False, 0)
+
+    def on_dry_run_clicked(self, button):
+        device = self.selected_device()
+        if not device:
+            self.show_error_message("Please select a drive first.")
+            return
+        paths = self.choose_recovery_paths()
+        if paths is None:
+            return
+
         pattern = ".*"
+        path_list = None
+        if paths:
+            # dry-run.sh takes "@FILE" as a list of paths, all searched for in one sweep per root
+            with tempfile.NamedTemporaryFile("w", prefix="btrfs-paths.", suffix=".txt", delete=False) as f:
+                f.write("\n".join(paths) + "\n")
+            path_list = f.name
+            pattern = "@" + path_list
         restore_path = "/tmp"
-        depth = "2";
-        dry_run_command = f'./dry-run.sh {depth} /dev/nvme0n1p7 {pattern} 0 {restore_path}'
-        partition_recovery_button.connect("clicked", lambda w: self.dry_run(dry_run_command))
-        button_box.pack_start(partition_recovery_button, False, False, 0)
+        depth = "2"
+        try:
+            self.dry_run(f'./dry-run.sh {depth} {shlex.quote(device)} {shlex.quote(pattern)} 0 {restore_path}')
+        finally:
+            # dry-run.sh has finished with it (a recovery it starts in the background reads its own copy)
+            if path_list:
+                os.unlink(path_list)
+
+    def choose_recovery_paths(self):
+        """Asks for the paths to look for, one per line. Returns [] for everything, None if cancelled.
+
+        Paths can be typed (globs allowed, directories ending in /), loaded
+        from a list file or picked, several at once, in a file chooser.
+        """
+        dialog = Gtk.Dialog(title="Paths to Recover", transient_for=self, modal=True)
+        dialog.set_default_size(500, 350)
+        dialog.add_buttons(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL, Gtk.STOCK_OK, Gtk.ResponseType.OK)
+
+        vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
+        dialog.get_content_area().pack_start(vbox, True, True, 10)
+        vbox.pack_start(Gtk.Label(label="One path or glob per line, relative to the filesystem root.\n"
+                                        "End directories with /. Leave empty to search for everything."),
+                        False, False, 0)
+
+        scrolled_window = Gtk.ScrolledWindow()
+        scrolled_window.set_vexpand(True)
+        text_view = Gtk.TextView()
+        scrolled_window.add(text_view)
+        vbox.pack_start(scrolled_window, True, True, 0)
+        text_buffer = text_view.get_buffer()
+
+        def add_paths(paths):
+            text = text_buffer.get_text(text_buffer.get_start_iter(), text_buffer.get_end_iter(), False)
+            lines = [line for line in text.splitlines() if line.strip()] + list(paths)
+            text_buffer.set_text("\n".join(lines))
+
+        def choose_files(action, title):
+            chooser = Gtk.FileChooserDialog(title=title, transient_for=dialog, action=action,
+                                            buttons=(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                                                     Gtk.STOCK_OPEN, Gtk.ResponseType.OK))
+            chooser.set_select_multiple(True)
+            chosen = chooser.get_filenames() if chooser.run() == Gtk.ResponseType.OK else []
+            chooser.destroy()
+            return chosen
+
+        def load_list(widget):
+            for list_file in choose_files(Gtk.FileChooserAction.OPEN, "Load Path Lists"):
+                try:
+                    add_paths(read_paths(list_file))
+                except (OSError, UnicodeDecodeError) as e:
+                    self.show_error_message(f"Could not read {list_file}: {e}")
+
+        def pick_files(widget):
+            add_paths(choose_files(Gtk.FileChooserAction.OPEN, "Select Files to Recover"))
+
+        button_box = Gtk.Box(spacing=10)
+        vbox.pack_start(button_box, False, False, 0)
+        load_button = Gtk.Button(label="Load List...")
+        load_button.connect("clicked", load_list)
+        button_box.pack_start(load_button, False, False, 0)
+        pick_button = Gtk.Button(label="Add Files...")
+        pick_button.connect("clicked", pick_files)
+        button_box.pack_start(pick_button, False, False, 0)
+
+        dialog.show_all()
+        response = dialog.run()
+        text = text_buffer.get_text(text_buffer.get_start_iter(), text_buffer.get_end_iter(), False)
+        dialog.destroy()
+        if response != Gtk.ResponseType.OK:
+            return None
+        return [line.strip() for line in text.splitlines() if line.strip() and not line.lstrip().startswith("#")]
 
     def show_error_message(self, error_message):
         """Displays a floating window with an error message."""
@@ -483,12 +576,15 @@ class SaveMyNodeApp(Gtk.Window):
         file_types_label = Gtk.Label(label="Select file types:", halign=Gtk.Align.START)
         grid.attach(file_types_label, 0, 2, 1, 1)
 
-        file_types = ["Text Files (.txt)", "Images (.jpg, .png)", "Documents (.pdf, .docx)", 
-                      "Audio Files (.mp3, .wav)", "Videos (.mp4, .avi)", "Archives (.zip, .tar)"]
+        file_types_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=5)
+        grid.attach(file_types_box, 0, 3, 2, 1)
 
-        file_types_text = ", ".join(file_types)  # Join file types as a comma-separated string
-        file_types_display_label = Gtk.Label(label=f"File types: {file_types_text}", halign=Gtk.Align.START)
-        grid.attach(file_types_display_label, 0, 3, 2, 1)
+        self.file_type_checkboxes = []
+        for file_type in FILE_TYPE_CATEGORIES:
+            checkbox = Gtk.CheckButton(label=file_type)
+            checkbox.set_active(True)  # All selected by default
+            self.file_type_checkboxes.append(checkbox)
+            file_types_box.pack_start(checkbox, False, False, 0)
 
         confirm_button = Gtk.Button(label="Start Recovery")
         confirm_button.connect("clicked", self.on_confirm_recovery)
@@ -511,25 +607,22 @@ class SaveMyNodeApp(Gtk.Window):
             self.show_error_message("Please select at least one file type.")
             return
 
-        # Build the text message with selected file types and success status
-        recovery_message = (
-            f"Recovery started successfully!\n\n"
-            f"Selected file types:\n- {', '.join(selected_file_types)}"
-        )
-
-        # Retrieve the buffer from the stats textview (assuming stats_textview exists)
-        buffer = self.stats_textview.get_buffer()
-        buffer.set_text(recovery_message)
-
-        # Ensure the stats screen is visible to the user
-        self.stack.set_visible_child_name("statistics")
-
+        restoration_path = self.choose_restoration_path()
+        if restoration_path:
+            self.start_carving(restoration_path, selected_file_types)
 
     def on_inode_recovery_clicked(self, button):
         self.show_recovery_dialog("Inode Recovery", "Enter details for Inode Recovery")
 
     def on_partition_recovery_clicked(self, button):
         # Step 1: Show file chooser dialog for restoration path
+        restoration_path = self.choose_restoration_path()
+        if restoration_path:
+            # Step 2: Show recovery dialog for selecting file types
+            self.show_recovery_dialog("Partition Recovery", "Select file types and proceed", restoration_path)
+
+    def choose_restoration_path(self):
+        """Asks for the folder recovered files are written to. Returns None if cancelled."""
         file_chooser = Gtk.FileChooserDialog(
             title="Select Restoration Path",
             transient_for=self,
@@ -539,15 +632,9 @@ class SaveMyNodeApp(Gtk.Window):
         file_chooser.set_modal(True)
 
         response = file_chooser.run()
-
-        if response == Gtk.ResponseType.OK:
-            restoration_path = file_chooser.get_filename()
-            file_chooser.destroy()
-
-            # Step 2: Show recovery dialog for selecting file types
-            self.show_recovery_dialog("Partition Recovery", "Select file types and proceed", restoration_path)
-        else:
-            file_chooser.destroy()
+        restoration_path = file_chooser.get_filename() if response == Gtk.ResponseType.OK else None
+        file_chooser.destroy()
+        return restoration_path
 
     def show_recovery_dialog(self, title, action_desc, restoration_path):
         dialog = Gtk.Dialog(title=title, transient_for=self, modal=True)
@@ -573,11 +660,9 @@ class SaveMyNodeApp(Gtk.Window):
         vbox.pack_start(file_types_box, False, False, 0)
 
         # Common file types (all selected by default)
-        file_types = ["Text Files (.txt)", "Images (.jpg, .png)", "Documents (.pdf, .docx)", 
-                      "Audio Files (.mp3, .wav)", "Videos (.mp4, .avi)", "Archives (.zip, .tar)"]
         file_type_checkboxes = []
-        
-        for file_type in file_types:
+
+        for file_type in FILE_TYPE_CATEGORIES:
             checkbox = Gtk.CheckButton(label=file_type)
             checkbox.set_active(True)  # All selected by default
             file_type_checkboxes.append(checkbox)
@@ -635,9 +720,69 @@ class SaveMyNodeApp(Gtk.Window):
         # Close the dialog
         dialog.destroy()
 
+        self.start_carving(restoration_path, [checkbox.get_label() for checkbox in selected_file_types])
+
+    def selected_device(self):
+        """Returns the device path of the drive chosen on the recovery screen."""
+        drive_text = self.drive_combo.get_active_text()
+        if not drive_text:
+            return None
+        # lsblk prefixes partitions with tree characters
+        name = re.sub(r'^[^a-zA-Z0-9]+', '', drive_text).split()[0]
+        return f"/dev/{name}"
+
+    def start_carving(self, restoration_path, file_types):
+        """Carves the selected file types off the chosen drive in a background thread."""
+        device = self.selected_device()
+        if not device:
+            self.show_error_message("Please select a drive first.")
+            return
+
+        types = types_for_categories(file_types)
+        if not types:
+            self.show_error_message("Text files have no signature and cannot be carved.\n"
+                                    "Please select at least one other file type.")
+            return
+
+        progress_bar = Gtk.ProgressBar()
+        progress_bar.set_show_text(True)
+        status_label = Gtk.Label(label=f"Carving {', '.join(sorted(types))} files from {device}...")
+        self.stats_screen.pack_start(status_label, False, False, 0)
+        self.stats_screen.pack_start(progress_bar, False, False, 10)
+        self.stats_screen.show_all()
+
         # Switch to the statistics screen to display the updated recovery information
         self.stack.set_visible_child_name("statistics")
 
+        def progress(done, total):
+            GLib.idle_add(progress_bar.set_fraction, done / total if total else 1.0)
+
+        # The carving thread writes an event stream; this view follows it
+        events_path = os.path.join(restoration_path, DEFAULT_EVENTS_NAME)
+        start = os.path.getsize(events_path) if os.path.exists(events_path) else 0
+
+        def carve():
+            with EventSink(events_path, flush_interval=0.5) as events:
+                try:
+                    carve_image(device, restoration_path, types,
+                                manifest_path=os.path.join(restoration_path, DEFAULT_MANIFEST_NAME),
+                                progress=progress, free_only=True, events=events)
+                except Exception as e:
+                    events.error("carve_failed", f"Carving failed: {e}")
+
+        def follow():
+            failed = False
+            for record in follow_events(events_path, start):
+                if record["event"] in ("file_carved", "carve_failed"):
+                    failed = failed or record["event"] == "carve_failed"
+                    GLib.idle_add(status_label.set_text, record["message"])
+                elif record["event"] == "summary" and not failed:
+                    carved = record["counts"].get("file_carved", 0)
+                    GLib.idle_add(status_label.set_text, f"Recovered {carved} files to {restoration_path}")
+
+        threading.Thread(target=carve, daemon=True).start()
+        threading.Thread(target=follow, daemon=True).start()
+
     def show_error_message(self, error_message):
         """Displays a floating window with an error message."""
         dialog = Gtk.Dialog(title="Error", transient_for=self, modal=True)
@@ -0,0 +1,44 @@
+import json
+import os
+import time
+
+DEFAULT_MANIFEST_NAME = "recovery_manifest.jsonl"
+
+class RunManifest:
+    """Per-run record of recovered files, one JSON object per line."""
+
+    def __init__(self, path=DEFAULT_MANIFEST_NAME):
+        self.path = path
+        self.file = None
+        self.count = 0
+
+    def open(self):
+        self.file = open(self.path, "a", encoding="utf-8")
+        return self
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, path, size, algorithm=None, digest=None, **fields):
+        """Record one recovered file. Extra keyword fields are stored as-is."""
+        record = {"path": os.path.abspath(path), "size": size}
+        if algorithm:
+            record["algorithm"] = algorithm
+            record["digest"] = digest
+        record.update(fields)
+        record["time"] = time.time()
+        self.file.write(json.dumps(record) + "\n")
+        self.count += 1
+
+def read_manifest(path):
+    """Return the records of a manifest file as a list of dicts."""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
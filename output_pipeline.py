@@ -0,0 +1,136 @@
+import os
+
+from extent_copy import ExtentCopier
+from integrity import PieceHasher, StreamHasher, DEFAULT_HASH_ALGORITHM, hash_file
+from manifest import RunManifest, DEFAULT_MANIFEST_NAME
+
+class RecoveredFile:
+    """One output file being assembled from ranges of the source image.
+
+    Ranges must be written in increasing destination order so the inline
+    digest sees the file front to back; anything skipped becomes a hole
+    and is hashed as zeros.
+    """
+
+    def __init__(self, pipeline, path):
+        self.pipeline = pipeline
+        self.path = path
+        self.position = 0
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        if pipeline.hasher:
+            pipeline.hasher.start()
+
+    def write(self, src_offset, dst_offset, length):
+        """Copy `length` source bytes to `dst_offset` and return how many were covered."""
+        hasher = self.pipeline.hasher
+        if hasher:
+            hasher.feed_zeros(dst_offset - self.position)
+        covered = self.pipeline.copier.copy(self.pipeline.src_fd, src_offset, self.fd, dst_offset, length, hasher)
+        if self.pipeline.drop_cache:
+            os.posix_fadvise(self.pipeline.src_fd, src_offset, length, os.POSIX_FADV_DONTNEED)
+        self.position = dst_offset + covered
+        return covered
+
+    def finish(self, size, **fields):
+        """Set the final size, close the file and record it. Returns the digest, if any."""
+        hasher = self.pipeline.hasher
+        try:
+            if hasher:
+                hasher.feed_zeros(size - self.position)
+            # Extending the file leaves everything not written as holes
+            os.ftruncate(self.fd, size)
+        finally:
+            os.close(self.fd)
+
+        digest = hasher.hexdigest() if hasher else None
+        self.pipeline.record(self.path, size, digest, **fields)
+        return digest
+
+class OutputPipeline:
+    """Shared output path for every recovery method.
+
+    Data is copied from the source descriptor by an ExtentCopier, hashed
+    inline by a StreamHasher and every finished file is added to the run
+    manifest. With `drop_cache`, source pages are evicted once copied. With
+    a ContentStore, finished files are deduplicated into it by digest.
+
+    Files filled out of order are hashed by `pieces`, a PieceHasher to hand
+    to the ReadScheduler filling them; `read_back` counts those it could
+    not hash, which are read back from disk instead.
+    """
+
+    def __init__(self, src_fd, hash_algorithm=DEFAULT_HASH_ALGORITHM, manifest_path=DEFAULT_MANIFEST_NAME,
+                 copier=None, drop_cache=False, store=None):
+        if store and not hash_algorithm:
+            raise ValueError("a content store needs a hash algorithm")
+        self.src_fd = src_fd
+        self.drop_cache = drop_cache
+        self.store = store
+        self.hash_algorithm = hash_algorithm
+        self.manifest_path = manifest_path
+        self.copier = copier or ExtentCopier()
+        self.hasher = None
+        self.pieces = None
+        self.read_back = 0
+        self.manifest = None
+
+    def open(self):
+        if self.hash_algorithm:
+            self.hasher = StreamHasher(self.hash_algorithm)
+            self.pieces = PieceHasher(self.hash_algorithm)
+        if self.manifest_path:
+            self.manifest = RunManifest(self.manifest_path).open()
+        return self
+
+    def close(self):
+        if self.hasher:
+            self.hasher.close()
+            self.hasher = None
+        self.pieces = None
+        if self.manifest:
+            self.manifest.close()
+            self.manifest = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def create(self, path):
+        self._unlink_stored(path)
+        return RecoveredFile(self, path)
+
+    def prepare(self, path):
+        """Create an empty output file that will be filled out of order (see ReadScheduler)."""
+        self._unlink_stored(path)
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644))
+
+    def _unlink_stored(self, path):
+        # A name left by an earlier run may be a link to a blob; truncating it would corrupt the store
+        if self.store and os.path.lexists(path):
+            os.unlink(path)
+
+    def complete(self, path, size, **fields):
+        """Record a file filled out of order. Returns the digest, if any.
+
+        The digest comes from `pieces`, or from reading the finished file
+        back if they could not all be hashed as they were written.
+        """
+        os.truncate(path, size)
+        digest = None
+        if self.hash_algorithm:
+            digest = self.pieces.hexdigest(path, size) if self.pieces else None
+            if digest is None:
+                digest = hash_file(path, self.hash_algorithm)
+                self.read_back += 1
+        self.record(path, size, digest, **fields)
+        return digest
+
+    def record(self, path, size, digest, **fields):
+        """Move a finished file into the content store, if any, and add it to the manifest."""
+        if self.store:
+            blob, _, linked = self.store.add(path, digest)
+            fields.update(blob=os.path.abspath(blob), linked=linked)
+        if self.manifest:
+            self.manifest.add(path, size, self.hash_algorithm, digest, **fields)
@@ -0,0 +1,181 @@
+import argparse
+import os
+import re
+import sys
+
+# Linux caps a single argument at 128 KiB; stay well below it
+MAX_REGEX_LENGTH = 64 * 1024
+
+# Characters with a meaning in POSIX extended regexes, as used by `btrfs restore --path-regex`
+_ERE_SPECIAL = set(".[]()*+?{}|^$\\")
+
+def read_paths(path):
+    """Return the paths listed in a file, one per line; blank lines and # comments are skipped."""
+    with (sys.stdin if path == "-" else open(path, encoding="utf-8")) as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+def normalize(path):
+    """Return `path` with a single leading /: `btrfs restore` into / prints paths starting with //."""
+    return "/" + path.lstrip("/")
+
+def _split(path):
+    """Return (components, is_directory) of a path; a trailing / marks a directory."""
+    directory = path.endswith("/")
+    return [part for part in path.strip("/").split("/") if part], directory
+
+def glob_to_ere(component):
+    """Translate one path component with shell wildcards into an ERE.
+
+    `*` and `?` stay within the component and `[...]` is kept as a bracket
+    expression. A component of just `**`, any number of components, is
+    left to the callers.
+    """
+    out = []
+    i = 0
+    while i < len(component):
+        c = component[i]
+        if c == "*":
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            j = i + 1
+            if component[j:j + 1] == "!":
+                j += 1
+            if component[j:j + 1] == "]":
+                j += 1
+            end = component.find("]", j)
+            if end < 0:
+                out.append("\\[")
+            else:
+                body = component[i + 1:end]
+                out.append("[^" + body[1:] + "]" if body.startswith("!") else "[" + body + "]")
+                i = end
+        elif c in _ERE_SPECIAL:
+            out.append("\\" + c)
+        else:
+            out.append(c)
+        i += 1
+    return "".join(out)
+
+def _render(node, top=False):
+    # The node itself (the empty alternative), everything under it for a directory, then its children
+    alternatives = [""]
+    if node.get(None):
+        alternatives.append(".*" if top else "/.*")
+    for component, child in node.items():
+        if component == "**":
+            # Zero or more components: everything under the node, whatever follows
+            alternatives.append(".*" if top else "/.*")
+        elif component is not None:
+            alternatives.append(("" if top else "/") + glob_to_ere(component) + _render(child))
+    return "" if alternatives == [""] else "(" + "|".join(alternatives) + ")"
+
+def path_regex(paths):
+    """Return one ERE matching every path in `paths` and the directories leading to them.
+
+    `btrfs restore` only descends into directories its regex matches, so
+    every ancestor has to match too; generate-regex.sh builds the same
+    `(|a(|/b(|/c)))` shape for a single path. Paths sharing a prefix share
+    its part of the regex. The result has no leading /, to be anchored as
+    `^/REGEX$`.
+
+    The regex can't tell files from directories: one for `a/*/c` also
+    matches the files directly under `a`, and one for `a/**/c` everything
+    under it. Restored paths are to be filtered with path_selector.
+    """
+    trie = {}
+    for path in paths:
+        components, directory = _split(path)
+        node = trie
+        for component in components:
+            node = node.setdefault(component, {})
+        if directory or not components:
+            node[None] = True
+    return _render(trie, True)
+
+def path_regexes(paths, limit=MAX_REGEX_LENGTH):
+    """Return the regexes for `paths`, as few as fit in `limit` characters each.
+
+    Paths are grouped in sorted order, so neighbours share a regex. A
+    group's length is estimated from its paths' own regexes, which the
+    merged regex never exceeds; a single path longer than `limit` still
+    gets a regex of its own.
+    """
+    regexes = []
+    group = []
+    length = 0
+    for path in sorted(set(paths)):
+        size = len(path_regex([path]))
+        if group and length + size > limit:
+            regexes.append(path_regex(group))
+            group, length = [], 0
+        group.append(path)
+        length += size
+    if group:
+        regexes.append(path_regex(group))
+    return regexes
+
+def path_matcher(path):
+    """Return a compiled regex matching `path` itself, or anything under it for a directory.
+
+    `**` matches zero or more components, as in the regexes of path_regex.
+    """
+    components, directory = _split(path)
+    pattern = "".join("(/.*)?" if component == "**" else "/" + glob_to_ere(component)
+                      for component in components)
+    if directory:
+        pattern += "/.*"
+    return re.compile(pattern or "/")
+
+def path_selector(paths):
+    """Return a function telling whether a restored path is one of `paths`, or under one of their directories."""
+    matchers = [path_matcher(path) for path in paths]
+    return lambda path: any(matcher.fullmatch(path) for matcher in matchers)
+
+def prune(directory, selected):
+    """Delete the files under `directory` that `selected` rejects, then the directories left empty.
+
+    Paths are judged relative to `directory`, which stands for the
+    filesystem root: a restore destination.
+    """
+    for parent, dirs, files in os.walk(directory, topdown=False):
+        for name in files:
+            path = os.path.join(parent, name)
+            if not selected("/" + os.path.relpath(path, directory)):
+                os.remove(path)
+        if parent != directory and not os.listdir(parent):
+            os.rmdir(parent)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compile paths and globs into `btrfs restore` path regexes.")
+    parser.add_argument("paths", nargs="*", help="paths relative to the filesystem root; end directories with /")
+    parser.add_argument("--from", dest="path_file", help="file listing more paths, one per line (- for stdin)")
+    parser.add_argument("--limit", type=int, default=MAX_REGEX_LENGTH,
+                        help="longest regex to print (default: %(default)s characters)")
+    parser.add_argument("--select", action="store_true",
+                        help="instead, print the restored paths read from stdin that are selected")
+    parser.add_argument("--prune", metavar="DIR",
+                        help="instead, delete the files restored into DIR that are not selected")
+    args = parser.parse_args(argv)
+
+    paths = list(args.paths)
+    if args.path_file:
+        paths += read_paths(args.path_file)
+    if not paths:
+        parser.error("no paths given")
+    if args.select:
+        selected = path_selector(paths)
+        for line in sys.stdin:
+            if selected(normalize(line.rstrip("\n"))):
+                sys.stdout.write(line)
+        return 0
+    if args.prune:
+        prune(args.prune, path_selector(paths))
+        return 0
+    for regex in path_regexes(paths, args.limit):
+        print(regex)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import mmap
+import os
+from collections import OrderedDict, namedtuple
+
+# Ranges closer than this are read together; reading the gap is cheaper than a seek
+DEFAULT_MAX_GAP = 256 * 1024
+# Upper bound of one coalesced read (and of the buffer it goes into)
+DEFAULT_MAX_READ = 32 * 1024 * 1024
+# Output files kept open at once during dispatch
+DEFAULT_MAX_OPEN = 128
+
+ReadRequest = namedtuple("ReadRequest", "src_offset length path dst_offset")
+
+class ReadScheduler:
+    """Extract many source ranges in one sweep across the device.
+
+    Ranges are queued with `add()` while candidates are being collected.
+    `run()` sorts them by source offset, coalesces neighbours into large
+    reads and writes each piece of a read to its own output file, so the
+    device is read front to back once whatever the order of the files.
+    Output files are opened through a small LRU of descriptors. With
+    `drop_cache`, source pages are evicted once read. With an IOEngine the
+    coalesced reads are issued concurrently, capped at its buffer size, and
+    written out in whatever order they complete. With a PieceHasher, every
+    piece is hashed from memory as it is written.
+    """
+
+    def __init__(self, src_fd, max_gap=DEFAULT_MAX_GAP, max_read=DEFAULT_MAX_READ, max_open=DEFAULT_MAX_OPEN,
+                 drop_cache=False, engine=None, hasher=None):
+        self.src_fd = src_fd
+        self.hasher = hasher
+        self.drop_cache = drop_cache
+        self.engine = engine
+        self.max_gap = max_gap
+        self.max_read = min(max_read, engine.buffer_size) if engine else max_read
+        self.max_open = max_open
+        self.requests = []
+        self._fds = OrderedDict()
+        self.reads = 0
+        self.bytes_read = 0
+
+    def add(self, src_offset, length, path, dst_offset):
+        """Queue `length` bytes at `src_offset` for `dst_offset` of the file at `path`."""
+        if length > 0:
+            self.requests.append(ReadRequest(src_offset, length, path, dst_offset))
+
+    def batches(self):
+        """Yield (offset, length, requests) for every coalesced read, in offset order."""
+        batch = []
+        start = end = 0
+        for request in sorted(self.requests):
+            request_end = request.src_offset + request.length
+            if batch and (request.src_offset > end + self.max_gap or
+                          max(end, request_end) - start > self.max_read):
+                yield start, end - start, batch
+                batch = []
+            if not batch:
+                start = end = request.src_offset
+            batch.append(request)
+            end = max(end, request_end)
+        if batch:
+            yield start, end - start, batch
+
+    def run(self):
+        """Perform every queued read and write, then forget them."""
+        try:
+            if self.hasher:
+                self.hasher.expect(self.requests)
+            batches = []
+            for offset, length, batch in self.batches():
+                if length > self.max_read:
+                    # A single range larger than a read is streamed on its own
+                    for request in batch:
+                        self._copy_large(request)
+                else:
+                    batches.append((offset, length, batch))
+            if self.engine:
+                self._dispatch_concurrent(batches)
+            else:
+                self._dispatch(batches)
+        finally:
+            self.close()
+            self.requests = []
+
+    def _dispatch(self, batches):
+        buffer = None
+        for offset, length, batch in batches:
+            if buffer is None:
+                # Anonymous mappings are page aligned
+                buffer = memoryview(mmap.mmap(-1, self.max_read))
+            n = self._read(buffer[:length], offset)
+            self._scatter(offset, buffer[:n], batch)
+
+    def _dispatch_concurrent(self, batches):
+        for (offset, _, batch), data in self.engine.reads(batches, ordered=False):
+            self.reads += 1
+            self.bytes_read += len(data)
+            if self.drop_cache:
+                os.posix_fadvise(self.src_fd, offset, len(data), os.POSIX_FADV_DONTNEED)
+            self._scatter(offset, data, batch)
+
+    def _scatter(self, offset, data, batch):
+        for request in batch:
+            start = request.src_offset - offset
+            self._write(request.path, data[start:start + request.length], request.dst_offset)
+
+    def close(self):
+        while self._fds:
+            os.close(self._fds.popitem()[1])
+
+    def _copy_large(self, request):
+        buffer = memoryview(bytearray(self.max_read))
+        copied = 0
+        while copied < request.length:
+            n = self._read(buffer[:min(self.max_read, request.length - copied)], request.src_offset + copied)
+            if n == 0:
+                break
+            self._write(request.path, buffer[:n], request.dst_offset + copied)
+            copied += n
+
+    def _read(self, buffer, offset):
+        n = os.preadv(self.src_fd, [buffer], offset)
+        self.reads += 1
+        self.bytes_read += n
+        if self.drop_cache:
+            os.posix_fadvise(self.src_fd, offset, n, os.POSIX_FADV_DONTNEED)
+        return n
+
+    def _write(self, path, data, offset):
+        fd = self._fds.get(path)
+        if fd is None:
+            if len(self._fds) >= self.max_open:
+                os.close(self._fds.popitem(last=False)[1])
+            fd = os.open(path, os.O_WRONLY)
+            self._fds[path] = fd
+        else:
+            self._fds.move_to_end(path)
+        written = 0
+        while written < len(data):
+            written += os.pwrite(fd, data[written:], offset + written)
+        if self.hasher:
+            self.hasher.update(path, offset, data)
@@ -1,33 +1,71 @@
+import re
 import struct
 import sys
 import os
-import hashlib
+import argparse
+import time
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from image_reader import ImageReader, DirectReader, DEFAULT_IO_SIZE
+from xfs_ag import iter_inode_chunks, chunk_offset, chunk_inodes, make_ino, fsb_to_offset, XFS_INODES_PER_CHUNK
+from xfs_bmap import BlockCache, extent_map
+from integrity import HASH_ALGORITHMS, DEFAULT_HASH_ALGORITHM
+from manifest import DEFAULT_MANIFEST_NAME
+from output_pipeline import OutputPipeline
+from scan_index import ScanIndex, ag_fingerprint, DEFAULT_INDEX_PATH
+from xfs_batch import candidate_indexes, directory_indexes, InodeFilter
+from xfs_dir import DirectoryIndex, directory_entries
+from freespace import xfs_free_space
+from read_scheduler import ReadScheduler
+from io_engine import IOEngine
+from events import EventSink, EventBuffer, LEVELS, DEBUG, INFO
+from content_store import ContentStore, DEFAULT_STORE_NAME
+from checkpoint import Checkpoint, DEFAULT_CHECKPOINT_NAME, DEFAULT_CHECKPOINT_INTERVAL
+from xfs_crc import CRCVerifier, CRC_MODES, DEFAULT_CRC_MODE, XFS_SB_CRC_OFF
 
 # Constants
 XFS_SUPERBLOCK_OFFSET = 0
 XFS_SUPERBLOCK_SIZE = 512
 XFS_DINODE_MAGIC = 0x494E  # 'IN'
 XFS_EXTENT_FORMAT = 2  # Extent format
+XFS_BTREE_FORMAT = 3  # B+tree format (extent map too large for the inode)
+XFS_SB_VERSION_NUMBITS = 0x000F
+XFS_SB_VERSION_5 = 5
 
 class XFSSuperblock:
     def __init__(self, data):
         self.magicnum = struct.unpack_from(">I", data, 0)[0]
         self.blocksize = struct.unpack_from(">I", data, 4)[0]
         self.dblocks = struct.unpack_from(">Q", data, 8)[0]
-        self.icount = struct.unpack_from(">Q", data, 104)[0]
-        self.ifree = struct.unpack_from(">Q", data, 112)[0]
-        self.inodesize = struct.unpack_from(">H", data, 100)[0]
-        self.crc = struct.unpack_from(">I", data, 32)[0]  # CRC for v5
-        self.uuid = struct.unpack_from("16s", data, 100)[0]  # UUID for v5
+        self.uuid = struct.unpack_from("16s", data, 32)[0]
+        self.rootino = struct.unpack_from(">Q", data, 56)[0]
+        self.agblocks = struct.unpack_from(">I", data, 84)[0]
+        self.agcount = struct.unpack_from(">I", data, 88)[0]
+        self.versionnum = struct.unpack_from(">H", data, 100)[0]
+        self.sectsize = struct.unpack_from(">H", data, 102)[0]
+        self.inodesize = struct.unpack_from(">H", data, 104)[0]
+        self.inopblock = struct.unpack_from(">H", data, 106)[0]
+        self.blocklog, self.sectlog, self.inodelog, self.inopblog, self.agblklog = \
+            struct.unpack_from(">5B", data, 120)
+        self.icount = struct.unpack_from(">Q", data, 128)[0]
+        self.ifree = struct.unpack_from(">Q", data, 136)[0]
+        self.dirblklog = struct.unpack_from(">B", data, 192)[0]
+        self.features2 = struct.unpack_from(">I", data, 200)[0]
+        self.features_incompat = struct.unpack_from(">I", data, 216)[0]
+        self.crc = struct.unpack_from("<I", data, 224)[0]  # CRC for v5
 
     def is_valid(self):
         return self.magicnum == 0x58465342  # "XFSB"
 
+    def is_v5(self):
+        return self.versionnum & XFS_SB_VERSION_NUMBITS == XFS_SB_VERSION_5
+
     def display_info(self):
         print("XFS Superblock Information:")
         print(f"  Block Size: {self.blocksize} bytes")
         print(f"  Inode Size: {self.inodesize} bytes")
         print(f"  Total Data Blocks: {self.dblocks}")
+        print(f"  Allocation Groups: {self.agcount} x {self.agblocks} blocks")
         print(f"  Total Inodes: {self.icount}")
         print(f"  Free Inodes: {self.ifree}")
         print(f"  UUID: {self.uuid.hex()}")
@@ -38,151 +76,651 @@ class XFSInode:
         self.mode = struct.unpack_from(">H", data, 2)[0]
         self.version = struct.unpack_from(">B", data, 4)[0]
         self.format = struct.unpack_from(">B", data, 5)[0]
-        self.nlink = struct.unpack_from(">H", data, 16)[0]
-        self.uid = struct.unpack_from(">I", data, 18)[0]
-        self.gid = struct.unpack_from(">I", data, 22)[0]
+        self.uid = struct.unpack_from(">I", data, 8)[0]
+        self.gid = struct.unpack_from(">I", data, 12)[0]
+        if self.version == 1:
+            self.nlink = struct.unpack_from(">H", data, 6)[0]
+        else:
+            self.nlink = struct.unpack_from(">I", data, 16)[0]
         self.size = struct.unpack_from(">Q", data, 56)[0]
+        self.nextents = struct.unpack_from(">I", data, 76)[0]
+        self.forkoff = struct.unpack_from(">B", data, 82)[0]
 
     def is_deleted(self):
         return self.nlink == 0 and self.magic == XFS_DINODE_MAGIC
 
 class XFSFileRecovery:
-    def __init__(self, image_path):
+    def __init__(self, image_path, workers=1, hash_algorithm=DEFAULT_HASH_ALGORITHM,
+                 manifest_path=DEFAULT_MANIFEST_NAME, index_path=None, inodes=None, sorted_reads=False,
+                 direct_io=False, io_size=DEFAULT_IO_SIZE, queue_depth=1, events=None, store_path=None,
+                 names=False, path_filter=None, checkpoint_path=None, resume=False,
+                 checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL, inode_filter=None, crc_mode=DEFAULT_CRC_MODE):
         self.image_path = image_path
-        self.fd = None
+        self.workers = workers
+        self.hash_algorithm = hash_algorithm
+        self.manifest_path = manifest_path
+        self.index_path = index_path
+        self.inodes = set(inodes or ())
+        self.inode_filter = inode_filter or None
+        self.crc_mode = crc_mode
+        self.verifier = None
+        self.sorted_reads = sorted_reads
+        self.direct_io = direct_io
+        self.io_size = io_size
+        self.queue_depth = queue_depth
+        self.store_path = store_path
+        # Matched against the recovered path; implies `names`
+        self.path_filter = re.compile(path_filter) if path_filter else None
+        self.directories = DirectoryIndex() if names or path_filter else None
+        self.paths = {}
+        self.used_names = {}
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.resume = resume
+        self.checkpoint = None
+        self.resumed = {}
+        self.events = events if events is not None else EventSink()
+        self.engine = None
+        self.reader = None
         self.superblock = None
+        self.block_cache = None
+        self.output = None
+        self.index = None
+        self.free_space = None
         self.image_size = 0
+        self.recovered_files = 0
+        self.recovered_bytes = 0
 
     def open_image(self):
-        self.fd = open(self.image_path, 'rb')
-        self.image_size = os.path.getsize(self.image_path)  # Get the image size
+        if self.direct_io:
+            # Keep a production host's page cache out of the recovery
+            self.reader = DirectReader(self.image_path, io_size=self.io_size).open()
+        else:
+            self.reader = ImageReader(self.image_path).open()
+        self.image_size = self.reader.size  # Also correct for block devices
+        if self.queue_depth > 1:
+            self.engine = IOEngine.for_reader(self.reader, self.queue_depth)
 
     def close_image(self):
-        if self.fd:
-            self.fd.close()
+        if self.engine:
+            self.engine.close()
+            self.engine = None
+        if self.reader:
+            self.reader.close()
 
     def read_superblock(self):
-        self.fd.seek(XFS_SUPERBLOCK_OFFSET)
-        sb_data = self.fd.read(XFS_SUPERBLOCK_SIZE)
+        sb_data = self.reader.view(XFS_SUPERBLOCK_OFFSET, XFS_SUPERBLOCK_SIZE)
         self.superblock = XFSSuperblock(sb_data)
+        self.verifier = CRCVerifier(self.superblock, self.crc_mode, self.events)
+        self.block_cache = BlockCache(self.reader, self.superblock, verifier=self.verifier)
 
         if not self.superblock.is_valid():
-            print("Not a valid XFS filesystem.")
+            self.events.error("invalid_superblock", "Not a valid XFS filesystem.", magic=self.superblock.magicnum)
+            sys.exit(1)
+        if not self.verifier.check(self.reader.view(XFS_SUPERBLOCK_OFFSET, self.superblock.sectsize),
+                                   XFS_SB_CRC_OFF, "superblock"):
+            self.events.error("invalid_superblock", "The superblock CRC does not match.")
             sys.exit(1)
 
         self.superblock.display_info()
+        self.events.debug("superblock", uuid=self.superblock.uuid.hex(), blocksize=self.superblock.blocksize,
+                          agcount=self.superblock.agcount, agblocks=self.superblock.agblocks,
+                          icount=self.superblock.icount, ifree=self.superblock.ifree)
+
+    def selection(self):
+        """Describe the options that select the candidates, which a resumed run must share."""
+        selection = self.inode_filter.describe() if self.inode_filter else []
+        if self.inodes:
+            selection.append(["inodes", sorted(self.inodes)])
+        if self.path_filter:
+            selection.append(["path", self.path_filter.pattern])
+        return selection
+
+    def start_checkpoint(self):
+        """Open the checkpoint and, when resuming, pick up the AGs and counts it recorded."""
+        sb = self.superblock
+        self.checkpoint = Checkpoint(self.checkpoint_path, self.checkpoint_interval)
+        try:
+            self.checkpoint.start(sb.uuid, sb.inodesize, self.resume, self.selection())
+        except ValueError as e:
+            self.checkpoint = None
+            self.events.error("checkpoint_mismatch", f"Cannot resume: {e}.", path=self.checkpoint_path)
+            sys.exit(1)
+        if self.resume and self.checkpoint.ags():
+            self.resumed = self.checkpoint.ag_candidates()
+            self.recovered_files = self.checkpoint.state["files"]
+            self.recovered_bytes = self.checkpoint.state["bytes"]
+            self.events.info("checkpoint_resumed", f"Resuming: {len(self.resumed)} of {sb.agcount} AGs already "
+                             f"swept, {self.checkpoint.state['extracted']} candidates already handled.",
+                             ags=sorted(self.resumed), extracted=self.checkpoint.state["extracted"])
+
+    def iter_chunk_data(self, agno):
+        """Yield (chunk, chunk_data) for every inode chunk in the inode btree of one AG.
+
+        Only the inode chunks referenced by the AG's inode btree are read, so
+        the cost of a scan follows the number of inodes rather than the
+        size of the device.
+        """
+        sb = self.superblock
+        chunk_size = XFS_INODES_PER_CHUNK * sb.inodesize
+        if self.engine is None:
+            for chunk in iter_inode_chunks(self.reader, sb, agno, self.verifier, self.events):
+                yield chunk, self.reader.view(chunk_offset(sb, agno, chunk.startino), chunk_size)
+            return
 
-    def read_inodes(self):
-        inode_start_offset = XFS_SUPERBLOCK_OFFSET + XFS_SUPERBLOCK_SIZE
-        inodes_read = 0
-        self.fd.seek(inode_start_offset)
-
-        while inodes_read < self.superblock.icount:
-            inode_data = self.fd.read(self.superblock.inodesize)
-            if not inode_data:
-                break
-
-            inode = XFSInode(inode_data)
-            
-            # Only print non-zero inodes for debugging purposes
-            if inode.magic != 0 or inode.format != 0 or inode.size != 0:
-                print(f"Inode {inodes_read}: Magic = {hex(inode.magic)}, Format = {inode.format}, Size = {inode.size}")
-
-                # Check for valid inode data format (e.g., extents)
-                if inode.format == XFS_EXTENT_FORMAT:  # Example: extent format
-                    print(f"Valid data inode found at index {inodes_read}, attempting recovery...")
-                    self.recover_file(inode, inode_data)
-            
-            inodes_read += 1
-
-    def recover_file(self, inode, inode_data):
-        print("Recovering file from inode data...")
-        extents = self.extract_extents(inode, inode_data)
+        # Keep the device queue full: the chunk reads go out concurrently and
+        # come back in btree order
+        requests = ((chunk_offset(sb, agno, chunk.startino), chunk_size, chunk)
+                    for chunk in iter_inode_chunks(self.reader, sb, agno, self.verifier, self.events))
+        for (_, _, chunk), chunk_data in self.engine.reads(requests):
+            yield chunk, chunk_data
+
+    def scan_ag(self, agno):
+        """Yield (ino, inode, inode_data) for every non-empty inode in one AG."""
+        sb = self.superblock
+        inodesize = sb.inodesize
+
+        for chunk, chunk_data in self.iter_chunk_data(agno):
+            for i in chunk_inodes(chunk):
+                inode_data = chunk_data[i * inodesize:(i + 1) * inodesize]
+                if len(inode_data) < inodesize:
+                    break
+
+                inode = XFSInode(inode_data)
+                if inode.magic != 0 or inode.format != 0 or inode.size != 0:
+                    yield make_ino(sb, agno, chunk.startino + i), inode, inode_data
+
+    def find_candidates(self, agno):
+        """Yield (ino, inode, inode_data) for the recoverable deleted inodes of one AG.
+
+        Each chunk is triaged as a batch; XFSInode objects are only built for
+        the inodes that survive the filter.
+        """
+        sb = self.superblock
+        inodesize = sb.inodesize
+        # The scan index keeps every candidate, so that later runs can filter differently
+        inode_filter = None if self.index else self.inode_filter
+
+        directories = []
+        for chunk, chunk_data in self.iter_chunk_data(agno):
+            indexes = candidate_indexes(chunk_data, inodesize, chunk.holemask,
+                                        formats=(XFS_EXTENT_FORMAT, XFS_BTREE_FORMAT), inode_filter=inode_filter)
+            # Only the survivors are checksummed, as one batch per chunk
+            for i in self.verifier.inodes(chunk_data, inodesize, indexes, agno=agno, startino=chunk.startino):
+                # Copied: candidates outlive the chunk buffer of a windowed reader
+                inode_data = bytes(chunk_data[i * inodesize:(i + 1) * inodesize])
+                yield make_ino(sb, agno, chunk.startino + i), XFSInode(inode_data), inode_data
+            if self.directories is not None:
+                directories.extend(self.directory_inodes(agno, chunk, chunk_data))
+        self.add_directories(directories)
+
+    def directory_inodes(self, agno, chunk, chunk_data):
+        """Return (ino, inode_data) for the live directories of one chunk."""
+        inodesize = self.superblock.inodesize
+        return [(make_ino(self.superblock, agno, chunk.startino + i),
+                 bytes(chunk_data[i * inodesize:(i + 1) * inodesize]))
+                for i in directory_indexes(chunk_data, inodesize, chunk.holemask)]
+
+    def add_directories(self, directories):
+        """Add the entries of directory inodes to the directory index.
+
+        Called once the chunks of an AG have been swept, since reading
+        directory blocks would reuse the chunk buffer of a windowed reader.
+        """
+        for ino, inode_data in directories:
+            entries = directory_entries(self.reader, self.block_cache, self.superblock, XFSInode(inode_data),
+                                        inode_data)
+            self.directories.add_directory(ino, entries)
+
+    def scan_directories(self, agno):
+        """Index the directories of an AG whose candidates came from the scan index."""
+        directories = []
+        for chunk, chunk_data in self.iter_chunk_data(agno):
+            directories.extend(self.directory_inodes(agno, chunk, chunk_data))
+        self.add_directories(directories)
+
+    def scan_ags(self, agnos):
+        """Yield (agno, [(ino, inode_data)]) for the given AGs, in order.
+
+        With more than one worker the AGs are sharded across a process pool;
+        each worker maps the image itself and only the raw candidate inodes,
+        the directory entries of its AG and what its CRC checks found travel
+        back to this process.
+        """
+        if self.workers <= 1 or len(agnos) <= 1:
+            for agno in agnos:
+                yield agno, [(ino, inode_data) for ino, _, inode_data in self.find_candidates(agno)]
+            return
+
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(agnos)),
+                                 initializer=_init_scan_worker,
+                                 initargs=(self.image_path, self.direct_io, self.io_size,
+                                           self.queue_depth, self.directories is not None,
+                                           None if self.index else self.inode_filter, self.crc_mode)) as pool:
+            # map() hands results back in submission order as they complete
+            for agno, (candidates, directories, failures, events) in zip(agnos,
+                                                                         pool.map(_find_candidates_in_ag, agnos)):
+                if directories is not None:
+                    self.directories.extend(directories)
+                self.verifier.failures.update(failures)
+                EventBuffer.replay(events, self.events)
+                yield agno, candidates
+
+    def iter_candidates(self):
+        """Yield candidates from every AG, in AG order.
+
+        With a scan index, AGs whose headers have not changed since they were
+        indexed are answered from the index and only the others are scanned.
+        """
+        sb = self.superblock
+        fingerprints = {}
+        # AGs swept before an interrupted run was checkpointed
+        cached = dict(self.resumed)
+        if self.index:
+            for agno in range(sb.agcount):
+                if agno in cached:
+                    continue
+                fingerprints[agno] = ag_fingerprint(self.reader, sb, agno)
+                candidates = self.index.ag_candidates(sb.uuid, agno, fingerprints[agno])
+                if candidates is not None:
+                    cached[agno] = candidates
+            if cached:
+                self.events.info("index_hit", f"{len(cached)} of {sb.agcount} AGs unchanged since the last scan; "
+                                 "using the scan index.", ags=sorted(cached))
+
+        scanned = self.scan_ags([agno for agno in range(sb.agcount) if agno not in cached])
+        for agno in range(sb.agcount):
+            if agno in cached:
+                candidates = cached[agno]
+                if self.directories is not None:
+                    self.scan_directories(agno)
+            else:
+                _, candidates = next(scanned)
+
+            decoded = [(ino, XFSInode(inode_data), inode_data) for ino, inode_data in candidates]
+            if self.index and agno not in cached:
+                self.index.store_ag(sb.uuid, agno, fingerprints[agno], [
+                    (ino, inode, inode_data, extent_map(self.block_cache, sb, inode, inode_data))
+                    for ino, inode, inode_data in decoded])
+            if self.index and self.inode_filter:
+                candidates = [(ino, inode_data) for ino, inode_data in candidates
+                              if self.inode_filter.matches(inode_data, 0, sb.inodesize)]
+                decoded = [(ino, inode, inode_data) for ino, inode, inode_data in decoded
+                           if self.inode_filter.matches(inode_data, 0, sb.inodesize)]
+            if self.checkpoint and agno not in self.resumed:
+                self.checkpoint.add_ag(agno, candidates)
+            yield from decoded
+
+    def read_inodes(self, candidates=None):
+        """Recover every candidate, scanning for them unless `candidates` is given."""
+        # Blocks of a deleted file that were allocated again hold someone else's data
+        self.free_space = xfs_free_space(self.reader, self.superblock, self.verifier, self.events)
+        scheduler = None
+        if self.sorted_reads:
+            scheduler = ReadScheduler(self.reader.fileno(), drop_cache=self.direct_io, engine=self.engine,
+                                      hasher=self.output.pieces)
+        planned = []
+        if candidates is None:
+            candidates = self.iter_candidates()
+        if self.directories is not None:
+            candidates = self.name_candidates(candidates)
+        # Candidates come in the same order on every run, so a checkpoint only counts them
+        extracted = self.checkpoint.state["extracted"] if self.checkpoint else 0
+        for position, (ino, inode, inode_data) in enumerate(candidates):
+            if position < extracted or (self.inodes and ino not in self.inodes):
+                continue
+            self.events.debug("inode_found", f"Deleted data inode found at {ino}, attempting recovery...",
+                              ino=ino, format=inode.format, size=inode.size)
+            if scheduler:
+                plan = self.plan_file(ino, inode, inode_data, scheduler)
+                if plan:
+                    planned.append(plan + (position,))
+            else:
+                self.recover_file(ino, inode, inode_data)
+                self.save_progress(position + 1)
+
+        if scheduler:
+            self.extract_planned(scheduler, planned)
+
+    def save_progress(self, extracted):
+        if self.checkpoint:
+            self.checkpoint.extracted(extracted, self.recovered_files, self.recovered_bytes)
+
+    def name_candidates(self, candidates):
+        """Resolve the original paths of every candidate at once and apply the path filter.
+
+        Names are only complete once every AG has been swept, so the
+        candidates are collected before anything is extracted.
+        """
+        candidates = list(candidates)
+        self.paths = self.directories.resolve([ino for ino, _, _ in candidates], self.superblock.rootino)
+        self.events.info("names_resolved", f"Recovered the names of {len(self.paths)} of {len(candidates)} deleted "
+                         f"inodes from {len(self.directories)} directory entries.", named=len(self.paths),
+                         candidates=len(candidates), entries=len(self.directories))
+        if self.path_filter is None:
+            return candidates
+        return [candidate for candidate in candidates if self.path_filter.search(self.paths.get(candidate[0], ""))]
+
+    def output_name(self, ino):
+        """Output file name of an inode: its recovered path if known, otherwise its inode number."""
+        path = self.paths.get(ino)
+        if path is None:
+            return f"recovered_file_{ino}.dat"
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.basename(path) in self.used_names.setdefault(directory, set()):
+            # An earlier deleted file had the same path
+            path = f"{path}.{ino}"
+        self.used_names[directory].add(os.path.basename(path))
+        return path
+
+    def output_fields(self, ino):
+        fields = {"ino": ino}
+        if ino in self.paths:
+            fields["original_path"] = self.paths[ino]
+        return fields
+
+    def recover_file(self, ino, inode, inode_data):
+        extents = self.extract_extents(inode, inode_data, ino)
         if not extents:
-            print("No extents found for this inode.")
+            self.events.debug("inode_skipped", "No extents found for this inode.", ino=ino, reason="no extents")
             return
 
-        recovered_filename = f"recovered_file_{id(inode_data)}.dat"
-        with open(recovered_filename, 'wb') as out_file:
+        recovered_filename = self.output_name(ino)
+        size = self.recovered_size(inode, extents)
+        out_file = self.output.create(recovered_filename)
+        try:
             for extent in extents:
-                self.read_extent_data(extent, out_file)
-
-        print(f"Recovered file written to {recovered_filename}")
-        self.verify_integrity(recovered_filename)
+                self.read_extent_data(extent, out_file, size)
+        finally:
+            # Gaps and unwritten extents were never written and stay holes
+            digest = out_file.finish(size, **self.output_fields(ino))
 
-    def extract_extents(self, inode, inode_data):
-        """Extract extents from inode data based on inode format."""
-        extents = []
-        if inode.format == XFS_EXTENT_FORMAT:
-            # Example calculation; adjust as per actual format
-            num_extents = (len(inode_data) - 60) // 16
-            for i in range(num_extents):
-                offset = 60 + i * 16
-                try:
-                    start_block = struct.unpack_from(">Q", inode_data, offset)[0]
-                    block_count = struct.unpack_from(">I", inode_data, offset + 8)[0]
-                except struct.error as e:
-                    print(f"Struct unpacking error: {e}")
-                    continue
+        self.report_recovery(recovered_filename, ino, size, digest)
 
-                # Validation checks for extent values
-                if start_block * self.superblock.blocksize >= self.image_size:
-                    print(f"Invalid extent found: Start Block = {start_block}, exceeds image size.")
-                    continue
+    def plan_file(self, ino, inode, inode_data, scheduler):
+        """Queue the extents of an inode on `scheduler`. Returns (filename, size, ino) or None."""
+        extents = self.extract_extents(inode, inode_data, ino)
+        if not extents:
+            self.events.debug("inode_skipped", "No extents found for this inode.", ino=ino, reason="no extents")
+            return None
+
+        recovered_filename = self.output_name(ino)
+        size = self.recovered_size(inode, extents)
+        self.output.prepare(recovered_filename)
+        for extent in extents:
+            for src_offset, dst_offset, length in self.extent_pieces(extent, size):
+                scheduler.add(src_offset, length, recovered_filename, dst_offset)
+        return recovered_filename, size, ino
+
+    def extract_planned(self, scheduler, planned):
+        """Second phase of a sorted-read run: one sweep across the image, then the digests."""
+        self.events.info("extraction_started",
+                         f"Extracting {len(scheduler.requests)} ranges of {len(planned)} files in offset order...",
+                         ranges=len(scheduler.requests), files=len(planned))
+        scheduler.run()
+        self.events.info("extraction_finished", f"Read {scheduler.bytes_read} bytes in {scheduler.reads} reads.",
+                         bytes_read=scheduler.bytes_read, reads=scheduler.reads)
+        for recovered_filename, size, ino, position in planned:
+            digest = self.output.complete(recovered_filename, size, **self.output_fields(ino))
+            self.report_recovery(recovered_filename, ino, size, digest)
+            self.save_progress(position + 1)
+        if self.output.read_back:
+            self.events.info("digests_read_back", f"{self.output.read_back} files were read back to hash them: "
+                             "their pieces arrived too far out of order.", files=self.output.read_back)
+
+    def report_recovery(self, recovered_filename, ino, size, digest):
+        self.recovered_files += 1
+        self.recovered_bytes += size
+        message = f"Recovered file written to {recovered_filename}"
+        if digest:
+            message += f" ({self.hash_algorithm} {digest})"
+        self.events.info("file_recovered", message, path=recovered_filename, ino=ino, size=size,
+                         algorithm=self.hash_algorithm, digest=digest)
+
+    def extract_extents(self, inode, inode_data, ino=None):
+        """Extract the extent map of an inode from its extent list or bmap btree."""
+        if inode.format not in (XFS_EXTENT_FORMAT, XFS_BTREE_FORMAT):
+            self.events.warning("inode_skipped", f"Unknown inode format {inode.format}; skipping...",
+                                ino=ino, reason="unknown format", format=inode.format)
+            return []
 
-                print(f"  Found extent: Start Block = {start_block}, Block Count = {block_count}")
-                extents.append((start_block, block_count))
-        else:
-            print(f"Unknown inode format {inode.format}; skipping...")
+        extents = []
+        for extent in extent_map(self.block_cache, self.superblock, inode, inode_data):
+            # Validation checks for extent values
+            if fsb_to_offset(self.superblock, extent.start_block) >= self.image_size:
+                self.events.warning("extent_invalid", f"Invalid extent found: Start Block = {extent.start_block}, "
+                                    "exceeds image size.", ino=ino, start_block=extent.start_block)
+                continue
+
+            self.events.debug("extent", f"  Found extent: File Block = {extent.offset}, "
+                              f"Start Block = {extent.start_block}, Block Count = {extent.block_count}",
+                              ino=ino, file_block=extent.offset, start_block=extent.start_block,
+                              block_count=extent.block_count, unwritten=extent.unwritten)
+            extents.append(extent)
 
         return extents
 
-    def read_extent_data(self, extent, out_file):
-        """Read data from an extent and write it to the output file."""
-        start_block, block_count = extent
+    def recovered_size(self, inode, extents):
+        """Size of the recovered file: the inode size, or the end of the last extent once it was zeroed."""
+        if inode.size:
+            return inode.size
+        last = extents[-1]
+        return (last.offset + last.block_count) * self.superblock.blocksize
+
+    def read_extent_data(self, extent, out_file, size=None):
+        """Copy an extent from the image to its place in the output file."""
+        for src_offset, dst_offset, length in self.extent_pieces(extent, size):
+            # The kernel moves the data straight from the image to the output
+            # file unless it has to pass through the hasher on the way
+            out_file.write(src_offset, dst_offset, length)
+
+    def extent_pieces(self, extent, size=None):
+        """Yield the (image offset, file offset, length) ranges of an extent worth copying."""
         block_size = self.superblock.blocksize
+        start = extent.offset * block_size
+        if size is None:
+            size = start + extent.block_count * block_size
+        if start >= size:
+            return
+
+        if extent.unwritten:
+            # Preallocated but never written: the blocks hold stale data
+            self.events.debug("extent_skipped", f"Skipping unwritten extent at file block {extent.offset}; "
+                              "leaving a hole.", file_block=extent.offset, reason="unwritten")
+            return
 
         # Calculate the starting offset
-        offset = start_block * block_size
+        offset = fsb_to_offset(self.superblock, extent.start_block)
 
         # Validate offset before seeking
         if offset >= self.image_size:
-            print(f"Error: Attempted to seek to offset {offset}, which is outside the image bounds.")
+            self.events.error("extent_invalid", f"Error: Attempted to seek to offset {offset}, "
+                              "which is outside the image bounds.", offset=offset)
             return
 
-        print(f"Reading data from offset {offset} for {block_count} blocks of size {block_size}.")
-
-        self.fd.seek(offset)
-
-        for _ in range(block_count):
-            data = self.fd.read(block_size)
-            if not data:
-                break
-            out_file.write(data)
-
-    def verify_integrity(self, filename):
-        """Verify the integrity of the recovered file by computing its hash."""
-        hash_md5 = hashlib.md5()
-        with open(filename, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        print(f"MD5 hash of {filename}: {hash_md5.hexdigest()}")
+        length = min(extent.block_count * block_size, self.image_size - offset, size - start)
+        if self.free_space is None:
+            yield offset, start, length
+            return
+        for free_start, free_end in self.free_space.overlap(offset, offset + length):
+            yield free_start, start + free_start - offset, free_end - free_start
+        if not self.free_space.covers(offset, offset + length):
+            self.events.warning("extent_reallocated", f"Extent at file block {extent.offset} was partly "
+                                "reallocated; leaving those blocks as holes.", file_block=extent.offset,
+                                offset=offset, length=length)
 
     def run(self):
-        self.open_image()
-        self.read_superblock()
-        self.read_inodes()
-        self.close_image()
+        self.events.open()
+        if self.index_path:
+            self.index = ScanIndex(self.index_path).open()
+        try:
+            self.open_image()
+            store = ContentStore(self.store_path) if self.store_path else None
+            self.output = OutputPipeline(self.reader.fileno(), self.hash_algorithm, self.manifest_path,
+                                         drop_cache=self.direct_io, store=store).open()
+            self.read_superblock()
+            if self.checkpoint_path:
+                self.start_checkpoint()
+            self.read_inodes()
+            if self.checkpoint:
+                self.checkpoint.remove()
+                self.checkpoint = None
+        finally:
+            if self.checkpoint:
+                self.checkpoint.save(force=True)
+                self.checkpoint.close()
+                self.events.info("checkpoint_saved", f"Progress saved to {self.checkpoint_path}; "
+                                 "continue with --resume.", path=self.checkpoint_path,
+                                 ags=len(self.checkpoint.ags()), extracted=self.checkpoint.state["extracted"])
+            if self.output:
+                self.output.close()
+            self.close_image()
+            if self.index:
+                self.index.close()
+            fields = {"files": self.recovered_files, "bytes": self.recovered_bytes}
+            if self.verifier and self.verifier.failures:
+                fields["crc_failures"] = dict(self.verifier.failures)
+            message = f"Recovered {self.recovered_files} files ({self.recovered_bytes} bytes)."
+            store = self.output.store if self.output else None
+            if store:
+                fields.update(blobs=store.blobs, duplicates=store.duplicates, duplicate_bytes=store.duplicate_bytes)
+                message += f" {store.duplicates} duplicates stored once ({store.duplicate_bytes} bytes saved)."
+            self.events.info("run_finished", message, **fields)
+            self.events.close(**fields)
+
+# Per-process state for parallel scans, set up once by the pool initializer
+_worker_recovery = None
+
+def _init_scan_worker(image_path, direct_io=False, io_size=DEFAULT_IO_SIZE, queue_depth=1, names=False,
+                      inode_filter=None, crc_mode=DEFAULT_CRC_MODE):
+    global _worker_recovery
+    _worker_recovery = XFSFileRecovery(image_path, direct_io=direct_io, io_size=io_size, queue_depth=queue_depth,
+                                       names=names, inode_filter=inode_filter, crc_mode=crc_mode,
+                                       events=EventBuffer())
+    _worker_recovery.open_image()
+    _worker_recovery.superblock = XFSSuperblock(
+        _worker_recovery.reader.view(XFS_SUPERBLOCK_OFFSET, XFS_SUPERBLOCK_SIZE))
+    _worker_recovery.verifier = CRCVerifier(_worker_recovery.superblock, crc_mode, _worker_recovery.events)
+    _worker_recovery.block_cache = BlockCache(_worker_recovery.reader, _worker_recovery.superblock,
+                                              verifier=_worker_recovery.verifier)
+
+def _find_candidates_in_ag(agno):
+    """Return the candidates of one AG, the directory entries found in it when names are wanted, and the
+    CRC failures counted and events emitted while scanning it."""
+    if _worker_recovery.directories is not None:
+        _worker_recovery.directories = DirectoryIndex()
+    candidates = [(ino, bytes(inode_data)) for ino, _, inode_data in _worker_recovery.find_candidates(agno)]
+    failures = dict(_worker_recovery.verifier.failures)
+    _worker_recovery.verifier.failures.clear()
+    return candidates, _worker_recovery.directories, failures, _worker_recovery.events.drain()
+
+TIME_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+def parse_time(value):
+    """Parse Unix seconds, an ISO 8601 date/time or an age such as 90m, 1h or 2d ago."""
+    if value[-1:] in TIME_UNITS and value[:-1].isdigit():
+        return int(time.time()) - int(value[:-1]) * TIME_UNITS[value[-1]]
+    if value.lstrip("-").isdigit():
+        return int(value)
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a time: {value!r} (use Unix seconds, ISO 8601 or an age like 1h)")
+
+def parse_mode(value):
+    """Parse an octal mode, optionally followed by /MASK (e.g. 100000/170000 for regular files)."""
+    mode, _, mask = value.partition("/")
+    try:
+        return int(mode, 8), int(mask, 8) if mask else None
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not an octal mode: {value!r}")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python xfs_recovery.py <xfs_disk_image>")
+    parser = argparse.ArgumentParser(description="Recover deleted files from an XFS disk image.")
+    parser.add_argument("image_path", help="XFS disk image or block device")
+    parser.add_argument("-j", "--workers", type=int, default=1,
+                        help="number of processes scanning allocation groups in parallel")
+    parser.add_argument("--hash", choices=HASH_ALGORITHMS + ("none",), default=DEFAULT_HASH_ALGORITHM,
+                        help="digest computed while files are extracted")
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST_NAME,
+                        help="JSON Lines file listing the recovered files and their digests")
+    parser.add_argument("--index", nargs="?", const=DEFAULT_INDEX_PATH, default=None,
+                        help="reuse and update a persistent scan index (default: %(const)s)")
+    parser.add_argument("--inode", type=int, action="append", dest="inodes",
+                        help="only recover this inode number (may be repeated)")
+    filters = parser.add_argument_group("filters", "evaluated on the raw inodes before any file data is read")
+    filters.add_argument("--min-size", type=int)
+    filters.add_argument("--max-size", type=int)
+    filters.add_argument("--mtime-after", type=parse_time, metavar="TIME",
+                         help="Unix seconds, ISO 8601 or an age such as 1h (also --mtime-before, --ctime-*)")
+    filters.add_argument("--mtime-before", type=parse_time, metavar="TIME")
+    filters.add_argument("--ctime-after", type=parse_time, metavar="TIME",
+                         help="deleting a file updates its ctime: --ctime-after 1h finds files deleted in the last hour")
+    filters.add_argument("--ctime-before", type=parse_time, metavar="TIME")
+    filters.add_argument("--uid", type=int, action="append", dest="uids", help="owner (may be repeated)")
+    filters.add_argument("--gid", type=int, action="append", dest="gids", help="group (may be repeated)")
+    filters.add_argument("--mode", type=parse_mode, metavar="OCTAL[/MASK]",
+                         help="mode bits, compared under MASK (default: the whole mode)")
+    filters.add_argument("--min-extents", type=int)
+    filters.add_argument("--max-extents", type=int)
+    parser.add_argument("--crc", choices=CRC_MODES, default=DEFAULT_CRC_MODE, dest="crc_mode",
+                        help="v5 metadata with a bad CRC: strict rejects it, lenient reports it and uses it anyway "
+                             "(default: %(default)s)")
+    parser.add_argument("--sorted-reads", action="store_true",
+                        help="collect every extent first, then read the image once in offset order")
+    parser.add_argument("--direct", action="store_true",
+                        help="read the device with O_DIRECT, keeping it out of the page cache")
+    parser.add_argument("--io-size", type=int, default=DEFAULT_IO_SIZE,
+                        help="smallest read issued in --direct mode, in bytes (default: %(default)s)")
+    parser.add_argument("-Q", "--queue-depth", type=int, default=1,
+                        help="reads kept in flight while scanning and during --sorted-reads extraction")
+    parser.add_argument("--store", nargs="?", const=DEFAULT_STORE_NAME, default=None,
+                        help="keep each distinct content once in this content-addressed directory and hard link "
+                             "the recovered names to it (default: %(const)s)")
+    parser.add_argument("--names", action="store_true",
+                        help="rebuild the directory tree and write files under their original paths")
+    parser.add_argument("--path", dest="path_filter", metavar="REGEX",
+                        help="only recover files whose original path matches this regular expression "
+                             "(implies --names)")
+    parser.add_argument("--checkpoint", nargs="?", const=DEFAULT_CHECKPOINT_NAME, default=None,
+                        help="save progress to this file so an interrupted run can be resumed (default: %(const)s)")
+    parser.add_argument("--checkpoint-interval", type=float, default=DEFAULT_CHECKPOINT_INTERVAL,
+                        help="seconds between progress saves; swept AGs are always saved (default: %(default)s)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the checkpoint of an interrupted run (implies --checkpoint)")
+    parser.add_argument("--events", help="append a JSON Lines event stream to this file")
+    parser.add_argument("--events-fd", type=int, help="write the event stream to this open file descriptor")
+    parser.add_argument("--event-level", choices=LEVELS, default="info",
+                        help="lowest level written to the event stream (default: %(default)s)")
+    parser.add_argument("--sample", type=int, default=1,
+                        help="write one in N debug and info events of each kind (default: every one)")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="print every inode and extent, not just recovered files and problems")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.image_path):
+        print(f"Error: Disk image {args.image_path} does not exist.")
         sys.exit(1)
-
-    image_path = sys.argv[1]
-    if not os.path.exists(image_path):
-        print(f"Error: Disk image {image_path} does not exist.")
-        sys.exit(1)
-
-    recovery_tool = XFSFileRecovery(image_path)
+    if args.store and args.hash == "none":
+        parser.error("--store needs a hash algorithm")
+
+    mode, mode_mask = args.mode or (None, None)
+    inode_filter = InodeFilter(args.min_size, args.max_size, args.mtime_after, args.mtime_before, args.ctime_after,
+                               args.ctime_before, args.uids, args.gids, mode,
+                               0o7777 | 0o170000 if mode_mask is None else mode_mask,
+                               args.min_extents, args.max_extents)
+    recovery_tool = XFSFileRecovery(args.image_path, workers=args.workers,
+                                    hash_algorithm=None if args.hash == "none" else args.hash,
+                                    manifest_path=args.manifest, index_path=args.index,
+                                    inodes=args.inodes, sorted_reads=args.sorted_reads,
+                                    direct_io=args.direct, io_size=args.io_size, queue_depth=args.queue_depth,
+                                    events=EventSink(args.events if args.events_fd is None else args.events_fd,
+                                                     level=LEVELS[args.event_level], sample=args.sample,
+                                                     console_level=DEBUG if args.verbose else INFO),
+                                    store_path=args.store, names=args.names, path_filter=args.path_filter,
+                                    checkpoint_path=args.checkpoint or (DEFAULT_CHECKPOINT_NAME if args.resume else None),
+                                    resume=args.resume, checkpoint_interval=args.checkpoint_interval,
+                                    inode_filter=inode_filter, crc_mode=args.crc_mode)
     recovery_tool.run()
@@ -0,0 +1,193 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import time
+
+from image_reader import ImageReader
+from xfs_ag import ag_offset
+import btrfs
+import btrfs_roots
+
+DEFAULT_INDEX_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "savemynode", "scan_index.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS xfs_ags (
+    uuid TEXT, agno INTEGER, fingerprint TEXT, scanned REAL,
+    PRIMARY KEY (uuid, agno));
+CREATE TABLE IF NOT EXISTS xfs_candidates (
+    uuid TEXT, agno INTEGER, ino INTEGER, size INTEGER, format INTEGER, inode BLOB, extents TEXT,
+    PRIMARY KEY (uuid, ino));
+CREATE TABLE IF NOT EXISTS btrfs_root_scans (
+    fsid TEXT, generation INTEGER, depth INTEGER, scanned REAL,
+    PRIMARY KEY (fsid, generation, depth));
+CREATE TABLE IF NOT EXISTS btrfs_roots (
+    fsid TEXT, generation INTEGER, depth INTEGER, bytenr INTEGER,
+    PRIMARY KEY (fsid, generation, depth, bytenr));
+"""
+
+def ag_fingerprint(reader, sb, agno):
+    """Digest of an AG's AGF and AGI sectors.
+
+    XFS has no filesystem-wide generation number, but every allocation or
+    free in an AG rewrites its headers (and on v5 bumps their LSN), so an
+    unchanged fingerprint means the AG's inode btree is unchanged too.
+    """
+    start = ag_offset(sb, agno) + sb.sectsize
+    return hashlib.blake2b(reader.view(start, 2 * sb.sectsize), digest_size=16).hexdigest()
+
+class ScanIndex:
+    """Persistent SQLite index of scan results, keyed by filesystem UUID.
+
+    XFS candidates are stored per allocation group together with the AG's
+    fingerprint, so a rescan only revisits the AGs that changed. Btrfs tree
+    roots are stored per fsid, superblock generation and search depth.
+    """
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = path
+        self.db = None
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(SCHEMA)
+        return self
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def ag_candidates(self, uuid, agno, fingerprint):
+        """Return the stored [(ino, inode_data)] of an AG, or None if it must be rescanned."""
+        row = self.db.execute("SELECT fingerprint FROM xfs_ags WHERE uuid = ? AND agno = ?",
+                              (uuid.hex(), agno)).fetchone()
+        if row is None or row[0] != fingerprint:
+            return None
+        rows = self.db.execute("SELECT ino, inode FROM xfs_candidates WHERE uuid = ? AND agno = ? ORDER BY ino",
+                               (uuid.hex(), agno))
+        return [(ino, inode) for ino, inode in rows]
+
+    def store_ag(self, uuid, agno, fingerprint, candidates):
+        """Replace the candidates of an AG. `candidates` holds (ino, inode, inode_data, extents)."""
+        with self.db:
+            self.db.execute("DELETE FROM xfs_candidates WHERE uuid = ? AND agno = ?", (uuid.hex(), agno))
+            self.db.executemany(
+                "INSERT OR REPLACE INTO xfs_candidates VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(uuid.hex(), agno, ino, inode.size, inode.format, bytes(inode_data),
+                  json.dumps([list(extent) for extent in extents]))
+                 for ino, inode, inode_data, extents in candidates])
+            self.db.execute("INSERT OR REPLACE INTO xfs_ags VALUES (?, ?, ?, ?)",
+                            (uuid.hex(), agno, fingerprint, time.time()))
+
+    def xfs_candidates(self, uuid):
+        """Yield (ino, size, format, extents) for every stored candidate of a filesystem."""
+        rows = self.db.execute("SELECT ino, size, format, extents FROM xfs_candidates WHERE uuid = ? ORDER BY ino",
+                               (uuid.hex(),))
+        for ino, size, fmt, extents in rows:
+            yield ino, size, fmt, json.loads(extents)
+
+    def btrfs_roots(self, fsid, generation, depth):
+        """Return the stored tree roots, newest first, or None if this generation was never searched."""
+        row = self.db.execute("SELECT 1 FROM btrfs_root_scans WHERE fsid = ? AND generation = ? AND depth = ?",
+                              (fsid.hex(), generation, depth)).fetchone()
+        if row is None:
+            return None
+        # Stored in rank order, which insertion order preserves
+        rows = self.db.execute("SELECT bytenr FROM btrfs_roots WHERE fsid = ? AND generation = ? AND depth = ? "
+                               "ORDER BY rowid", (fsid.hex(), generation, depth))
+        return [bytenr for bytenr, in rows]
+
+    def store_btrfs_roots(self, fsid, generation, depth, roots):
+        with self.db:
+            self.db.execute("DELETE FROM btrfs_roots WHERE fsid = ? AND generation = ? AND depth = ?",
+                            (fsid.hex(), generation, depth))
+            self.db.executemany("INSERT OR IGNORE INTO btrfs_roots VALUES (?, ?, ?, ?)",
+                                [(fsid.hex(), generation, depth, bytenr) for bytenr in roots])
+            self.db.execute("INSERT OR REPLACE INTO btrfs_root_scans VALUES (?, ?, ?, ?)",
+                            (fsid.hex(), generation, depth, time.time()))
+
+def run_btrfs_find_root(device, depth):
+    """Run btrfs-find-root and return the "Well block" candidates, newest first."""
+    command = ["btrfs-find-root"]
+    if depth >= 2:
+        command.append("-a")  # Search all metadata, not just until the expected generation
+    command.append(device)
+    if os.geteuid() != 0:
+        command.insert(0, "sudo")
+
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = result.stdout.decode(errors="replace")
+    roots = {int(bytenr) for bytenr in re.findall(r"Well block (\d+)", output)}
+    if not roots and result.returncode != 0:
+        # Don't let a failed run be cached as "no roots"
+        raise subprocess.CalledProcessError(result.returncode, command, output)
+    return sorted(roots, reverse=True)
+
+def find_btrfs_roots(reader, sb, depth):
+    """Return the tree roots found by scanning the metadata in-process, newest first."""
+    return [root.bytenr for root in btrfs_roots.find_tree_roots(reader, sb, all_nodes=depth >= 2)]
+
+def cached_btrfs_roots(index, device, depth):
+    """Return the tree roots of a btrfs device, searching for them only on a cache miss.
+
+    The metadata chunks are scanned in-process; btrfs-find-root is only run
+    if that finds nothing, e.g. when the chunk tree is too damaged to map
+    the metadata.
+    """
+    # Depths 0 and 1 run the same search
+    depth = 2 if depth >= 2 else 1
+    with ImageReader(device) as reader:
+        sb = btrfs.read_superblock(reader)
+        if not sb.is_valid():
+            raise ValueError(f"{device} is not a btrfs filesystem")
+        roots = index.btrfs_roots(sb.fsid, sb.generation, depth)
+        if roots is not None:
+            return roots
+        roots = find_btrfs_roots(reader, sb, depth)
+    if not roots:
+        roots = run_btrfs_find_root(device, depth)
+    index.store_btrfs_roots(sb.fsid, sb.generation, depth, roots)
+    return roots
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the SaveMyNode scan index.")
+    parser.add_argument("--index", default=DEFAULT_INDEX_PATH, help="path of the SQLite index")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    roots_parser = commands.add_parser("btrfs-roots", help="print the tree roots of a btrfs device, newest first")
+    roots_parser.add_argument("-D", "--depth", type=int, default=1)
+    roots_parser.add_argument("device")
+
+    list_parser = commands.add_parser("xfs-candidates", help="list the deleted inodes indexed for an XFS image")
+    list_parser.add_argument("image_path")
+
+    args = parser.parse_args(argv)
+    with ScanIndex(args.index) as index:
+        if args.command == "btrfs-roots":
+            for bytenr in cached_btrfs_roots(index, args.device, args.depth):
+                print(bytenr)
+        else:
+            from recover_xfs import XFSSuperblock, XFS_SUPERBLOCK_OFFSET, XFS_SUPERBLOCK_SIZE
+            with ImageReader(args.image_path) as reader:
+                sb = XFSSuperblock(reader.view(XFS_SUPERBLOCK_OFFSET, XFS_SUPERBLOCK_SIZE))
+            for ino, size, fmt, extents in index.xfs_candidates(sb.uuid):
+                blocks = sum(extent[2] for extent in extents)
+                print(f"Inode {ino}: Format = {fmt}, Size = {size}, Extents = {len(extents)}, Blocks = {blocks}")
+
+if __name__ == "__main__":
+    sys.exit(main())
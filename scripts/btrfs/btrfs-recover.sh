@@ -5,10 +5,15 @@ function usage() {
     echo "Usage: $0 [options]"
     echo "Options:"
     echo "  -d,  --device           Specify the device path"
-    echo "  -fp, --file-path        Path of the file/dir to recover"
+    echo "  -fp, --file-path        Path of the file/dir to recover; repeat for more, globs allowed"
+    echo "       --paths-from       File listing more paths/globs to recover, one per line"
     echo "  -rp, --recovery-path    Specify the recovery path"
     echo "  -D,  --depth            Specify the recovery depth"
     echo "  -R,  --recover          If 1, recover the files along with printing logs"
+    echo "       --resume           Continue an interrupted recovery, skipping the roots already restored"
+    echo "  -j,  --jobs             Number of roots restored at once (default: 4)"
+    echo "  -V,  --versions         Stop once the path was found in this many roots, newest first;"
+    echo "                          0 searches every root (default: 1)"
     echo "  -h,  --help             Display this help message"
 }
 
@@ -16,8 +21,7 @@ function usage() {
 # mount-check.sh expects: 
 # Argument 1: device path (e.g., /dev/sdb1)
 function is_mounted() {
-    cmd="$(dirname $0)/mount-check.sh $dev"
-    res="$(bash ./$cmd)"
+    res="$(bash "$(dirname "$0")/mount-check.sh" "$dev")"
     if [[ ! -z $res ]]; then
         echo "ERROR: Device '$dev' is mounted at '$res'."
         echo "Please unmount the device before proceeding."
@@ -28,7 +32,12 @@ function is_mounted() {
 # Initialize variables
 dev=""
 file_path=""
+file_paths=()
+paths_from=""
 recovery_path=""
+resume=0
+jobs=4
+versions=1
 
 # Function to validate the path
 validate_path() {
@@ -47,7 +56,12 @@ while [[ $# -gt 0 ]]; do
             shift 2
             ;;
         -fp|--file-path)
-            file_path="$2"
+            file_paths+=("$2")
+            shift 2
+            ;;
+        --paths-from)
+            paths_from="$2"
+            validate_path "$paths_from"
             shift 2
             ;;
         -rp|--recovery-path)
@@ -67,6 +81,18 @@ while [[ $# -gt 0 ]]; do
             recover="$2"
             shift 2
             ;;
+        --resume)
+            resume=1
+            shift
+            ;;
+        -j|--jobs)
+            jobs="$2"
+            shift 2
+            ;;
+        -V|--versions)
+            versions="$2"
+            shift 2
+            ;;
         *)
             echo "Unknown argument: $1"
             usage
@@ -76,7 +102,7 @@ while [[ $# -gt 0 ]]; do
 done
 
 # Check if required arguments are provided
-if [ -z "$dev" ] || [ -z "$file_path" ] || [ -z "$recovery_path" ] || [ -z "$depth" ]; then
+if [ -z "$dev" ] || [[ ${#file_paths[@]} -eq 0 && -z "$paths_from" ]] || [ -z "$recovery_path" ] || [ -z "$depth" ]; then
     echo "Error: Missing required arguments."
     usage
     exit 1
@@ -90,6 +116,8 @@ function sanitize_filepath() {
     fi
 
     echo ""
+    # What the root search stops at once found
+    target="/$file_path"
     # If the file path ends with '/', assume it's a directory
     if [[ $file_path == */ ]]; then
         rectype="dir"
@@ -103,12 +131,27 @@ function sanitize_filepath() {
     echo "Sanitized file path: '$file_path'"
 }
 
+# Write every requested path into one list, which dry-run.sh takes as "@FILE"
+# and compiles into as few regexes as possible, so that each root is swept once
+# for all of them instead of once per path
+function batch_paths() {
+    path_list=$(mktemp -t btrfs-paths.XXXXXX)
+    # dry-run.sh works on its own copy
+    trap 'rm -f "$path_list"' EXIT
+    printf '%s\n' "${file_paths[@]}" > "$path_list"
+    if [[ -n "$paths_from" ]]; then
+        cat "$paths_from" >> "$path_list"
+    fi
+    regex="@$path_list"
+    target=""
+    echo "Recovering $(grep -cv '^[[:space:]]*\(#\|$\)' "$path_list") paths in one sweep per root"
+}
+
 # Function to generate regex for file recovery
 # generate-regex.sh expects:
 # Argument 1: sanitized file path to create the regex pattern
 function cook_regex() { 
-    cmd="$(dirname $0)/generate-regex.sh $file_path"
-    regex="$(bash ./$cmd)"
+    regex="$(bash "$(dirname "$0")/generate-regex.sh" "$file_path")"
 }
 
 # Function for dry-run file recovery with depth levels
@@ -118,10 +161,15 @@ function cook_regex() {
 # Argument 3: regex (to find files based on the pattern)
 # Optional Argument 4: 1 if recovery should happen, 0 for just logging
 # Optional Argument 5: recovery path (where recovered files will be stored)
+# Optional Argument 6: 1 to resume an interrupted recovery
+# Optional Argument 7: number of roots restored at once
+# Optional Argument 8: roots the target must be found in before the search stops, 0 for all
+# Optional Argument 9: target path, ending in / for a directory
 function dryrun_with_depth_levels() {
-    cmd="$(dirname $0)/dry-run.sh $depth $dev $regex"
-    res="$(bash $cmd)"
-    echo "$cmd"
+    # Passed as separate words: paths with spaces or wildcards must reach dry-run.sh intact
+    cmd=("$(dirname "$0")/dry-run.sh" "$depth" "$dev" "$regex" 0 / 0 "$jobs" "$versions" "$target")
+    res="$(bash "${cmd[@]}")"
+    echo "${cmd[*]}"
 }
 
 # Function to recover files
@@ -131,17 +179,27 @@ function dryrun_with_depth_levels() {
 # Argument 3: regex (generated earlier)
 # Argument 4: recovery flag (1 for recovery)
 # Argument 5: recovery path (where to save the recovered files)
+# Argument 6: 1 to resume an interrupted recovery
+# Argument 7: number of roots restored at once
+# Argument 8: roots the target must be found in before the search stops, 0 for all
+# Argument 9: target path, ending in / for a directory
 function recover() { 
-    cmd="$(dirname $0)/dry-run.sh  $depth $dev $regex 1 $recovery_path"
-    regex="$(bash ./$cmd)"
+    regex="$(bash "$(dirname "$0")/dry-run.sh" "$depth" "$dev" "$regex" 1 "$recovery_path" "$resume" "$jobs" \
+                  "$versions" "$target")"
 }
 
 # Check if the device is mounted
 is_mounted
 
 # Sanitize file path and generate recovery regex
-sanitize_filepath
-cook_regex
+# A single plain path keeps the simple regex; lists and globs go through path_regex.py
+if [[ ${#file_paths[@]} -eq 1 && -z "$paths_from" && ${file_paths[0]} != *[*?[]* ]]; then
+    file_path="${file_paths[0]}"
+    sanitize_filepath
+    cook_regex
+else
+    batch_paths
+fi
 
 # Perform dry-run recovery with specified depth
 dryrun_with_depth_levels
@@ -1,43 +1,145 @@
 #!/bin/bash
-roots="/tmp/btrfsroots.tmp"
-tmp="/tmp/undeleter.tmp"
+# Every job works in its own directory, so recoveries of different devices can run at once
+workspace=$(mktemp -d -t btrfs-recover.XXXXXX)
+roots="$workspace/roots"
+tmp="$workspace/matches"
 rectype="none"
+# Set once a background restore owns the workspace and removes it itself
+keep_workspace=0
+function cleanup(){
+  if [[ $keep_workspace -ne 1 ]]; then
+    rm -rf "$workspace"
+  fi
+}
+trap cleanup EXIT
 
 depth=$1
 dev=$2
 regex=$3
+# As given, for the report: a path list is swept from a copy
+requested=$3
 
 # If 1 then recover files to the destination directory
 recover=$4
 dst=$5
+# If 1 then continue an interrupted recovery, skipping the roots it already restored
+resume=$6
+# Roots already restored into $dst, one per line
+checkpoint="$dst/.restored-roots"
+# Roots restored at once
+jobs=${7:-4}
+# Stop once the target path (ending in / for a directory) was found in this many roots; 0 searches every root
+versions=${8:-0}
+target=$9
+if [[ $regex == @* ]]; then
+  # The caller may remove its list as soon as this script returns, before a
+  # recovery left running in the background is done with it
+  cp "${regex#@}" "$workspace/paths"
+  regex="@$workspace/paths"
+fi
+# Kept as arrays so that paths with spaces or wildcards reach btrfs_restore.py intact
+search=(--versions "$versions")
+if [[ -n "$target" ]]; then
+  search+=(--target "$target")
+fi
+
+# Roots are found by scanning the metadata chunks in-process and cached in the
+# scan index, keyed by fsid and superblock generation, so the search only runs
+# again once the filesystem has changed
+scan_index="$(dirname "$0")/../../scan_index.py"
+# Restored files are folded into a content-addressed store, so content that
+# repeats across roots is kept once
+content_store="$(dirname "$0")/../../content_store.py"
+# Without Python, btrfs-find-root output is still cached per filesystem, keyed by
+# fsid and superblock generation
+roots_cache="${XDG_CACHE_HOME:-$HOME/.cache}/savemynode/btrfs-roots"
+# Runs the per-root restores concurrently, merging the matched paths
+btrfs_restore="$(dirname "$0")/../../btrfs_restore.py"
+# A regex of @FILE stands for a list of paths and globs, all recovered in one sweep per root
+path_regex="$(dirname "$0")/../../path_regex.py"
+
+# Print the regexes to sweep with, one per line
+function regexes(){
+  if [[ $regex != @* ]]; then
+    echo "$regex"
+  elif ! python3 "$path_regex" --from "${regex#@}" 2> /dev/null; then
+    # No Python: one regex per path, without wildcards
+    while read -r p || [[ -n "$p" ]]; do
+      if [[ -n "$p" && $p != \#* ]]; then
+        bash "$(dirname "$0")/generate-regex.sh" "${p#/}"
+      fi
+    done < "${regex#@}"
+  fi
+}
+
+# Filter restored paths, one per line, down to those listed: the regexes for a
+# list can't tell files from directories, so a glob such as a/*/c also matches
+# the files directly under a
+function selected(){
+  if [[ $regex == @* ]] && command -v python3 &> /dev/null; then
+    python3 "$path_regex" --from "${regex#@}" --select
+  else
+    cat
+  fi
+}
+
+# Print "<fsid>-<generation>" of the device, or nothing if the superblock can't be read
+function superblock_key(){
+  sudo btrfs inspect-internal dump-super "$dev" 2> /dev/null |
+    awk '$1 == "fsid" {fsid = $2} $1 == "generation" {generation = $2} END {if (fsid && generation) print fsid "-" generation}'
+}
+
+function findroots(){
+  key=$(superblock_key)
+  cached="$roots_cache/$key$1"
+  if [[ -n "$key" && -s "$cached" ]]; then
+    cp "$cached" "$roots"
+    return
+  fi
+  sudo btrfs-find-root $1 "$dev" &> "$tmp"
+  grep -a Well "$tmp" | sed -r -e 's/Well block ([0-9]+).*/\1/' | sort -rn > "$roots"
+  > "$tmp"
+  if [[ -n "$key" && -s "$roots" ]] && mkdir -p "$roots_cache"; then
+    # Renamed into place, so a concurrent job never reads half a list
+    cp "$roots" "$cached.$$" && mv "$cached.$$" "$cached"
+  fi
+}
 
 function generateroots(){
-  if [[ $depth -eq 1 || $depth -eq 0 ]]; then
-    sudo btrfs-find-root "$dev" &> "$tmp"
-    grep -a Well "$tmp" | sed -r -e 's/Well block ([0-9]+).*/\1/' | sort -rn > "$roots"
-    rootcount=$(wc -l "$roots" | awk '{print $1}')
-    > "$tmp"
+  if [[ $depth -eq 0 ]]; then
+    # The current root only: nothing to discover
+    rootcount=0
+    return
+  fi
+  if [[ $depth -eq 1 ]]; then
+    flags=""
   elif [[ $depth -eq 2 ]]; then
-    sudo btrfs-find-root -a "$dev" &> "$tmp"
-    grep -a Well "$tmp" | sed -r -e 's/Well block ([0-9]+).*/\1/' | sort -rn > "$roots"
-    rootcount=$(wc -l $roots | awk '{print $1}')
-    > "$tmp"
+    flags="-a"
   fi
+  if ! python3 "$scan_index" btrfs-roots --depth "$depth" "$dev" > "$roots" 2> /dev/null; then
+    # No Python or unreadable superblock: fall back to parsing btrfs-find-root directly
+    findroots $flags
+  fi
+  rootcount=$(wc -l "$roots" | awk '{print $1}')
 }
 
 function dryrun(){
   if [[ $depth -eq 0 ]]; then
-    sudo btrfs restore -Divv --path-regex '^/'${regex}'$' "$dev" /  2> /dev/null | grep -E "Restoring.*$recname" | cut -d" " -f 2- &> $tmp
-    # Level 1 finds roots and loops through them
-  elif [[ $depth -eq 1 ]]; then
-    while read -r i || [[ -n "$i" ]]; do
-      sudo btrfs restore -t "$i" -Divv --path-regex '^/'${regex}'$' "$dev" / 2> /dev/null | grep -E "Restoring.*$recname" | cut -d" " -f 2- &>> $tmp
-    done < "$roots"
-    # add the -a flag to the btrfs-find-roots, to find more roots
-  elif [[ $depth -eq 2 ]]; then
-    while read -r i || [[ -n "$i" ]]; do
-      sudo btrfs restore -t "$i" -Divv --path-regex '^/'${regex}'$' "$dev" / 2> /dev/null| grep -E "Restoring.*$recname" | cut -d" " -f 2- &>> $tmp
-    done < "$roots"
+    > "$tmp"
+    while read -r r; do
+      sudo btrfs restore -Divv --path-regex "^/$r\$" "$dev" /  2> /dev/null | grep -E "Restoring.*$recname" | cut -d" " -f 2- | selected &>> $tmp
+    done < <(regexes)
+    # Levels 1 and 2 loop through the roots; level 2 found more of them with -a
+  elif [[ $depth -eq 1 || $depth -eq 2 ]]; then
+    if ! python3 "$btrfs_restore" --jobs "$jobs" "${search[@]}" --roots "$roots" "$dev" "$regex" > "$tmp" 2> /dev/null; then
+      # No Python: one root at a time
+      > "$tmp"
+      while read -r i || [[ -n "$i" ]]; do
+        while read -r r; do
+          sudo btrfs restore -t "$i" -Divv --path-regex "^/$r\$" "$dev" / 2> /dev/null | grep -E "Restoring.*$recname" | cut -d" " -f 2- | selected &>> $tmp
+        done < <(regexes)
+      done < "$roots"
+    fi
   fi
 }
 
@@ -45,26 +147,75 @@ function checkresult(){
     if [[ ! -s $tmp ]]; then 
         echo "No results found"
     else 
-        echo -e "Successful dry run!\nDevice: $dev\nDepth: $depth\nRegex: $regex\n"
+        echo -e "Successful dry run!\nDevice: $dev\nDepth: $depth\nRegex: $requested\n"
         cat $tmp
     fi
 }
 
+# Restore root $1 (the current root if empty) into $dst
+function restoreroot(){
+  scratch=$(mktemp -d "$dst/.restore.XXXXXX")
+  while read -r r; do
+    sudo btrfs restore ${1:+-t "$1"} -ivv --path-regex "^/$r\$" "$dev" "$scratch" &> /dev/null
+  done < <(regexes)
+  if [[ $regex == @* ]]; then
+    # Only the listed paths, as for the dry run
+    sudo python3 "$path_regex" --from "${regex#@}" --prune "$scratch" &> /dev/null
+  fi
+  if ! sudo python3 "$content_store" ingest --manifest "$dst/recovery_manifest.jsonl" ${1:+--version "$1"} "$scratch" "$dst" &> /dev/null; then
+    # No Python: plain copy, names restored from newer roots win
+    cp -an "$scratch"/. "$dst"/
+  fi
+  rm -rf "$scratch"
+}
+
+function restoreroots(){
+  flags=()
+  if [[ $resume -eq 1 ]]; then
+    flags=(--resume)
+  fi
+  if sudo python3 "$btrfs_restore" --jobs "$jobs" --roots "$roots" --destination "$dst" \
+       --manifest "$dst/recovery_manifest.jsonl" --checkpoint "$checkpoint" "${flags[@]}" "${search[@]}" "$dev" "$regex" &> /dev/null; then
+    return
+  fi
+  # No Python: one root at a time
+  if [[ $resume -ne 1 ]]; then
+    > "$checkpoint"
+  fi
+  while read -r i || [[ -n "$i" ]]; do
+    if grep -qx "$i" "$checkpoint" 2> /dev/null; then
+      continue
+    fi
+    restoreroot "$i"
+    # A single short append per root: an interruption leaves every earlier line intact
+    echo "$i" >> "$checkpoint"
+  done < "$roots"
+}
+
 function recover(){
   if [[ $depth = "0" ]]; then
-    sudo btrfs restore -ivv --path-regex '^/'${regex}'$' "$dev" "$dst"  &> /dev/null &
+    keep_workspace=1
+    {
+      if [[ $regex == @* ]]; then
+        # Restored aside first, so the files the list didn't ask for can be dropped
+        restoreroot ""
+      else
+        while read -r r; do
+          sudo btrfs restore -ivv --path-regex "^/$r\$" "$dev" "$dst"  &> /dev/null
+        done < <(regexes)
+      fi
+      rm -rf "$workspace"
+    } &
     recoveredfiles=$(find "$dst" ! -empty -type f | wc -l)
   elif [[ $depth == "1" ]]; then
-    while read -r i || [[ -n "$i" ]]; do
-      sudo btrfs restore -t "$i" -ivv --path-regex '^/'${regex}'$' "$dev" "$dst" &> /dev/null
-    done < "$roots" &
+    keep_workspace=1
+    { restoreroots; rm -rf "$workspace"; } &
     # Find and delete empty files in $dst
     # so that we don't skip recovering a file on next iteration just because an empty version of the same file was recovered
     recoveredfiles=$(find "$dst" ! -empty -type f | wc -l)
   elif [[ $depth == "2" ]]; then
-    while read -r i || [[ -n "$i" ]]; do
-      sudo btrfs restore -t "$i" -ivv --path-regex '^/'${regex}'$' "$dev" "$dst" &> /dev/null
-    done < "$roots" &
+    keep_workspace=1
+    { restoreroots; rm -rf "$workspace"; } &
     recoveredfiles=$(find "$dst" ! -empty -type f | wc -l)
   fi
 }
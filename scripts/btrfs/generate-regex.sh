@@ -21,4 +21,4 @@ else
         regex+=")"
     done
 fi
-echo $regex
\ No newline at end of file
+echo "$regex"
\ No newline at end of file
@@ -3,7 +3,7 @@
 # Returns empty string if the device is not mounted, otherwise returns the mount point
 
 dev=$1
-mntfind="$(findmnt $dev)"
+mntfind="$(findmnt "$dev")"
 
 if [[ -z "$mntfind" ]]; then
     echo ""
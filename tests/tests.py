@@ -3,9 +3,225 @@
 # This file is just for unit testing (will be worked upon more in the future)
 # 
 
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 from unittest.mock import patch
 from recovery_operations import recover_btrfs, recover_xfs
+from image_reader import ImageReader, DirectReader
+import recover_xfs as xfs_recovery
+from recover_xfs import XFSFileRecovery, XFSSuperblock, XFS_SUPERBLOCK_OFFSET, XFS_SUPERBLOCK_SIZE
+from xfs_ag import iter_inode_chunks
+import xfs_batch
+import xfs_bmap
+from xfs_bmap import Extent
+from extent_copy import ExtentCopier, COPY_METHODS
+from manifest import read_manifest, RunManifest
+import scan_index
+from scan_index import ScanIndex
+import carver
+import freespace
+from read_scheduler import ReadScheduler, ReadRequest
+from integrity import PieceHasher
+from io_engine import IOEngine
+from freespace import IntervalSet
+from content_store import ContentStore
+import events
+from events import EventSink, EventBuffer, read_events, follow_events
+import xfs_dir
+import crc
+import btrfs
+import btrfs_roots
+import btrfs_restore
+import path_regex
+import xfs_crc
+from xfs_crc import CRCVerifier
+from xfs_dir import DirectoryIndex
+from benchmarks.xfs_image import generate_xfs_image, file_content
+
+# Geometry of the small XFS images built by make_xfs_image()
+BLOCKSIZE = 4096
+INODESIZE = 512
+AGBLOCKS = 64
+CHUNK_AGINO = 16  # First inode chunk sits at AG block 2 (8 inodes per block)
+
+def pack_bmbt(offset, start_block, block_count, unwritten=False):
+    """Pack one 128-bit bmbt extent record."""
+    l0 = (unwritten << 63) | (offset << 9) | (start_block >> 43)
+    l1 = ((start_block & ((1 << 43) - 1)) << 21) | block_count
+    return struct.pack(">QQ", l0, l1)
+
+def make_carving_samples():
+    """Return {extension: file content} for one small sample of each carvable type."""
+    import io
+    import tarfile
+    import zipfile
+
+    def png_chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + b"\0" * 4
+
+    def zipped(names):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            for name in names:
+                archive.writestr(name, b"zip member " + name.encode())
+        return buffer.getvalue()
+
+    tar_buffer = io.BytesIO()
+    with tarfile.open(fileobj=tar_buffer, mode="w", format=tarfile.USTAR_FORMAT) as archive:
+        info = tarfile.TarInfo("member.txt")
+        info.size = 700
+        archive.addfile(info, io.BytesIO(b"t" * 700))
+    # tarfile pads the archive to a whole record; carving stops at the end marker
+    tar_data = tar_buffer.getvalue()[:3 * 512 + 1024]
+
+    # An EXIF thumbnail's end-of-image marker sits inside the APP1 segment
+    thumbnail = b"Exif\0\0\xff\xd8\xff\xd9"
+    mp3_frame = struct.pack(">I", 0xfffb9000) + b"\0" * 413  # 128 kbit/s, 44.1 kHz
+    return {
+        "jpg": (b"\xff\xd8\xff\xe1" + struct.pack(">H", len(thumbnail) + 2) + thumbnail +
+                b"\xff\xda\x00\x04\x01\x00" + b"\x12\xff\x00\x34" * 10 + b"\xff\xd9"),
+        "png": (b"\x89PNG\r\n\x1a\n" + png_chunk(b"IHDR", b"\0" * 13) +
+                png_chunk(b"IDAT", b"pixels" * 5) + png_chunk(b"IEND", b"")),
+        "pdf": b"%PDF-1.4\n1 0 obj\n<<>>\nendobj\n%%EOF\nupdate\n%%EOF\n",
+        "zip": zipped(["a.txt", "b.txt"]),
+        "docx": zipped(["[Content_Types].xml", "word/document.xml"]),
+        "wav": b"RIFF" + struct.pack("<I", 4 + 8 + 16) + b"WAVEfmt " + struct.pack("<I", 16) + b"\1" * 16,
+        "mp3": b"ID3\x03\x00\x00\x00\x00\x00\x04" + b"tags" + mp3_frame * 3,
+        "mp4": (struct.pack(">I", 16) + b"ftypisom" + b"\0" * 4 + struct.pack(">I", 16) + b"moov" + b"m" * 8 +
+                struct.pack(">I", 24) + b"mdat" + b"d" * 16),
+        "tar": tar_data,
+    }
+
+def make_xfs_image(path, agcount=2, inodes=(), blocks=None, free=None):
+    """Write a minimal v4 XFS image with one inode chunk per AG.
+
+    `inodes` is a list of (agno, index, fields) where fields is a dict of
+    inode core values (nlink, size, format, mode) plus an optional raw
+    data "fork". `blocks` maps filesystem block numbers to their content.
+    `free` maps an AG number to its free (agbno, count) extents; AGs not
+    listed have no AGF.
+    """
+    image = bytearray(agcount * AGBLOCKS * BLOCKSIZE)
+    for agno in range(agcount):
+        ag = agno * AGBLOCKS * BLOCKSIZE
+        # Superblock (copied into every AG like mkfs does)
+        struct.pack_into(">IIQ", image, ag, 0x58465342, BLOCKSIZE, agcount * AGBLOCKS)
+        struct.pack_into(">Q", image, ag + 56, CHUNK_AGINO)  # Root directory: first inode of AG 0
+        struct.pack_into(">II", image, ag + 84, AGBLOCKS, agcount)
+        struct.pack_into(">HHHH", image, ag + 100, 4, 512, INODESIZE, BLOCKSIZE // INODESIZE)
+        struct.pack_into(">5B", image, ag + 120, 12, 9, 9, 3, 6)
+        struct.pack_into(">QQ", image, ag + 128, 64 * agcount, 64 * agcount)
+        # AGI pointing at a single-leaf inode btree in block 1
+        struct.pack_into(">IIIIIII", image, ag + 1024, 0x58414749, 1, agno, AGBLOCKS, 64, 1, 1)
+        struct.pack_into(">IHHII", image, ag + BLOCKSIZE, 0x49414254, 0, 1, 0xffffffff, 0xffffffff)
+        struct.pack_into(">IIQ", image, ag + BLOCKSIZE + 16, CHUNK_AGINO, 64, (1 << 64) - 1)
+        if free is not None and agno in free:
+            # AGF pointing at a single-leaf by-block free space btree in block 10
+            struct.pack_into(">IIIIIIII", image, ag + 512, 0x58414746, 1, agno, AGBLOCKS, 10, 11, 1, 1)
+            struct.pack_into(">IHHII", image, ag + 10 * BLOCKSIZE, 0x41425442, 0, len(free[agno]),
+                             0xffffffff, 0xffffffff)
+            for i, (agbno, count) in enumerate(free[agno]):
+                struct.pack_into(">II", image, ag + 10 * BLOCKSIZE + 16 + i * 8, agbno, count)
+
+    for agno, index, fields in inodes:
+        off = (agno * AGBLOCKS + 2) * BLOCKSIZE + index * INODESIZE
+        struct.pack_into(">HHBB", image, off, 0x494E, fields.get("mode", 0), 2, fields.get("format", 2))
+        struct.pack_into(">I", image, off + 16, fields.get("nlink", 0))
+        struct.pack_into(">I", image, off + 76, fields.get("nextents", 0))
+        struct.pack_into(">Q", image, off + 56, fields.get("size", 0))
+        fork = fields.get("fork", b"")
+        image[off + 100:off + 100 + len(fork)] = fork
+
+    for fsbno, data in (blocks or {}).items():
+        # agblklog is 6 and agblocks is a power of two, so fsbno maps linearly
+        image[fsbno * BLOCKSIZE:fsbno * BLOCKSIZE + len(data)] = data
+
+    with open(path, "wb") as f:
+        f.write(image)
+
+def make_dir_block(entries, removed=()):
+    """Return a v4 block-form directory block.
+
+    `entries` are live (ino, name) pairs; `removed` are (ino, name) pairs
+    written and then freed the way XFS removes an entry.
+    """
+    block = bytearray(BLOCKSIZE)
+    struct.pack_into(">I", block, 0, 0x58443242)  # "XD2B"
+    p = 16
+    for (ino, name), live in [(entry, True) for entry in entries] + [(entry, False) for entry in removed]:
+        size = (8 + 1 + len(name) + 2 + 7) & ~7
+        struct.pack_into(">QB", block, p, ino, len(name))
+        block[p + 9:p + 9 + len(name)] = name
+        struct.pack_into(">H", block, p + size - 2, p)
+        if not live:
+            struct.pack_into(">HH", block, p, 0xffff, size)
+        p += size
+    # The rest of the data area is free, followed by the leaf and the tail
+    count = len(entries) + len(removed)
+    end = BLOCKSIZE - 8 - count * 8
+    struct.pack_into(">HH", block, p, 0xffff, end - p)
+    struct.pack_into(">H", block, end - 2, p)
+    struct.pack_into(">II", block, BLOCKSIZE - 8, count, len(removed))
+    return bytes(block)
+
+BTRFS_MiB = 1024 * 1024
+BTRFS_FSID = b"F" * 16
+
+def make_btrfs_leaf(bytenr, owner, items, nodesize=4096, generation=1, level=0):
+    """Build a btrfs leaf holding (objectid, type, offset, data) items."""
+    node = bytearray(nodesize)
+    node[32:48] = BTRFS_FSID
+    struct.pack_into("<Q", node, 48, bytenr)
+    struct.pack_into("<QQIB", node, 80, generation, owner, len(items), level)
+    data_end = nodesize - 101
+    for i, (objectid, item_type, offset, data) in enumerate(items):
+        data_end -= len(data)
+        struct.pack_into("<QBQII", node, 101 + i * 25, objectid, item_type, offset, data_end, len(data))
+        node[101 + data_end:101 + data_end + len(data)] = data
+    return bytes(node)
+
+def make_btrfs_image(path, data_extents=(), size=8 * BTRFS_MiB):
+    """Write a minimal single-device btrfs image.
+
+    One chunk maps logical to physical 1:1 from 1 MiB to the end of the
+    device. The chunk, root and extent tree leaves sit in its first three
+    blocks; `data_extents` are (logical, length) EXTENT_ITEMs.
+    """
+    chunk_root, root, extent_root = BTRFS_MiB, BTRFS_MiB + 4096, BTRFS_MiB + 8192
+    chunk = struct.pack("<QQQQIIIHH", size - BTRFS_MiB, 2, 65536, 7, 4096, 4096, 4096, 1, 0)
+    chunk += struct.pack("<QQ16s", 1, BTRFS_MiB, bytes(16))
+    root_item = bytearray(439)
+    struct.pack_into("<Q", root_item, 176, extent_root)
+
+    image = bytearray(size)
+    sb = 0x10000
+    image[sb + 0x20:sb + 0x30] = BTRFS_FSID
+    struct.pack_into("<Q", image, sb + 0x30, sb)
+    image[sb + 0x40:sb + 0x48] = b"_BHRfS_M"
+    struct.pack_into("<QQQ", image, sb + 0x48, 1, root, chunk_root)
+    struct.pack_into("<QQ", image, sb + 0x70, size, 3 * 4096)
+    struct.pack_into("<II", image, sb + 0x90, 4096, 4096)
+    struct.pack_into("<I", image, sb + 0xA0, 17 + len(chunk))
+    struct.pack_into("<Q", image, sb + 0xC9, 1)
+    image[sb + 0x32B:sb + 0x32B + 17 + len(chunk)] = struct.pack("<QBQ", 256, 228, BTRFS_MiB) + chunk
+
+    image[chunk_root:chunk_root + 4096] = make_btrfs_leaf(chunk_root, 3, [(256, 228, BTRFS_MiB, chunk)])
+    image[root:root + 4096] = make_btrfs_leaf(root, 1, [(2, 132, 0, bytes(root_item))])
+    extents = [(block, 169, 0, bytes(33)) for block in (chunk_root, root, extent_root)]
+    extents += [(logical, 168, length, bytes(24)) for logical, length in data_extents]
+    image[extent_root:extent_root + 4096] = make_btrfs_leaf(extent_root, 2, sorted(extents))
+    with open(path, "wb") as f:
+        f.write(image)
 
 class TestRecoveryOperations(unittest.TestCase):
 
@@ -21,5 +237,1173 @@ class TestRecoveryOperations(unittest.TestCase):
         result = recover_xfs("/dev/sda1")
         self.assertEqual(result, "XFS recovery successful")
 
+class TestImageReader(unittest.TestCase):
+
+    def setUp(self):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(bytes(range(256)) * 64)
+        self.path = f.name
+        self.addCleanup(os.unlink, self.path)
+
+    def test_view_is_zero_copy_slice(self):
+        with ImageReader(self.path) as reader:
+            self.assertEqual(reader.size, 256 * 64)
+            view = reader.view(250, 10)
+            self.assertIsInstance(view, memoryview)
+            self.assertEqual(bytes(view), bytes([250, 251, 252, 253, 254, 255, 0, 1, 2, 3]))
+            # Reads past the end of the image are truncated
+            self.assertEqual(len(reader.view(reader.size - 4, 100)), 4)
+            view.release()
+
+    def test_buffered_fallback(self):
+        reader = ImageReader(self.path, buffer_size=128)
+        with patch('mmap.mmap', side_effect=OSError):
+            reader.open()
+        try:
+            self.assertEqual(reader.read(300, 4), bytes([44, 45, 46, 47]))
+            self.assertEqual(reader.read(1000, 500), (bytes(range(256)) * 64)[1000:1500])
+        finally:
+            reader.close()
+
+    def test_direct_reader_aligns_reads(self):
+        data = bytes(range(256)) * 64
+        for direct in (True, False):
+            with DirectReader(self.path, io_size=4096, buffer_size=8192) as reader:
+                if not direct:
+                    # Filesystems refusing O_DIRECT: buffered reads that drop their pages
+                    os.close(reader.direct_fd)
+                    reader.direct_fd = None
+                with patch('os.posix_fadvise') as fadvise:
+                    self.assertEqual(reader.read(5000, 100), data[5000:5100])
+                    self.assertEqual(reader.read(4100, 10000), data[4100:14100])  # Larger than the window
+                    self.assertEqual(reader.read(reader.size - 10, 100), data[-10:])
+                self.assertEqual(fadvise.called, not direct)
+
+class TestXFSInodeDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+
+    def test_scan_finds_inodes_in_every_ag(self):
+        make_xfs_image(self.path, agcount=3, inodes=[
+            (0, 1, {"nlink": 1, "size": 10, "mode": 0o100644}),
+            (2, 5, {"nlink": 0, "size": 20}),
+        ])
+        recovery = XFSFileRecovery(self.path)
+        recovery.open_image()
+        try:
+            recovery.read_superblock()
+            found = {}
+            for agno in range(recovery.superblock.agcount):
+                for ino, inode, _ in recovery.scan_ag(agno):
+                    found[ino] = inode
+        finally:
+            recovery.close_image()
+
+        # ino = agno << (agblklog + inopblog) | agino
+        self.assertEqual(sorted(found), [CHUNK_AGINO + 1, (2 << 9) | (CHUNK_AGINO + 5)])
+        self.assertFalse(found[CHUNK_AGINO + 1].is_deleted())
+        self.assertTrue(found[(2 << 9) | (CHUNK_AGINO + 5)].is_deleted())
+
+    def test_parallel_scan_matches_serial_order(self):
+        make_xfs_image(self.path, agcount=4, inodes=[
+            (agno, index, {"nlink": 0, "size": 1}) for agno in (3, 0, 2) for index in (7, 2)
+        ])
+        results = []
+        for workers, queue_depth in ((1, 1), (3, 1), (1, 8), (2, 4)):
+            recovery = XFSFileRecovery(self.path, workers=workers, queue_depth=queue_depth)
+            recovery.open_image()
+            try:
+                recovery.read_superblock()
+                results.append([ino for ino, _, _ in recovery.iter_candidates()])
+            finally:
+                recovery.close_image()
+
+        for result in results[1:]:
+            self.assertEqual(result, results[0])
+        self.assertEqual(results[0], sorted(results[0]))
+        self.assertEqual(len(results[0]), 6)
+
+    def test_scan_workers_hand_back_crc_failures(self):
+        make_xfs_image(self.path, agcount=2, inodes=[(1, 3, {"nlink": 0, "size": 1})])
+        xfs_recovery._init_scan_worker(self.path)
+        self.addCleanup(xfs_recovery._worker_recovery.close_image)
+        # A v4 image has no CRCs: one failure is made up
+        verifier = xfs_recovery._worker_recovery.verifier
+        verifier.enabled = True
+        self.assertTrue(verifier.check(bytes(512), 312, "agi", agno=1))
+        verifier.enabled = False
+        candidates, _, failures, records = xfs_recovery._find_candidates_in_ag(1)
+        self.assertEqual(len(candidates), 1)
+        self.assertEqual(failures, {"agi": 1})
+        self.assertEqual([record[0] for record in records], ["crc_mismatch"])
+        # Handed back once: the next AG starts from nothing
+        self.assertEqual(xfs_recovery._find_candidates_in_ag(0)[2:], ({}, []))
+
+        sink = EventSink(io.StringIO(), console_level=events.ERROR).open()
+        EventBuffer.replay(records, sink)
+        sink.flush()
+        self.assertEqual(sink.counts["crc_mismatch"], 1)
+        self.assertEqual(json.loads(sink.file.getvalue())["kind"], "agi")
+
+class TestInodeBatchDecoding(unittest.TestCase):
+
+    def make_chunk(self):
+        chunk = bytearray(64 * INODESIZE)
+        # (index, version, format, nlink, size)
+        for index, version, fmt, nlink, size in [(0, 3, 2, 0, 100), (1, 3, 2, 2, 100),
+                                                 (5, 3, 1, 0, 100), (9, 1, 2, 0, 5000),
+                                                 (40, 3, 3, 0, 7)]:
+            off = index * INODESIZE
+            struct.pack_into(">HHBB", chunk, off, 0x494E, 0, version, fmt)
+            if version == 1:
+                struct.pack_into(">H", chunk, off + 6, nlink)
+            else:
+                struct.pack_into(">I", chunk, off + 16, nlink)
+            struct.pack_into(">Q", chunk, off + 56, size)
+        return bytes(chunk)
+
+    def check(self, chunk):
+        self.assertEqual(xfs_batch.candidate_indexes(chunk, INODESIZE), [0, 9])
+        self.assertEqual(xfs_batch.candidate_indexes(chunk, INODESIZE, formats=(2, 3)), [0, 9, 40])
+        self.assertEqual(xfs_batch.candidate_indexes(chunk, INODESIZE, max_size=1000), [0])
+        # Holemask bit 2 covers inodes 8-11
+        self.assertEqual(xfs_batch.candidate_indexes(chunk, INODESIZE, holemask=0b100), [0])
+
+    def make_filter_chunk(self):
+        chunk = bytearray(64 * INODESIZE)
+        # (index, version, uid, ctime, bigtime, extent records left in the fork)
+        for index, version, uid, ctime, bigtime, extents in [(0, 2, 1000, 5000, False, 1), (1, 2, 0, 5000, False, 3),
+                                                             (2, 3, 1000, 9000, True, 2), (3, 2, 1000, 100, False, 4)]:
+            off = index * INODESIZE
+            struct.pack_into(">HHBBHII", chunk, off, 0x494E, 0, version, 2, 0, uid, 0)
+            if bigtime:
+                struct.pack_into(">QQ", chunk, off + 48, (ctime + (1 << 31)) * 10 ** 9, 0)
+                struct.pack_into(">Q", chunk, off + 120, xfs_batch.XFS_DIFLAG2_BIGTIME)
+            else:
+                struct.pack_into(">i", chunk, off + 48, ctime)
+            core = 176 if version == 3 else 100
+            for i in range(extents):
+                chunk[off + core + 16 * i:off + core + 16 * (i + 1)] = pack_bmbt(i, 20 + i, 1)
+        return bytes(chunk)
+
+    def check_filters(self, chunk):
+        def selected(**bounds):
+            return xfs_batch.candidate_indexes(chunk, INODESIZE, inode_filter=xfs_batch.InodeFilter(**bounds))
+        self.assertEqual(selected(), [0, 1, 2, 3])
+        self.assertEqual(selected(uids=[1000]), [0, 2, 3])
+        self.assertEqual(selected(uids=[1000], ctime_after=1000), [0, 2])
+        self.assertEqual(selected(ctime_after=6000), [2])  # 64-bit nanosecond timestamp
+        self.assertEqual(selected(min_extents=2, max_extents=3), [1, 2])
+        self.assertEqual(selected(mode=0o100000, mode_mask=0o170000), [])  # XFS clears the mode of freed inodes
+
+    def test_vectorised(self):
+        if xfs_batch.np is None:
+            self.skipTest("numpy not installed")
+        self.check(self.make_chunk())
+        self.check_filters(self.make_filter_chunk())
+
+    def test_fallback_matches(self):
+        with patch.object(xfs_batch, 'np', None):
+            self.check(self.make_chunk())
+            self.check_filters(self.make_filter_chunk())
+
+class TestExtentMap(unittest.TestCase):
+
+    def test_decode_packed_records(self):
+        data = pack_bmbt(0, 70, 3) + pack_bmbt(3, (1 << 52) - 1, (1 << 21) - 1, unwritten=True)
+        expected = [Extent(0, 70, 3, False), Extent(3, (1 << 52) - 1, (1 << 21) - 1, True)]
+        self.assertEqual(xfs_bmap.decode_extents(data, 2), expected)
+        with patch.object(xfs_bmap, 'np', None):
+            self.assertEqual(xfs_bmap.decode_extents(data, 2), expected)
+
+    def test_merge_adjacent(self):
+        merged = xfs_bmap.merge_extents([Extent(2, 12, 2, False), Extent(0, 10, 2, False),
+                                         Extent(4, 20, 1, False), Extent(5, 21, 1, True)])
+        self.assertEqual(merged, [Extent(0, 10, 4, False), Extent(4, 20, 1, False), Extent(5, 21, 1, True)])
+
+    def recover(self, path, inode_fields, blocks):
+        make_xfs_image(path, agcount=2, inodes=[(1, 0, inode_fields)], blocks=blocks)
+        recovery = XFSFileRecovery(path)
+        recovery.open_image()
+        try:
+            recovery.read_superblock()
+            (ino, inode, inode_data), = recovery.iter_candidates()
+            return recovery.extract_extents(inode, inode_data)
+        finally:
+            recovery.close_image()
+
+    def test_freed_extent_inode(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        # Extent count was zeroed on free, the records are still there
+        fork = pack_bmbt(0, 20, 2) + pack_bmbt(2, 22, 1) + pack_bmbt(5, (1 << 6) | 3, 1)
+        extents = self.recover(path, {"format": 2, "fork": fork}, {})
+        self.assertEqual(extents, [Extent(0, 20, 3, False), Extent(5, 67, 1, False)])
+
+    def test_btree_format_inode(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        # Root in the inode: level 1, one pointer to a leaf at fsb 40
+        maxrecs = (INODESIZE - 100 - 4) // 16
+        fork = bytearray(INODESIZE - 100)
+        struct.pack_into(">HHQ", fork, 0, 1, 1, 0)
+        struct.pack_into(">Q", fork, 4 + maxrecs * 8, 40)
+        leaf = bytearray(BLOCKSIZE)
+        struct.pack_into(">IHHQQ", leaf, 0, 0x424D4150, 0, 3, (1 << 64) - 1, (1 << 64) - 1)
+        leaf[24:72] = pack_bmbt(0, 50, 4) + pack_bmbt(4, 54, 4) + pack_bmbt(100, 60, 1)
+        extents = self.recover(path, {"format": 3, "fork": bytes(fork)}, {40: bytes(leaf)})
+        self.assertEqual(extents, [Extent(0, 50, 8, False), Extent(100, 60, 1, False)])
+
+class TestExtentCopier(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.src = os.path.join(self.dir.name, "src")
+        with open(self.src, "wb") as f:
+            f.write(os.urandom(3 * BLOCKSIZE))
+
+    def test_every_method_copies_ranges_in_place(self):
+        with open(self.src, "rb") as f:
+            source = f.read()
+        for method in COPY_METHODS:
+            if method != "preadv" and not hasattr(os, method):
+                continue
+            dst = os.path.join(self.dir.name, method)
+            copier = ExtentCopier(buffer_size=1000, method=method)
+            src_fd = os.open(self.src, os.O_RDONLY)
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT)
+            try:
+                self.assertEqual(copier.copy(src_fd, BLOCKSIZE, dst_fd, 2 * BLOCKSIZE, BLOCKSIZE), BLOCKSIZE)
+                copier.copy(src_fd, 0, dst_fd, 0, 10)
+                os.ftruncate(dst_fd, 4 * BLOCKSIZE)
+            finally:
+                os.close(src_fd)
+                os.close(dst_fd)
+            with open(dst, "rb") as f:
+                data = f.read()
+            self.assertEqual(len(data), 4 * BLOCKSIZE)
+            self.assertEqual(data[:10], source[:10])
+            self.assertEqual(data[10:2 * BLOCKSIZE], bytes(2 * BLOCKSIZE - 10))
+            self.assertEqual(data[2 * BLOCKSIZE:3 * BLOCKSIZE], source[BLOCKSIZE:2 * BLOCKSIZE])
+
+    def test_falls_back_when_unsupported(self):
+        copier = ExtentCopier()
+        src_fd = os.open(self.src, os.O_RDONLY)
+        dst_fd = os.open(os.path.join(self.dir.name, "out"), os.O_WRONLY | os.O_CREAT)
+        try:
+            with patch('os.copy_file_range', side_effect=OSError(18, "EXDEV"), create=True), \
+                 patch('os.sendfile', side_effect=OSError(22, "EINVAL")):
+                self.assertEqual(copier.copy(src_fd, 0, dst_fd, 0, 100), 100)
+            self.assertEqual(copier.method, "preadv")
+        finally:
+            os.close(src_fd)
+            os.close(dst_fd)
+
+class TestStreamingIntegrity(unittest.TestCase):
+
+    def test_manifest_digest_matches_output(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(workdir.name)
+
+        fork = pack_bmbt(0, 20, 1) + pack_bmbt(3, 21, 2) + pack_bmbt(5, 23, 1, unwritten=True)
+        make_xfs_image("image", inodes=[(1, 2, {"fork": fork, "size": 5 * BLOCKSIZE + 100})],
+                       blocks={20: b"A" * BLOCKSIZE, 21: b"B" * 10, 22: b"C" * BLOCKSIZE})
+        for algorithm in ("sha256", "md5"):
+            XFSFileRecovery("image", hash_algorithm=algorithm, manifest_path=algorithm + ".jsonl").run()
+
+            (record,) = read_manifest(algorithm + ".jsonl")
+            with open(record["path"], "rb") as f:
+                content = f.read()
+            self.assertEqual(len(content), 5 * BLOCKSIZE + 100)
+            self.assertEqual(content[3 * BLOCKSIZE:3 * BLOCKSIZE + 10], b"B" * 10)
+            self.assertEqual(record["digest"], hashlib.new(algorithm, content).hexdigest())
+            self.assertEqual(record["ino"], (1 << 9) | (CHUNK_AGINO + 2))
+
+class TestIOEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(100000)
+        fd, path = tempfile.mkstemp()
+        os.write(fd, self.data)
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        self.fd = os.open(path, os.O_RDONLY)
+        self.addCleanup(os.close, self.fd)
+        self.requests = [(offset, 3000, offset) for offset in range(0, 100000, 2500)]
+
+    def test_ordered_and_unordered_reads(self):
+        for alignment in (1, 4096):
+            with IOEngine(self.fd, depth=4, buffer_size=4096, alignment=alignment) as engine:
+                ordered = [(request[0], bytes(data)) for request, data in engine.reads(self.requests)]
+                unordered = {request[0]: bytes(data) for request, data in engine.reads(self.requests, ordered=False)}
+            expected = [(offset, self.data[offset:offset + 3000]) for offset, _, _ in self.requests]
+            self.assertEqual(ordered, expected)
+            self.assertEqual(unordered, dict(expected))
+
+    def test_abandoned_reads_return_their_buffers(self):
+        with IOEngine(self.fd, depth=3, buffer_size=4096) as engine:
+            for _ in engine.reads(self.requests):
+                break
+            self.assertEqual(engine._free.qsize(), 3)
+            with self.assertRaises(ValueError):
+                list(engine.reads([(0, 5000)]))
+
+class TestReadScheduler(unittest.TestCase):
+
+    def setUp(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.dir = workdir.name
+
+    def test_coalesces_sorted_ranges(self):
+        scheduler = ReadScheduler(-1, max_gap=10, max_read=100)
+        scheduler.add(200, 10, "b", 0)
+        scheduler.add(0, 20, "a", 0)
+        scheduler.add(25, 20, "a", 20)
+        scheduler.add(30, 5, "b", 10)
+        scheduler.add(60, 50, "c", 0)
+        self.assertEqual([(offset, length, [r.path for r in batch]) for offset, length, batch in scheduler.batches()],
+                         [(0, 45, ["a", "a", "b"]), (60, 50, ["c"]), (200, 10, ["b"])])
+
+    def test_sorted_reads_match_inline_recovery(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.dir)
+        inodes = [(0, 1, {"fork": pack_bmbt(0, 22, 1) + pack_bmbt(1, 20, 1), "size": 2 * BLOCKSIZE - 7}),
+                  (0, 2, {"fork": pack_bmbt(0, 21, 1) + pack_bmbt(3, 23, 1), "size": 4 * BLOCKSIZE})]
+        blocks = {20 + i: bytes([65 + i]) * BLOCKSIZE for i in range(4)}
+        make_xfs_image("image", inodes=inodes, blocks=blocks)
+
+        XFSFileRecovery("image", hash_algorithm="sha256", manifest_path="inline.jsonl").run()
+        inline = {r["ino"]: r["digest"] for r in read_manifest("inline.jsonl")}
+        # Hashed from the pieces as they are written, even those of inode 17 that arrive back to front
+        no_read_back = patch("output_pipeline.hash_file", side_effect=AssertionError("file read back"))
+        with patch.object(ReadScheduler, 'run', autospec=True, side_effect=ReadScheduler.run) as run, no_read_back:
+            XFSFileRecovery("image", hash_algorithm="sha256", manifest_path="sorted.jsonl", sorted_reads=True).run()
+        scheduler = run.call_args.args[0]
+        self.assertEqual(scheduler.reads, 1)
+        self.assertEqual({r["ino"]: r["digest"] for r in read_manifest("sorted.jsonl")}, inline)
+        with open("recovered_file_18.dat", "rb") as f:
+            self.assertEqual(f.read(), b"B" * BLOCKSIZE + bytes(2 * BLOCKSIZE) + b"D" * BLOCKSIZE)
+
+        XFSFileRecovery("image", hash_algorithm="sha256", manifest_path="direct.jsonl", direct_io=True).run()
+        self.assertEqual({r["ino"]: r["digest"] for r in read_manifest("direct.jsonl")}, inline)
+
+        with no_read_back:
+            XFSFileRecovery("image", hash_algorithm="sha256", manifest_path="queued.jsonl", sorted_reads=True,
+                            direct_io=True, queue_depth=4).run()
+        self.assertEqual({r["ino"]: r["digest"] for r in read_manifest("queued.jsonl")}, inline)
+
+    def test_piece_hasher_hashes_out_of_order_pieces(self):
+        # "a" is written back to front with a hole in the middle, "b" front to back
+        requests = [ReadRequest(0, 4, "a", 8), ReadRequest(10, 4, "a", 0), ReadRequest(20, 3, "b", 0)]
+        pieces = {(0, "a"): b"CCCC", (10, "a"): b"AAAA", (20, "b"): b"xyz"}
+        expected = {"a": hashlib.sha256(b"AAAA" + bytes(4) + b"CCCC" + bytes(2)).hexdigest(),
+                    "b": hashlib.sha256(b"xyz").hexdigest()}
+        for max_pending, digests in ((64, expected), (0, dict(expected, a=None))):
+            hasher = PieceHasher("sha256", max_pending)
+            hasher.expect(requests)
+            for request in requests:
+                hasher.update(request.path, request.dst_offset, pieces[request.src_offset, request.path])
+            # Past the cap, "a" is left to be read back
+            self.assertEqual({path: hasher.hexdigest(path, size) for path, size in (("a", 14), ("b", 3))}, digests)
+            self.assertEqual(hasher.pending_bytes, 0)
+
+class TestContentStore(unittest.TestCase):
+
+    def setUp(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.dir = workdir.name
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.dir)
+
+    def test_identical_inodes_are_stored_once(self):
+        inodes = [(0, 1, {"fork": pack_bmbt(0, 20, 1), "size": BLOCKSIZE}),
+                  (0, 2, {"fork": pack_bmbt(0, 21, 1), "size": BLOCKSIZE}),
+                  (0, 3, {"fork": pack_bmbt(0, 22, 1), "size": BLOCKSIZE})]
+        make_xfs_image("image", inodes=inodes, blocks={20: b"a" * BLOCKSIZE, 21: b"a" * BLOCKSIZE,
+                                                       22: b"b" * BLOCKSIZE})
+        for _ in range(2):  # A second run must not truncate the blobs its names link to
+            XFSFileRecovery("image", hash_algorithm="sha256", manifest_path="manifest.jsonl", store_path="blobs",
+                            sorted_reads=True).run()
+
+        records = read_manifest("manifest.jsonl")[3:]
+        self.assertEqual(len({r["blob"] for r in records}), 2)
+        self.assertEqual(sum(len(files) for _, _, files in os.walk("blobs")), 2)
+        for record in records:
+            with open(record["path"], "rb") as f:
+                self.assertEqual(hashlib.sha256(f.read()).hexdigest(), record["digest"])
+            self.assertTrue(os.path.samefile(record["path"], record["blob"]))
+        self.assertEqual(os.stat("recovered_file_17.dat").st_nlink, 3)  # Blob and both names
+
+    def test_ingest_keeps_newest_name_and_every_version(self):
+        for root, files in (("300", {"a/notes.txt": b"new", "b.txt": b"same"}),
+                            ("200", {"a/notes.txt": b"old", "c.txt": b"same"})):
+            scratch = os.path.join(self.dir, "scratch" + root)
+            for name, content in files.items():
+                os.makedirs(os.path.dirname(os.path.join(scratch, name)), exist_ok=True)
+                with open(os.path.join(scratch, name), "wb") as f:
+                    f.write(content)
+            with RunManifest("manifest.jsonl") as manifest:
+                ContentStore("out/blobs").ingest(scratch, "out", "sha256", manifest, version=root)
+
+        with open("out/a/notes.txt", "rb") as f:
+            self.assertEqual(f.read(), b"new")
+        self.assertTrue(os.path.samefile("out/b.txt", "out/c.txt"))
+        records = read_manifest("manifest.jsonl")
+        self.assertEqual([(r["version"], r["linked"]) for r in records if r["path"].endswith("notes.txt")],
+                         [("300", True), ("200", False)])
+        self.assertEqual(sum(len(files) for _, _, files in os.walk("out/blobs")), 3)
+
+class TestScanIndex(unittest.TestCase):
+
+    def setUp(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.dir = workdir.name
+
+    def test_unchanged_ags_come_from_the_index(self):
+        image = os.path.join(self.dir, "image")
+        index = os.path.join(self.dir, "index.sqlite")
+        make_xfs_image(image, agcount=3, inodes=[(agno, 1, {"fork": pack_bmbt(0, 20, 1)}) for agno in range(3)])
+
+        def candidates():
+            recovery = XFSFileRecovery(image)
+            recovery.open_image()
+            recovery.index = ScanIndex(index).open()
+            try:
+                recovery.read_superblock()
+                with patch.object(recovery, 'find_candidates', wraps=recovery.find_candidates) as scan:
+                    inos = [ino for ino, _, _ in recovery.iter_candidates()]
+                return inos, [call.args[0] for call in scan.call_args_list]
+            finally:
+                recovery.index.close()
+                recovery.close_image()
+
+        first, scanned = candidates()
+        self.assertEqual(scanned, [0, 1, 2])
+
+        # Touch AG 1's AGI: only that AG is rescanned
+        with open(image, "r+b") as f:
+            f.seek(AGBLOCKS * BLOCKSIZE + 1024 + 28)
+            f.write(struct.pack(">I", 5))
+        second, scanned = candidates()
+        self.assertEqual(scanned, [1])
+        self.assertEqual(first, second)
+
+        with ScanIndex(index) as db:
+            (_, _, _, extents), = [c for c in db.xfs_candidates(bytes(16)) if c[0] == first[0]]
+        self.assertEqual(extents, [[0, 20, 1, False]])
+
+    def test_btrfs_roots_cached_by_generation(self):
+        device = os.path.join(self.dir, "btrfs")
+        superblock = bytearray(0x10000 + 4096)
+        superblock[0x10020:0x10030] = b"F" * 16
+        superblock[0x10040:0x10048] = b"_BHRfS_M"
+        struct.pack_into("<Q", superblock, 0x10048, 7)
+        with open(device, "wb") as f:
+            f.write(superblock)
+
+        with ScanIndex(os.path.join(self.dir, "index.sqlite")) as index, \
+             patch.object(scan_index, 'run_btrfs_find_root', return_value=[300, 200]) as find_root:
+            self.assertEqual(scan_index.cached_btrfs_roots(index, device, 1), [300, 200])
+            self.assertEqual(scan_index.cached_btrfs_roots(index, device, 0), [300, 200])
+            self.assertEqual(find_root.call_count, 1)
+            scan_index.cached_btrfs_roots(index, device, 2)
+            self.assertEqual(find_root.call_count, 2)
+
+class TestFreeSpace(unittest.TestCase):
+
+    def setUp(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.dir = workdir.name
+
+    def test_interval_set(self):
+        intervals = IntervalSet([(50, 60), (0, 10), (10, 20), (40, 45)])
+        self.assertEqual(list(intervals), [(0, 20), (40, 45), (50, 60)])
+        self.assertEqual(intervals.total(), 35)
+        self.assertIn(44, intervals)
+        self.assertNotIn(45, intervals)
+        self.assertEqual(list(intervals.overlap(15, 55)), [(15, 20), (40, 45), (50, 55)])
+        self.assertTrue(intervals.covers(41, 45))
+        self.assertFalse(intervals.covers(18, 41))
+        self.assertEqual(list(intervals.complement(5, 70)), [(20, 40), (45, 50), (60, 70)])
+        self.assertEqual(list(intervals.difference(IntervalSet([(5, 42)]))), [(0, 5), (42, 45), (50, 60)])
+
+    def test_xfs_free_space_from_bnobt(self):
+        image = os.path.join(self.dir, "xfs")
+        make_xfs_image(image, free={0: [(20, 4), (30, 10)], 1: [(40, 24)]})
+        with ImageReader(image) as reader:
+            free = freespace.free_space(reader)
+        self.assertEqual(list(free), [(20 * BLOCKSIZE, 24 * BLOCKSIZE), (30 * BLOCKSIZE, 40 * BLOCKSIZE),
+                                      (104 * BLOCKSIZE, 128 * BLOCKSIZE)])
+
+    def test_damaged_ag_headers_are_reported_as_events(self):
+        image = os.path.join(self.dir, "xfs")
+        # AG 1 has no AGF, and its AGI magic is wiped
+        make_xfs_image(image, free={0: [(20, 4)]})
+        with open(image, "r+b") as f:
+            f.seek(AGBLOCKS * BLOCKSIZE + 1024)
+            f.write(bytes(4))
+        sink = EventSink(io.StringIO(), console_level=events.ERROR).open()
+        with ImageReader(image) as reader, patch("sys.stdout", new=io.StringIO()) as out:
+            free = freespace.free_space(reader, sink)
+            sb = XFSSuperblock(reader.view(XFS_SUPERBLOCK_OFFSET, XFS_SUPERBLOCK_SIZE))
+            self.assertEqual(list(iter_inode_chunks(reader, sb, 1, events=sink)), [])
+        sink.flush()
+        # The AG without an AGF counts as free as a whole
+        self.assertEqual(list(free), [(20 * BLOCKSIZE, 24 * BLOCKSIZE),
+                                      (AGBLOCKS * BLOCKSIZE, 2 * AGBLOCKS * BLOCKSIZE)])
+        self.assertEqual(out.getvalue(), "")
+        records = [json.loads(line) for line in sink.file.getvalue().splitlines()]
+        self.assertEqual([(record["event"], record["level"], record["agno"]) for record in records],
+                         [("bad_agf", "warning", 1), ("bad_agi", "warning", 1)])
+
+    def test_damaged_last_ag_ends_with_the_filesystem(self):
+        image = os.path.join(self.dir, "xfs")
+        # AG 1, without an AGF, only has 40 blocks
+        make_xfs_image(image, free={0: [(20, 4)]})
+        dblocks = AGBLOCKS + 40
+        with open(image, "r+b") as f:
+            f.seek(8)
+            f.write(struct.pack(">Q", dblocks))
+            f.truncate(dblocks * BLOCKSIZE)
+        with ImageReader(image) as reader:
+            free = freespace.free_space(reader)
+        self.assertEqual(list(free), [(20 * BLOCKSIZE, 24 * BLOCKSIZE), (AGBLOCKS * BLOCKSIZE, dblocks * BLOCKSIZE)])
+
+    def test_reallocated_blocks_are_not_recovered(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.dir)
+        # Blocks 20 and 22 are still free, block 21 was reused
+        make_xfs_image("image", inodes=[(0, 1, {"fork": pack_bmbt(0, 20, 3), "size": 3 * BLOCKSIZE})],
+                       blocks={20: b"A" * BLOCKSIZE, 21: b"X" * BLOCKSIZE, 22: b"C" * BLOCKSIZE},
+                       free={0: [(20, 1), (22, 1)], 1: []})
+        XFSFileRecovery("image", hash_algorithm=None).run()
+        with open("recovered_file_17.dat", "rb") as f:
+            self.assertEqual(f.read(), b"A" * BLOCKSIZE + bytes(BLOCKSIZE) + b"C" * BLOCKSIZE)
+
+    def test_btrfs_free_space_from_extent_tree(self):
+        image = os.path.join(self.dir, "btrfs")
+        make_btrfs_image(image, data_extents=[(2 * BTRFS_MiB, BTRFS_MiB)])
+        with ImageReader(image) as reader:
+            free = freespace.free_space(reader)
+        self.assertEqual(list(free), [(BTRFS_MiB + 3 * 4096, 2 * BTRFS_MiB), (3 * BTRFS_MiB, 8 * BTRFS_MiB)])
+
+class TestBtrfsRoots(unittest.TestCase):
+
+    def setUp(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.image = os.path.join(workdir.name, "btrfs")
+        make_btrfs_image(self.image)
+        nodes = {4: (1, 4, 0), 5: (1, 7, 0), 6: (1, 7, 1), 7: (1, 9, 0),
+                 8: (2, 8, 0),  # Another tree's block
+                 9: (1, 8, 0)}  # Checksum broken below
+        with open(self.image, "r+b") as f:
+            f.seek(0x10048)
+            f.write(struct.pack("<Q", 10))
+            for block, (owner, generation, level) in nodes.items():
+                bytenr = BTRFS_MiB + block * 4096
+                # Generations 7 and 9 left the filesystem tree alone
+                fs_root = bytearray(439)
+                struct.pack_into("<Q", fs_root, 176, 1000 if generation in (7, 9) else 2000 + generation)
+                node = bytearray(make_btrfs_leaf(bytenr, owner, [(2, 132, 0, bytes(439)), (5, 132, 0, bytes(fs_root))],
+                                                 generation=generation, level=level))
+                struct.pack_into("<I", node, 0, crc.crc32c(node[32:]) ^ (block == 9))
+                f.seek(bytenr)
+                f.write(node)
+
+    def find(self, **kwargs):
+        with ImageReader(self.image) as reader:
+            sb = btrfs.read_superblock(reader)
+            return [tuple(root) for root in btrfs_roots.find_tree_roots(reader, sb, **kwargs)]
+
+    def test_roots_newest_first(self):
+        block = lambda n: BTRFS_MiB + n * 4096
+        # The current root is left out; a generation's root is its highest node
+        self.assertEqual(self.find(), [(block(7), 9, 0), (block(6), 7, 1), (block(4), 4, 0)])
+        self.assertEqual(self.find(all_nodes=True),
+                         [(block(7), 9, 0), (block(6), 7, 1), (block(5), 7, 0), (block(4), 4, 0)])
+
+    def test_header_checks_without_numpy(self):
+        expected = self.find(all_nodes=True)
+        with patch.object(btrfs_roots, "np", None):
+            self.assertEqual(self.find(all_nodes=True), expected)
+
+    def test_roots_pointing_to_an_explored_tree_are_skipped(self):
+        block = lambda n: BTRFS_MiB + n * 4096
+        with btrfs_restore.open_trees(self.image) as tree_of:
+            self.assertEqual([tree_of(block(n)) for n in (7, 5, 4)], [1000, 1000, 2004])
+            restore = btrfs_restore.ParallelRestore(self.image, ".*", jobs=2, tree_of=tree_of)
+            result = lambda root: btrfs_restore.RootResult(root, [f"/{root}"], None, 0)
+            with patch.object(restore, "restore_root", side_effect=result):
+                searched = [r.root for r in restore.run([block(7), block(5), block(7), block(4)])]
+        self.assertEqual(searched, [block(7), block(4)])
+        self.assertEqual(restore.skipped, [block(5), block(7)])
+
+    def test_cli_and_scan_index(self):
+        with patch("sys.stdout", new=io.StringIO()) as out:
+            self.assertEqual(btrfs_roots.main([self.image, "-n", "2"]), 0)
+        self.assertEqual(out.getvalue().split(), [str(BTRFS_MiB + 7 * 4096), str(BTRFS_MiB + 6 * 4096)])
+
+        index_path = os.path.join(os.path.dirname(self.image), "index.sqlite")
+        with ScanIndex(index_path) as index, patch.object(scan_index, "run_btrfs_find_root") as find_root:
+            first = scan_index.cached_btrfs_roots(index, self.image, 1)
+            self.assertEqual(scan_index.cached_btrfs_roots(index, self.image, 1), first)
+        find_root.assert_not_called()
+        self.assertEqual(first, [BTRFS_MiB + n * 4096 for n in (7, 6, 4)])
+
+class TestPathRegex(unittest.TestCase):
+
+    def matches(self, regex, path):
+        # Anchored the way dry-run.sh passes it to btrfs restore
+        return re.fullmatch("/" + regex, path) is not None
+
+    def test_single_path_matches_generate_regex(self):
+        self.assertEqual(path_regex.path_regex(["home/user/notes.txt"]), r"(|home(|/user(|/notes\.txt)))")
+
+    def test_batch_of_paths_and_globs(self):
+        regex = path_regex.path_regex(["/home/user/notes.txt", "home/user/*.pdf", "home/user/photos/",
+                                       "etc/fs[!x]ab"])
+        self.assertEqual(regex.count("home"), 1)
+        for path in ("/", "/home", "/home/user", "/home/user/notes.txt", "/home/user/a.pdf",
+                     "/home/user/photos/2024/beach.jpg", "/etc", "/etc/fstab"):
+            self.assertTrue(self.matches(regex, path), path)
+        for path in ("/home/user/notesXtxt", "/home/user/sub/a.pdf", "/etc/fsxab", "/var"):
+            self.assertFalse(self.matches(regex, path), path)
+
+    def test_long_lists_are_chunked(self):
+        paths = [f"data/file{i:04}.bin" for i in range(500)]
+        regexes = path_regex.path_regexes(paths, limit=1000)
+        self.assertGreater(len(regexes), 1)
+        self.assertTrue(all(len(regex) <= 1000 for regex in regexes))
+        for path in paths:
+            self.assertEqual(sum(self.matches(regex, "/" + path) for regex in regexes), 1)
+
+    def test_matcher_is_exact(self):
+        self.assertTrue(path_regex.path_matcher("/home/*.pdf").fullmatch("/home/a.pdf"))
+        self.assertFalse(path_regex.path_matcher("/home/*.pdf").fullmatch("/home/a/b.pdf"))
+        self.assertTrue(path_regex.path_matcher("home/").fullmatch("/home/a/b.pdf"))
+        self.assertFalse(path_regex.path_matcher("home/").fullmatch("/home"))
+
+    def test_double_star_matches_zero_or_more_components(self):
+        regex = path_regex.path_regex(["home/**/a.txt"])
+        matcher = path_regex.path_matcher("home/**/a.txt")
+        for path in ("/home/a.txt", "/home/u/a.txt", "/home/u/v/a.txt"):
+            self.assertTrue(self.matches(regex, path), path)
+            self.assertTrue(matcher.fullmatch(path), path)
+        self.assertFalse(matcher.fullmatch("/home/u/a.txt.bak"))
+        self.assertTrue(path_regex.path_matcher("**/a.txt").fullmatch("/a.txt"))
+        self.assertTrue(path_regex.path_matcher("home/**").fullmatch("/home"))
+
+    def test_selector_drops_what_globbed_directories_let_through(self):
+        for glob, stray in (("home/**/a.txt", "/home/u/b.bin"), ("home/**/a.txt", "/home/u/v/w.jpg"),
+                            ("home/*/a.txt", "/home/notes.txt")):
+            # The regex has to let these through for btrfs restore to descend, the selector drops them
+            self.assertTrue(self.matches(path_regex.path_regex([glob]), stray), glob)
+            self.assertFalse(path_regex.path_selector([glob])(stray), glob)
+        selected = path_regex.path_selector(["home/*/a.txt", "etc/"])
+        self.assertTrue(selected("/home/u/a.txt"))
+        self.assertTrue(selected("/etc/fstab"))
+        self.assertFalse(selected("/home/u/v/a.txt"))
+
+    def test_prune_keeps_only_selected_files(self):
+        with tempfile.TemporaryDirectory() as staging:
+            for name in ("home/u/a.txt", "home/u/b.bin", "home/notes.txt", "home/v/w/x.jpg"):
+                os.makedirs(os.path.dirname(os.path.join(staging, name)), exist_ok=True)
+                open(os.path.join(staging, name), "w").close()
+            path_regex.prune(staging, path_regex.path_selector(["home/**/a.txt"]))
+            left = [os.path.relpath(os.path.join(parent, name), staging)
+                    for parent, dirs, files in os.walk(staging) for name in dirs + files]
+        self.assertEqual(sorted(left), ["home", "home/u", "home/u/a.txt"])
+
+class TestCarver(unittest.TestCase):
+
+    def setUp(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.dir = workdir.name
+        self.samples = make_carving_samples()
+        self.image = os.path.join(self.dir, "image")
+        self.offsets = {}
+        data = bytearray()
+        for ext, content in self.samples.items():
+            data += os.urandom(3000).replace(b"\xff", b"\0").replace(b"PK", b"pk")
+            self.offsets[ext] = len(data)
+            data += content
+        data += bytes(5000)
+        with open(self.image, "wb") as f:
+            f.write(data)
+
+    def test_single_pass_finds_every_type(self):
+        with ImageReader(self.image) as reader:
+            found = list(carver.Carver(reader, window_size=4096).scan())
+        self.assertEqual({(c.ext, c.offset, c.length) for c in found},
+                         {(ext, self.offsets[ext], len(content)) for ext, content in self.samples.items()})
+
+    def test_only_selected_types(self):
+        types = carver.types_for_categories(["Text Files (.txt)", "Documents (.pdf, .docx)"])
+        self.assertEqual(types, {"pdf", "docx"})
+        with ImageReader(self.image) as reader:
+            found = [c.ext for c in carver.Carver(reader, types).scan()]
+        self.assertEqual(found, ["pdf", "docx"])
+
+    def test_regions_limit_the_scan(self):
+        png = self.offsets["png"]
+        regions = IntervalSet([(0, png), (png + 8, os.path.getsize(self.image))])
+        with ImageReader(self.image) as reader:
+            found = {c.ext for c in carver.Carver(reader).scan(regions=regions)}
+        self.assertEqual(found, set(self.samples) - {"png"})
+
+    def test_measuring_hits_keeps_the_direct_window(self):
+        window = 32 * 1024
+        data = bytearray(4 * window)
+        for i in range(6):
+            # JPEG headers just before the end of the scan window, each with a segment
+            # length sending the measurement well past the reader's window
+            offset = window - 700 + i * 100
+            data[offset:offset + 6] = b"\xff\xd8\xff\xe1" + struct.pack(">H", 0xfff0)
+        with open(self.image, "wb") as f:
+            f.write(data)
+        with DirectReader(self.image, io_size=4096, buffer_size=window) as reader:
+            with patch.object(DirectReader, "_read_into", autospec=True,
+                              side_effect=DirectReader._read_into) as read_into:
+                self.assertEqual(list(carver.Carver(reader, window_size=window).scan()), [])
+        # Each hit misses the window twice; none of those misses may refill all of it
+        self.assertEqual(read_into.call_count, 15)
+        self.assertLess(sum(len(call.args[1]) for call in read_into.call_args_list), 2 * len(data))
+
+    def test_carved_files_go_through_the_output_pipeline(self):
+        output = os.path.join(self.dir, "out")
+        manifest = os.path.join(self.dir, "manifest.jsonl")
+        carver.carve_image(self.image, output, ["png", "zip"], hash_algorithm="sha256", manifest_path=manifest)
+        records = read_manifest(manifest)
+        self.assertEqual([r["type"] for r in records], ["png", "zip"])
+        for record in records:
+            with open(record["path"], "rb") as f:
+                content = f.read()
+            self.assertEqual(content, self.samples[record["type"]])
+            self.assertEqual(record["offset"], self.offsets[record["type"]])
+            self.assertEqual(record["digest"], hashlib.sha256(content).hexdigest())
+
+class TestEventSink(unittest.TestCase):
+
+    def setUp(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.path = os.path.join(workdir.name, "events.jsonl")
+
+    def test_levels_sampling_and_summary(self):
+        with patch("builtins.print") as console, \
+             EventSink(self.path, level=events.DEBUG, sample=3, batch_size=4) as sink:
+            for ino in range(7):
+                sink.debug("extent", f"extent {ino}", ino=ino)
+                sink.warning("extent_reallocated", ino=ino)
+            sink.info("file_recovered", "recovered", ino=6)
+            self.assertGreater(len(read_events(self.path)), 0)  # Full batches are written as they fill
+        records = read_events(self.path)
+        self.assertEqual([r["ino"] for r in records if r["event"] == "extent"], [0, 3, 6])
+        self.assertEqual(len([r for r in records if r["event"] == "extent_reallocated"]), 7)
+        self.assertEqual(records[-1]["event"], "summary")
+        self.assertEqual(records[-1]["counts"], {"extent": 7, "extent_reallocated": 7, "file_recovered": 1})
+        console.assert_called_once_with("recovered", file=sys.stdout)
+
+        start = os.path.getsize(self.path)
+        with EventSink(self.path) as sink:
+            sink.info("file_recovered", ino=1)
+        self.assertEqual([r["event"] for r in follow_events(self.path, start)], ["file_recovered", "summary"])
+
+    def test_recovery_writes_events_instead_of_printing(self):
+        directory = os.path.dirname(self.path)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory)
+        make_xfs_image("image", inodes=[(0, 1, {"fork": pack_bmbt(0, 20, 1), "size": 100})],
+                       blocks={20: b"x" * BLOCKSIZE})
+        with patch("builtins.print") as console:
+            XFSFileRecovery("image", hash_algorithm=None, events=EventSink(self.path, level=events.DEBUG)).run()
+        printed = [call.args[0] for call in console.call_args_list]
+        self.assertFalse([line for line in printed if "extent" in line])
+        self.assertIn("Recovered file written to recovered_file_17.dat", printed)
+
+        records = {r["event"]: r for r in read_events(self.path)}
+        self.assertEqual(records["inode_found"]["ino"], CHUNK_AGINO + 1)
+        self.assertEqual(records["extent"]["start_block"], 20)
+        self.assertEqual(records["file_recovered"]["size"], 100)
+        self.assertEqual(records["summary"]["files"], 1)
+
+class TestDirectoryNames(unittest.TestCase):
+
+    def setUp(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(workdir.name)
+        # / is shortform and holds home/ (ino 18), a block-form directory that
+        # still lists keep.txt (ino 19) and the removed notes.txt (ino 17)
+        root = struct.pack(">BBI", 1, 0, CHUNK_AGINO) + struct.pack(">BH", 4, 48) + b"home" + struct.pack(">I", 18)
+        home = make_dir_block([(18, b"."), (CHUNK_AGINO, b".."), (19, b"keep.txt")], removed=[(17, b"notes.txt")])
+        directory = 0o040755
+        make_xfs_image("image", inodes=[
+            (0, 0, {"mode": directory, "format": 1, "nlink": 3, "size": len(root), "fork": root}),
+            (0, 1, {"fork": pack_bmbt(0, 20, 1), "size": 100}),
+            (0, 2, {"mode": directory, "format": 2, "nlink": 2, "nextents": 1, "size": BLOCKSIZE,
+                    "fork": pack_bmbt(0, 30, 1)}),
+            (0, 3, {"mode": 0o100644, "nlink": 1, "nextents": 1, "fork": pack_bmbt(0, 21, 1), "size": 5}),
+            (1, 4, {"fork": pack_bmbt(0, 64 + 20, 1), "size": 100}),
+        ], blocks={20: b"n" * BLOCKSIZE, 30: home, 21: b"k" * BLOCKSIZE, 64 + 20: b"u" * BLOCKSIZE})
+
+    def test_entries_and_removed_names(self):
+        entries = list(xfs_dir.decode_data_block(make_dir_block([(19, b"keep.txt")], removed=[(17, b"notes.txt")]),
+                                                 0, False))
+        self.assertEqual(entries, [(19, b"keep.txt", True), (17, b"notes.txt", False)])
+
+        index = DirectoryIndex()
+        index.add_directory(CHUNK_AGINO, [(18, b"home", True)])
+        index.add_directory(18, entries)
+        index.add_directory(99, [(5, b"lost", True)])
+        self.assertEqual(index.resolve([19, 17, (1 << 40) | 17, 5, 6], CHUNK_AGINO),
+                         {19: "home/keep.txt", 17: "home/notes.txt", (1 << 40) | 17: "home/notes.txt", 5: "#99/lost"})
+
+        # A removed entry kept only the low 32 bits of its inode number, the same as a live inode's
+        index.add_directory(18, [(19, b"old.txt", False)])
+        self.assertEqual(index.lookup(19), (18, b"keep.txt"))
+        self.assertEqual(index.lookup(19 + (1 << 32)), (18, b"old.txt"))
+
+    def test_recovery_writes_original_paths(self):
+        XFSFileRecovery("image", hash_algorithm=None, manifest_path="manifest.jsonl", names=True, workers=2).run()
+        with open("home/notes.txt", "rb") as f:
+            self.assertEqual(f.read(), b"n" * 100)
+        unnamed = (1 << 9) + CHUNK_AGINO + 4  # agblklog + inopblog
+        self.assertTrue(os.path.exists(f"recovered_file_{unnamed}.dat"))
+        records = {r["ino"]: r for r in read_manifest("manifest.jsonl")}
+        self.assertEqual(records[17]["original_path"], "home/notes.txt")
+        self.assertNotIn("original_path", records[unnamed])
+
+    def test_path_filter_before_extraction(self):
+        XFSFileRecovery("image", hash_algorithm=None, manifest_path="manifest.jsonl", path_filter=r"^home/").run()
+        self.assertEqual([r["original_path"] for r in read_manifest("manifest.jsonl")], ["home/notes.txt"])
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(workdir.name)
+        make_xfs_image("image", inodes=[(0, 1, {"fork": pack_bmbt(0, 20, 1), "size": 100}),
+                                        (0, 2, {"fork": pack_bmbt(0, 21, 1), "size": 100}),
+                                        (1, 3, {"fork": pack_bmbt(0, 64 + 20, 1), "size": 100})],
+                       blocks={20: b"a" * BLOCKSIZE, 21: b"b" * BLOCKSIZE, 64 + 20: b"c" * BLOCKSIZE})
+
+    def recovery(self, resume=False, **options):
+        return XFSFileRecovery("image", hash_algorithm=None, manifest_path="manifest.jsonl",
+                               checkpoint_path="checkpoint.json", resume=resume, checkpoint_interval=0, **options)
+
+    def test_interrupted_run_resumes_where_it_stopped(self):
+        original = XFSFileRecovery.recover_file
+        calls = []
+
+        def interrupted(recovery, ino, *args):
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            calls.append(ino)
+            original(recovery, ino, *args)
+
+        with patch.object(XFSFileRecovery, "recover_file", interrupted), self.assertRaises(KeyboardInterrupt):
+            self.recovery().run()
+        with open("checkpoint.json") as f:
+            self.assertEqual(json.load(f)["extracted"], 2)
+
+        with patch.object(XFSFileRecovery, "find_candidates") as find_candidates:
+            find_candidates.side_effect = AssertionError("swept AGs must come from the checkpoint")
+            recovery = self.recovery(resume=True)
+            recovery.run()
+        self.assertEqual([r["ino"] for r in read_manifest("manifest.jsonl")], calls + [(1 << 9) + CHUNK_AGINO + 3])
+        self.assertEqual(recovery.recovered_files, 3)
+        self.assertFalse(os.path.exists("checkpoint.json"))
+
+    def test_checkpoint_of_another_filesystem_is_refused(self):
+        with open("checkpoint.json", "w") as f:
+            json.dump({"uuid": "00" * 15 + "01", "inodesize": INODESIZE, "ags": [0]}, f)
+        with self.assertRaises(SystemExit):
+            self.recovery(resume=True).run()
+
+    def test_checkpoint_of_another_selection_is_refused(self):
+        # Candidates are skipped by position: another --inode or --path selection would skip the wrong ones
+        with patch.object(XFSFileRecovery, "recover_file", side_effect=KeyboardInterrupt), \
+             self.assertRaises(KeyboardInterrupt):
+            self.recovery(inodes=[CHUNK_AGINO + 1, CHUNK_AGINO + 2]).run()
+        for options in ({}, {"inodes": [CHUNK_AGINO + 1]}, {"path_filter": "^home/"}):
+            with self.assertRaises(SystemExit), patch("builtins.print"):
+                self.recovery(resume=True, **options).run()
+        with open("checkpoint.json") as f:
+            self.assertEqual(json.load(f)["filters"], [["inodes", [CHUNK_AGINO + 1, CHUNK_AGINO + 2]]])
+
+class TestCRC32C(unittest.TestCase):
+
+    def make_inodes(self):
+        """Return a chunk of v3 inodes with valid CRCs, except inode 2."""
+        chunk = bytearray(8 * INODESIZE)
+        for i in range(8):
+            off = i * INODESIZE
+            struct.pack_into(">HHBBQ", chunk, off, 0x494E, 0, 3, 2, i)
+            crc32 = xfs_crc.xfs_crc(chunk[off:off + INODESIZE], xfs_crc.XFS_DINODE_CRC_OFF)
+            struct.pack_into("<I", chunk, off + xfs_crc.XFS_DINODE_CRC_OFF, crc32 ^ (i == 2))
+        return bytes(chunk)
+
+    def test_known_values_and_batches(self):
+        self.assertEqual(crc.crc32c(b"123456789"), 0xE3069283)
+        self.assertEqual(crc.crc32c(b"56789", crc.crc32c(b"1234")), 0xE3069283)
+        records = [bytes(range(i, i + 37)) for i in range(5)]
+        expected = [crc.crc32c(record) for record in records]
+        if crc.np is not None:
+            self.assertEqual(crc.crc32c_batch(crc.np.frombuffer(b"".join(records), dtype="u1").reshape(5, 37)),
+                             expected)
+        with patch.object(crc, "_native", None), patch.object(crc, "np", None):
+            self.assertEqual(crc.crc32c_batch(records), expected)
+
+    def test_strict_rejects_and_lenient_reports(self):
+        class V5:
+            def is_v5(self):
+                return True
+        chunk = self.make_inodes()
+        with patch("builtins.print"):
+            strict = CRCVerifier(V5(), "strict", EventSink())
+            self.assertEqual(strict.inodes(chunk, INODESIZE, [0, 2, 5]), [0, 5])
+            lenient = CRCVerifier(V5(), "lenient", EventSink())
+            self.assertEqual(lenient.inodes(chunk, INODESIZE, [0, 2, 5]), [0, 2, 5])
+        self.assertEqual((strict.failures["inode"], lenient.failures["inode"]), (1, 1))
+        self.assertEqual(CRCVerifier(V5(), "off").inodes(chunk, INODESIZE, [2]), [2])
+        with patch.object(xfs_crc, "np", None):
+            self.assertEqual(xfs_crc.inode_crc_ok(chunk, INODESIZE, [1, 2]), [True, False])
+
+class TestBenchmarkFixtures(unittest.TestCase):
+
+    def setUp(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.dir = workdir.name
+
+    def test_generated_image_recovers_every_deleted_file(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.dir)
+        image = generate_xfs_image("image", 8 * 1024 * 1024, agcount=2, inode_density=40, fragmentation=3,
+                                   deleted_ratio=0.3, file_size=16 * 1024, seed=5)
+        deleted = [f for f in image.files if f.deleted]
+        self.assertTrue(any(len(f.extents) > 1 for f in deleted))
+
+        XFSFileRecovery("image", hash_algorithm=None, queue_depth=4, sorted_reads=True).run()
+        recovered = sorted(int(name[len("recovered_file_"):-len(".dat")]) for name in os.listdir(".")
+                           if name.startswith("recovered_file_"))
+        self.assertEqual(recovered, sorted(f.ino for f in deleted))
+        for f in deleted:
+            with open(f"recovered_file_{f.ino}.dat", "rb") as out:
+                self.assertEqual(out.read(), file_content(f))
+
+    def test_fake_btrfs_replays_canned_output(self):
+        fake = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "fake_btrfs")
+        device = os.path.join(self.dir, "device")
+        with open(device, "wb") as f:
+            f.truncate(1024 * 1024)
+        env = dict(os.environ, PATH=fake + os.pathsep + os.environ["PATH"])
+        with patch.dict(os.environ, env):
+            self.assertEqual(scan_index.run_btrfs_find_root(device, 1), [30687232, 30670848, 30507008])
+
+        script = os.path.join(os.path.dirname(fake), "..", "scripts", "btrfs", "dry-run.sh")
+        output = subprocess.run(["bash", script, "1", device, "home/user/.*", "0", "/"], env=env,
+                                stdout=subprocess.PIPE, check=True).stdout.decode()
+        self.assertIn("Successful dry run!", output)
+        # Found under two roots, listed once
+        self.assertEqual(output.count("/home/user/notes.txt"), 1)
+        self.assertIn("/home/user/photos/beach.jpg", output)
+        self.assertNotIn("/etc/fstab", output)
+
+    def test_dry_runs_use_private_workspaces_and_cached_roots(self):
+        fake = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "fake_btrfs")
+        fixtures = os.path.join(self.dir, "fixtures")
+        shutil.copytree(os.path.join(fake, "fixtures"), fixtures)
+        with open(os.path.join(fixtures, "dump-super.txt"), "w") as f:
+            f.write("superblock: bytenr=65536, device=/dev/fake\n"
+                    "fsid\t\t\t0f2c4e6a-1b3d-4f5a-8c7e-9d0b1a2c3e4f\n"
+                    "generation\t\t42\nchunk_root_generation\t40\n")
+        device = os.path.join(self.dir, "device")
+        with open(device, "wb") as f:
+            f.truncate(1024 * 1024)
+        workspaces = os.path.join(self.dir, "tmp")
+        os.mkdir(workspaces)
+        log = os.path.join(self.dir, "log")
+        env = dict(os.environ, PATH=fake + os.pathsep + os.environ["PATH"], FAKE_BTRFS_FIXTURES=fixtures,
+                   FAKE_BTRFS_LOG=log, FAKE_BTRFS_DELAY="0.1", XDG_CACHE_HOME=os.path.join(self.dir, "cache"),
+                   TMPDIR=workspaces)
+        script = os.path.join(os.path.dirname(fake), "..", "scripts", "btrfs", "dry-run.sh")
+
+        def dry_run(regex):
+            return subprocess.Popen(["bash", script, "1", device, regex], env=env, stdout=subprocess.PIPE)
+
+        # Two jobs at once no longer share their root list and results
+        home, etc = dry_run("home/user/.*"), dry_run("etc/.*")
+        home_output, etc_output = home.communicate()[0].decode(), etc.communicate()[0].decode()
+        self.assertIn("/home/user/notes.txt", home_output)
+        self.assertNotIn("/etc/fstab", home_output)
+        self.assertIn("/etc/fstab", etc_output)
+        self.assertNotIn("/home/user/notes.txt", etc_output)
+
+        def find_root_runs():
+            with open(log) as f:
+                return sum(line.startswith("btrfs-find-root") for line in f)
+
+        # The roots are cached per filesystem and generation: a repeat run doesn't search again
+        searched = find_root_runs()
+        self.assertGreaterEqual(searched, 1)
+        self.assertEqual(dry_run("home/user/.*").communicate()[0].decode(), home_output)
+        self.assertEqual(find_root_runs(), searched)
+        self.assertEqual(os.listdir(workspaces), [])
+
+    def test_paths_with_spaces_reach_the_restore_intact(self):
+        fake = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "fake_btrfs")
+        fixtures = os.path.join(self.dir, "fixtures")
+        shutil.copytree(os.path.join(fake, "fixtures"), fixtures)
+        with open(os.path.join(fixtures, "restore.txt"), "a") as f:
+            f.write("30687232 /home/user/my notes.txt\n30670848 /home/user/my notes.txt\n")
+        device = os.path.join(self.dir, "device")
+        with open(device, "wb") as f:
+            f.truncate(1024 * 1024)
+        log = os.path.join(self.dir, "log")
+        env = dict(os.environ, PATH=fake + os.pathsep + os.environ["PATH"], FAKE_BTRFS_FIXTURES=fixtures,
+                   FAKE_BTRFS_LOG=log, XDG_CACHE_HOME=os.path.join(self.dir, "cache"))
+        script = os.path.join(os.path.dirname(fake), "..", "scripts", "btrfs", "btrfs-recover.sh")
+        output = subprocess.run(["bash", script, "-d", device, "-fp", "/home/user/my notes.txt", "-rp", self.dir,
+                                 "-D", "1", "-j", "1"], env=env, stdout=subprocess.PIPE, check=True).stdout.decode()
+        self.assertIn("/home/user/my notes.txt", output)
+        # The target arrived in one piece: found in the newest root, so no other root was restored
+        with open(log) as f:
+            self.assertEqual(sum(line.startswith("btrfs restore") for line in f), 1)
+
+    def test_parallel_restore_merges_roots(self):
+        fake = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "fake_btrfs")
+        roots = os.path.join(self.dir, "roots")
+        with open(roots, "w") as f:
+            f.write("30687232\n30670848\n30507008\n")
+        dst = os.path.join(self.dir, "dst")
+        os.mkdir(dst)
+        checkpoint = os.path.join(self.dir, "restored")
+        args = ["--roots", roots, "--jobs", "3", "device", "home/user/.*"]
+        with patch.dict(os.environ, {"PATH": fake + os.pathsep + os.environ["PATH"]}), \
+             patch("sys.stdout", new=io.StringIO()) as out:
+            self.assertEqual(btrfs_restore.main(args), 0)
+            listed = out.getvalue().split()
+            self.assertEqual(btrfs_restore.main(args + ["--destination", dst, "--checkpoint", checkpoint]), 0)
+        self.assertEqual(sorted(listed), ["/home/user/notes.txt", "/home/user/old.txt",
+                                          "/home/user/photos/beach.jpg", "/home/user/report.pdf"])
+        # The newest root's version of a name wins; staging directories are gone
+        with open(os.path.join(dst, "home", "user", "notes.txt")) as f:
+            self.assertEqual(f.read(), "30687232 /home/user/notes.txt\n")
+        self.assertFalse([name for name in os.listdir(dst) if name.startswith(".restore.")])
+        with open(checkpoint) as f:
+            self.assertEqual(f.read().split(), ["30687232", "30670848", "30507008"])
+        versions = {entry["version"] for entry in read_manifest(os.path.join(dst, "recovery_manifest.jsonl"))}
+        self.assertEqual(versions, {"30687232", "30670848", "30507008"})
+
+    def test_restore_stops_once_targets_are_found(self):
+        fake = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "fake_btrfs")
+        roots = [30687232, 30670848, 30507008]
+
+        def searched(targets, versions, jobs=1):
+            restore = btrfs_restore.ParallelRestore("device", "home/user/.*", jobs=jobs, targets=targets,
+                                                    versions=versions)
+            return [result.root for result in restore.run(roots)]
+
+        with patch.dict(os.environ, {"PATH": fake + os.pathsep + os.environ["PATH"]}):
+            self.assertEqual(searched(["/home/user/notes.txt"], 1), roots[:1])
+            self.assertEqual(searched(["home/user/notes.txt"], 2, jobs=3), roots[:2])
+            self.assertEqual(searched(["/home/user/photos/", "/home/user/report.pdf"], 1), roots[:2])
+            self.assertEqual(searched(["/home/user/notes.txt"], 0), roots)
+            self.assertEqual(searched(["/home/user/missing.txt"], 1, jobs=2), roots)
+            # A target found with `**` standing for no component at all counts too
+            self.assertEqual(searched(["/home/**/user/notes.txt"], 1), roots[:1])
+
+        # A path list: every path and glob searched for in one sweep per root, stopping once all are found
+        paths = os.path.join(self.dir, "paths")
+        with open(paths, "w") as f:
+            f.write("/home/user/*.pdf\n# comment\n/home/user/photos/\n")
+        roots_file = os.path.join(self.dir, "roots")
+        with open(roots_file, "w") as f:
+            f.write("".join(f"{root}\n" for root in roots))
+        with patch.dict(os.environ, {"PATH": fake + os.pathsep + os.environ["PATH"]}), \
+             patch("sys.stdout", new=io.StringIO()) as out:
+            self.assertEqual(btrfs_restore.main(["--roots", roots_file, "device", "@" + paths]), 0)
+        self.assertEqual(out.getvalue().split(), ["/home/user/report.pdf", "/home/user/photos/beach.jpg"])
+
+        # Globbed directories: only the files asked for are listed and restored, not their siblings
+        with open(paths, "w") as f:
+            f.write("home/**/beach.jpg\n")
+        dst = os.path.join(self.dir, "dst")
+        os.mkdir(dst)
+        args = ["--roots", roots_file, "--versions", "0", "device", "@" + paths]
+        with patch.dict(os.environ, {"PATH": fake + os.pathsep + os.environ["PATH"]}), \
+             patch("sys.stdout", new=io.StringIO()) as out:
+            self.assertEqual(btrfs_restore.main(args), 0)
+            listed = out.getvalue().split()
+            self.assertEqual(btrfs_restore.main(args + ["--destination", dst]), 0)
+        self.assertEqual(listed, ["/home/user/photos/beach.jpg"])
+        self.assertEqual(os.listdir(os.path.join(dst, "home", "user")), ["photos"])
+
+        script = os.path.join(os.path.dirname(fake), "..", "scripts", "btrfs", "dry-run.sh")
+        with open(paths, "w") as f:
+            f.write("home/**/report.pdf\n")
+        output = subprocess.run(["bash", script, "0", "device", "@" + paths, "0", "/"],
+                                env=dict(os.environ, PATH=fake + os.pathsep + os.environ["PATH"]),
+                                stdout=subprocess.PIPE, check=True).stdout.decode()
+        self.assertIn("/home/user/report.pdf", output)
+        self.assertNotIn("/home/user/notes.txt", output)
+
+    def test_doubled_leading_slashes_are_collapsed(self):
+        fake = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "fake_btrfs")
+        fixtures = os.path.join(self.dir, "fixtures")
+        os.mkdir(fixtures)
+        # As printed by `btrfs restore` into /
+        with open(os.path.join(fixtures, "restore.txt"), "w") as f:
+            f.write("30687232 //home/user/notes.txt\n30687232 //home/user/report.pdf\n30670848 //etc/fstab\n")
+        target = "//home/user/notes.txt"
+        restore = btrfs_restore.ParallelRestore("device", ".*", targets=[target], versions=1,
+                                                select=path_regex.path_selector([target]))
+        with patch.dict(os.environ, {"PATH": fake + os.pathsep + os.environ["PATH"],
+                                     "FAKE_BTRFS_FIXTURES": fixtures}):
+            searched = [result.root for result in restore.run([30687232, 30670848])]
+        self.assertEqual(searched, [30687232])
+        self.assertEqual(restore.paths, {"/home/user/notes.txt": [30687232]})
+        self.assertEqual(restore.found, {"/home/user/notes.txt": 1})
+
+    def test_restores_running_when_the_targets_are_found_are_terminated(self):
+        fake = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "fake_btrfs")
+        # The older root takes far longer to restore than the test may wait for
+        slow = os.path.join(self.dir, "slow")
+        os.mkdir(slow)
+        with open(os.path.join(slow, "btrfs"), "w") as f:
+            f.write('#!/bin/sh\ncase " $* " in *" -t 30670848 "*) export FAKE_BTRFS_DELAY=60;; esac\n'
+                    f'exec "{fake}/btrfs" "$@"\n')
+        os.chmod(os.path.join(slow, "btrfs"), 0o755)
+        dst = os.path.join(self.dir, "dst")
+        os.mkdir(dst)
+        restore = btrfs_restore.ParallelRestore("device", "home/user/.*", dst, jobs=2,
+                                                targets=["/home/user/notes.txt"], versions=1)
+        with patch.dict(os.environ, {"PATH": os.pathsep.join([slow, fake, os.environ["PATH"]])}):
+            started = time.monotonic()
+            results = list(restore.run([30687232, 30670848]))
+            self.assertLess(time.monotonic() - started, 30)
+        self.assertEqual([result.root for result in results], [30687232])
+        # The first root's staging is the caller's; the terminated one's is gone
+        self.assertEqual(os.listdir(dst), [os.path.basename(results[0].staging)])
+
 if __name__ == '__main__':
     unittest.main()
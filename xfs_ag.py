@@ -0,0 +1,159 @@
+import struct
+from collections import namedtuple
+
+from xfs_crc import XFS_AGI_CRC_OFF, XFS_BTREE_SBLOCK_CRC_OFF
+
+# Allocation group header magics
+XFS_AGF_MAGIC = 0x58414746  # "XAGF"
+XFS_AGI_MAGIC = 0x58414749  # "XAGI"
+
+# Short-form btree block magics (v4 and v5/CRC variants)
+XFS_IBT_MAGICS = (0x49414254, 0x49414233)  # "IABT", "IAB3"
+
+XFS_SB_FEAT_INCOMPAT_SPINODES = 0x2  # Sparse inode chunks
+
+XFS_INODES_PER_CHUNK = 64
+XFS_INODES_PER_HOLEMASK_BIT = 4
+
+# Depth limit for btree walks so a corrupt pointer cannot loop forever
+XFS_BTREE_MAXLEVELS = 9
+
+XFSInodeChunk = namedtuple("XFSInodeChunk", "agno startino holemask free")
+
+class XFSAgi:
+    def __init__(self, data):
+        self.magicnum = struct.unpack_from(">I", data, 0)[0]
+        self.seqno = struct.unpack_from(">I", data, 8)[0]
+        self.length = struct.unpack_from(">I", data, 12)[0]
+        self.count = struct.unpack_from(">I", data, 16)[0]
+        self.root = struct.unpack_from(">I", data, 20)[0]
+        self.level = struct.unpack_from(">I", data, 24)[0]
+        self.freecount = struct.unpack_from(">I", data, 28)[0]
+
+    def is_valid(self):
+        return self.magicnum == XFS_AGI_MAGIC
+
+class XFSAgf:
+    def __init__(self, data):
+        self.magicnum = struct.unpack_from(">I", data, 0)[0]
+        self.seqno = struct.unpack_from(">I", data, 8)[0]
+        self.length = struct.unpack_from(">I", data, 12)[0]
+        self.bno_root, self.cnt_root = struct.unpack_from(">II", data, 16)
+        self.bno_level, self.cnt_level = struct.unpack_from(">II", data, 28)
+        self.freeblks = struct.unpack_from(">I", data, 52)[0]
+        self.longest = struct.unpack_from(">I", data, 56)[0]
+
+    def is_valid(self):
+        return self.magicnum == XFS_AGF_MAGIC
+
+def ag_offset(sb, agno):
+    """Byte offset of the start of allocation group `agno`."""
+    return agno * sb.agblocks * sb.blocksize
+
+def agb_offset(sb, agno, agbno):
+    """Byte offset of AG-relative block `agbno` in allocation group `agno`."""
+    return (agno * sb.agblocks + agbno) * sb.blocksize
+
+def read_agf(reader, sb, agno):
+    return XFSAgf(reader.view(ag_offset(sb, agno) + sb.sectsize, sb.sectsize))
+
+def read_agi(reader, sb, agno):
+    return XFSAgi(reader.view(ag_offset(sb, agno) + 2 * sb.sectsize, sb.sectsize))
+
+def sbtree_header_size(sb):
+    # v5 short-form blocks carry blkno, lsn, uuid, owner and crc after the v4 header
+    return 56 if sb.is_v5() else 16
+
+def walk_sbtree(reader, sb, agno, root, magics, keysize, ptrsize=4, verifier=None):
+    """Walk a short-form (AG-local) btree and yield (block, numrecs) for every leaf.
+
+    Blocks with an unexpected magic or level, or rejected by the optional
+    CRCVerifier, are skipped rather than followed, so a corrupt node only
+    costs the subtree below it.
+    """
+    hdr = sbtree_header_size(sb)
+    maxrecs = (sb.blocksize - hdr) // (keysize + ptrsize)
+    stack = [(root, None)]
+    seen = set()
+
+    while stack:
+        agbno, expected_level = stack.pop()
+        if agbno in seen or agbno >= sb.agblocks:
+            continue
+        seen.add(agbno)
+
+        block = reader.view(agb_offset(sb, agno, agbno), sb.blocksize)
+        if len(block) < hdr:
+            continue
+        magic, level, numrecs = struct.unpack_from(">IHH", block, 0)
+        if magic not in magics or level >= XFS_BTREE_MAXLEVELS:
+            continue
+        if expected_level is not None and level != expected_level:
+            continue
+        if verifier and not verifier.check(block, XFS_BTREE_SBLOCK_CRC_OFF, "btree block", agno=agno, agbno=agbno):
+            continue
+
+        if level == 0:
+            yield block, numrecs
+            continue
+
+        numrecs = min(numrecs, maxrecs)
+        ptrs = struct.unpack_from(f">{numrecs}I", block, hdr + maxrecs * keysize)
+        # Push right-to-left so leaves come out in key order
+        for ptr in reversed(ptrs):
+            stack.append((ptr, level - 1))
+
+def iter_inode_chunks(reader, sb, agno, verifier=None, events=None):
+    """Yield every inode chunk recorded in the inode btree of one AG.
+
+    Free inodes inside allocated chunks are included: that is where the
+    inodes of recently deleted files live. An AG with a damaged AGI is
+    skipped, with a warning to the optional EventSink `events`.
+    """
+    agi = read_agi(reader, sb, agno)
+    if not agi.is_valid():
+        if events:
+            events.warning("bad_agi", f"AG {agno}: bad AGI magic {hex(agi.magicnum)}; skipping.", agno=agno,
+                           magic=agi.magicnum)
+        return
+    if verifier and not verifier.check(reader.view(ag_offset(sb, agno) + 2 * sb.sectsize, sb.sectsize),
+                                       XFS_AGI_CRC_OFF, "AGI", agno=agno):
+        return
+
+    sparse = bool(sb.features_incompat & XFS_SB_FEAT_INCOMPAT_SPINODES)
+    hdr = sbtree_header_size(sb)
+    for block, numrecs in walk_sbtree(reader, sb, agno, agi.root, XFS_IBT_MAGICS, keysize=4, verifier=verifier):
+        numrecs = min(numrecs, (len(block) - hdr) // 16)
+        # Unpack the whole leaf up front: with a windowed reader the caller's
+        # next read may reuse the buffer the leaf lives in
+        records = list(struct.iter_unpack(">IHHQ", block[hdr:hdr + numrecs * 16]))
+        for startino, holemask, _, free in records:
+            if not sparse:
+                holemask = 0
+            yield XFSInodeChunk(agno, startino, holemask, free)
+
+def chunk_offset(sb, agno, agino):
+    """Byte offset of the inode with AG-relative number `agino`."""
+    agbno = agino >> sb.inopblog
+    return agb_offset(sb, agno, agbno) + (agino & (sb.inopblock - 1)) * sb.inodesize
+
+def chunk_inodes(chunk):
+    """Yield the indexes of the inodes of a chunk that are physically present."""
+    for i in range(XFS_INODES_PER_CHUNK):
+        if not chunk.holemask & (1 << (i // XFS_INODES_PER_HOLEMASK_BIT)):
+            yield i
+
+def make_ino(sb, agno, agino):
+    return (agno << (sb.agblklog + sb.inopblog)) | agino
+
+def fsb_to_offset(sb, fsbno):
+    """Byte offset of filesystem block `fsbno` (AG number in the high bits)."""
+    agno = fsbno >> sb.agblklog
+    agbno = fsbno & ((1 << sb.agblklog) - 1)
+    return agb_offset(sb, agno, agbno)
+
+def fsb_is_valid(sb, fsbno, count=1):
+    """True if the `count` blocks starting at `fsbno` lie inside one AG."""
+    agno = fsbno >> sb.agblklog
+    agbno = fsbno & ((1 << sb.agblklog) - 1)
+    return agno < sb.agcount and count > 0 and agbno + count <= sb.agblocks
@@ -0,0 +1,253 @@
+import struct
+
+try:
+    import numpy as np
+except ImportError:  # Batch decoding is optional; fall back to unpacking one inode at a time
+    np = None
+
+XFS_DINODE_MAGIC = 0x494E  # 'IN'
+S_IFMT = 0o170000
+S_IFDIR = 0o040000
+XFS_DIFLAG2_BIGTIME = 1 << 3  # v3 timestamps are 64-bit nanosecond counters
+XFS_BIGTIME_EPOCH_OFFSET = 1 << 31
+NSEC_PER_SEC = 1000000000
+XFS_BMBT_REC_SIZE = 16
+
+# Inode core fields used for triage: (name, big-endian format, offset)
+INODE_CORE_FIELDS = [
+    ("magic", ">u2", 0),
+    ("mode", ">u2", 2),
+    ("version", "u1", 4),
+    ("format", "u1", 5),
+    ("onlink", ">u2", 6),
+    ("uid", ">u4", 8),
+    ("gid", ">u4", 12),
+    ("nlink", ">u4", 16),
+    ("mtime", ">i4", 40),
+    ("mtime64", ">u8", 40),
+    ("ctime", ">i4", 48),
+    ("ctime64", ">u8", 48),
+    ("size", ">u8", 56),
+    ("nextents", ">u4", 76),
+    ("forkoff", "u1", 82),
+    ("flags2", ">u8", 120),  # v3 inodes only
+]
+
+_dtypes = {}
+
+def inode_core_dtype(inodesize):
+    """Structured dtype overlaying the inode core on an `inodesize` record."""
+    dtype = _dtypes.get(inodesize)
+    if dtype is None:
+        names, formats, offsets = zip(*INODE_CORE_FIELDS)
+        dtype = np.dtype({"names": list(names), "formats": list(formats),
+                          "offsets": list(offsets), "itemsize": inodesize})
+        _dtypes[inodesize] = dtype
+    return dtype
+
+def decode_inodes(data, inodesize):
+    """Map a buffer of back-to-back inodes onto a structured array (no copy)."""
+    return np.frombuffer(data, dtype=inode_core_dtype(inodesize), count=len(data) // inodesize)
+
+def present_mask(holemask, count):
+    """Boolean mask of the inodes of a chunk that are not sparse holes."""
+    bits = (holemask >> np.arange(16, dtype=np.uint32)) & 1
+    return np.repeat(bits == 0, 4)[:count]
+
+def candidate_indexes(data, inodesize, holemask=0, formats=(2,), min_size=None, max_size=None, inode_filter=None):
+    """Return the indexes of the deleted inodes in `data` worth recovering.
+
+    An inode survives when it carries the inode magic, has no links left,
+    uses one of `formats` for its data fork, falls inside the optional
+    size bounds and passes the optional InodeFilter. Only survivors should
+    be turned into XFSInode objects.
+    """
+    if np is None:
+        return _candidate_indexes_slow(data, inodesize, holemask, formats, min_size, max_size, inode_filter)
+
+    batch = decode_inodes(data, inodesize)
+    nlink = np.where(batch["version"] == 1, batch["onlink"], batch["nlink"])
+    mask = (batch["magic"] == XFS_DINODE_MAGIC) & (nlink == 0) & np.isin(batch["format"], formats)
+    if holemask:
+        mask &= present_mask(holemask, len(batch))
+    if min_size is not None:
+        mask &= batch["size"] >= min_size
+    if max_size is not None:
+        mask &= batch["size"] <= max_size
+    if inode_filter and mask.any():
+        mask &= inode_filter.mask(data, inodesize, batch)
+    return np.flatnonzero(mask).tolist()
+
+def _candidate_indexes_slow(data, inodesize, holemask, formats, min_size, max_size, inode_filter=None):
+    indexes = []
+    for i in range(len(data) // inodesize):
+        if holemask & (1 << (i // 4)):
+            continue
+        off = i * inodesize
+        magic, _, version, fmt, onlink = struct.unpack_from(">HHBBH", data, off)
+        nlink = onlink if version == 1 else struct.unpack_from(">I", data, off + 16)[0]
+        if magic != XFS_DINODE_MAGIC or nlink != 0 or fmt not in formats:
+            continue
+        size = struct.unpack_from(">Q", data, off + 56)[0]
+        if (min_size is not None and size < min_size) or (max_size is not None and size > max_size):
+            continue
+        if inode_filter and not inode_filter.matches(data, off, inodesize):
+            continue
+        indexes.append(i)
+    return indexes
+
+def directory_indexes(data, inodesize, holemask=0):
+    """Return the indexes of the linked directory inodes in `data`."""
+    if np is None:
+        return _directory_indexes_slow(data, inodesize, holemask)
+
+    batch = decode_inodes(data, inodesize)
+    nlink = np.where(batch["version"] == 1, batch["onlink"], batch["nlink"])
+    mask = (batch["magic"] == XFS_DINODE_MAGIC) & (nlink != 0) & (batch["mode"] & S_IFMT == S_IFDIR)
+    if holemask:
+        mask &= present_mask(holemask, len(batch))
+    return np.flatnonzero(mask).tolist()
+
+def _directory_indexes_slow(data, inodesize, holemask):
+    indexes = []
+    for i in range(len(data) // inodesize):
+        if holemask & (1 << (i // 4)):
+            continue
+        off = i * inodesize
+        magic, mode, version, _, onlink = struct.unpack_from(">HHBBH", data, off)
+        nlink = onlink if version == 1 else struct.unpack_from(">I", data, off + 16)[0]
+        if magic == XFS_DINODE_MAGIC and nlink != 0 and mode & S_IFMT == S_IFDIR:
+            indexes.append(i)
+    return indexes
+
+class InodeFilter:
+    """Predicates on raw inode cores, compiled once and applied to whole chunks.
+
+    Every bound is optional and inclusive. Times are Unix seconds; deleting
+    a file updates its ctime, so a ctime window selects when it was deleted.
+    `mode` is compared after masking with `mode_mask`. Note that XFS clears
+    the mode of an inode once it is freed.
+
+    The extent count is the inode's own count or, once that has been zeroed
+    by a delete, the number of extent records still in an extent-format
+    fork. Btree-format inodes whose count was zeroed always pass: their
+    extents cannot be counted without reading blocks.
+    """
+
+    def __init__(self, min_size=None, max_size=None, mtime_after=None, mtime_before=None, ctime_after=None,
+                 ctime_before=None, uids=None, gids=None, mode=None, mode_mask=0o7777 | S_IFMT,
+                 min_extents=None, max_extents=None):
+        # Cheapest checks first: the rest are skipped once nothing is left
+        self.checks = []
+        for name, ids in (("uid", uids), ("gid", gids)):
+            if ids:
+                self.checks.append(("in", name, tuple(sorted(ids)), None))
+        if mode is not None:
+            self.checks.append(("mode", "mode", mode & mode_mask, mode_mask))
+        for name, low, high in (("size", min_size, max_size), ("mtime", mtime_after, mtime_before),
+                                ("ctime", ctime_after, ctime_before), ("extents", min_extents, max_extents)):
+            if low is not None or high is not None:
+                self.checks.append(("range", name, low, high))
+
+    def __bool__(self):
+        return bool(self.checks)
+
+    def describe(self):
+        """Plain description of the compiled checks, e.g. to tell two runs' filters apart."""
+        return [[kind, name, list(a) if isinstance(a, tuple) else a, b] for kind, name, a, b in self.checks]
+
+    def mask(self, data, inodesize, batch=None):
+        """Boolean mask of the inodes in `data` that pass every check."""
+        if batch is None:
+            batch = decode_inodes(data, inodesize)
+        mask = np.ones(len(batch), dtype=bool)
+        for kind, name, a, b in self.checks:
+            if kind == "in":
+                mask &= np.isin(batch[name], a)
+            elif kind == "mode":
+                mask &= (batch["mode"] & b) == a
+            else:
+                values = self._column(name, data, inodesize, batch)
+                if a is not None:
+                    mask &= values >= a
+                if b is not None:
+                    mask &= values <= b
+            if not mask.any():
+                break
+        return mask
+
+    def _column(self, name, data, inodesize, batch):
+        if name == "size":
+            return batch["size"]
+        if name in ("mtime", "ctime"):
+            seconds = batch[name].astype(np.int64)
+            bigtime = (batch["version"] == 3) & (batch["flags2"] & XFS_DIFLAG2_BIGTIME != 0)
+            if bigtime.any():
+                seconds = np.where(bigtime, (batch[name + "64"] // NSEC_PER_SEC).astype(np.int64)
+                                   - XFS_BIGTIME_EPOCH_OFFSET, seconds)
+            return seconds
+        return self._extent_counts(data, inodesize, batch)
+
+    def _extent_counts(self, data, inodesize, batch):
+        counts = batch["nextents"].astype(np.int64)
+        zeroed = (counts == 0) & (batch["format"] == 2)
+        if not zeroed.any():
+            return np.where((counts == 0) & (batch["format"] == 3), np.iinfo(np.int64).max, counts)
+        raw = np.frombuffer(data, dtype=np.uint8, count=len(batch) * inodesize).reshape(len(batch), inodesize)
+        for version_core in ((batch["version"] < 3, 100), (batch["version"] >= 3, 176)):
+            rows, core = version_core
+            rows = rows & zeroed
+            if not rows.any():
+                continue
+            capacity = (inodesize - core) // XFS_BMBT_REC_SIZE
+            records = raw[rows, core:core + capacity * XFS_BMBT_REC_SIZE].reshape(-1, capacity, XFS_BMBT_REC_SIZE)
+            present = records.any(axis=2)
+            leading = np.where(present.all(axis=1), capacity, np.argmin(present, axis=1))
+            # The attribute fork, if any, starts at forkoff * 8 bytes into the literal area
+            forkoff = batch["forkoff"][rows].astype(np.int64)
+            limit = np.where(forkoff > 0, forkoff * 8 // XFS_BMBT_REC_SIZE, capacity)
+            counts[rows] = np.minimum(leading, limit)
+        return np.where((counts == 0) & (batch["format"] == 3), np.iinfo(np.int64).max, counts)
+
+    def matches(self, data, off=0, inodesize=None):
+        """True if the inode at `off` in `data` passes every check (one inode at a time, no numpy)."""
+        for kind, name, a, b in self.checks:
+            if kind == "in":
+                if self._value_slow(name, data, off, inodesize) not in a:
+                    return False
+            elif kind == "mode":
+                if self._value_slow("mode", data, off, inodesize) & b != a:
+                    return False
+            else:
+                value = self._value_slow(name, data, off, inodesize)
+                if (a is not None and value < a) or (b is not None and value > b):
+                    return False
+        return True
+
+    def _value_slow(self, name, data, off, inodesize):
+        version, fmt = data[off + 4], data[off + 5]
+        if name == "mode":
+            return struct.unpack_from(">H", data, off + 2)[0]
+        if name in ("uid", "gid"):
+            return struct.unpack_from(">I", data, off + (8 if name == "uid" else 12))[0]
+        if name == "size":
+            return struct.unpack_from(">Q", data, off + 56)[0]
+        if name in ("mtime", "ctime"):
+            at = off + (40 if name == "mtime" else 48)
+            if version == 3 and struct.unpack_from(">Q", data, off + 120)[0] & XFS_DIFLAG2_BIGTIME:
+                return struct.unpack_from(">Q", data, at)[0] // NSEC_PER_SEC - XFS_BIGTIME_EPOCH_OFFSET
+            return struct.unpack_from(">i", data, at)[0]
+
+        count = struct.unpack_from(">I", data, off + 76)[0]
+        if count or fmt != 2:
+            return count if count or fmt != 3 else float("inf")
+        core = 176 if version >= 3 else 100
+        inodesize = inodesize or len(data) - off
+        capacity = (inodesize - core) // XFS_BMBT_REC_SIZE
+        forkoff = data[off + 82]
+        if forkoff:
+            capacity = min(capacity, forkoff * 8 // XFS_BMBT_REC_SIZE)
+        start = off + core
+        while count < capacity and any(data[start + count * XFS_BMBT_REC_SIZE:start + (count + 1) * XFS_BMBT_REC_SIZE]):
+            count += 1
+        return count
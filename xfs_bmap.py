@@ -0,0 +1,181 @@
+import struct
+from collections import namedtuple, OrderedDict
+
+from xfs_ag import fsb_to_offset, fsb_is_valid
+from xfs_crc import XFS_BTREE_LBLOCK_CRC_OFF
+
+try:
+    import numpy as np
+except ImportError:  # Bulk unpacking falls back to struct.iter_unpack
+    np = None
+
+XFS_DINODE_FMT_EXTENTS = 2
+XFS_DINODE_FMT_BTREE = 3
+
+XFS_BMAP_MAGICS = (0x424D4150, 0x424D4133)  # "BMAP", "BMA3"
+
+XFS_BMBT_REC_SIZE = 16
+XFS_BMDR_HEADER_SIZE = 4  # Root of the bmap btree inside the inode: level, numrecs
+XFS_BTREE_MAXLEVELS = 9
+
+# Packed 128-bit bmbt record layout
+_MASK_STARTOFF = (1 << 54) - 1
+_MASK_STARTBLOCK_HI = (1 << 9) - 1
+_MASK_BLOCKCOUNT = (1 << 21) - 1
+
+# A mapping of `block_count` file blocks starting at file block `offset` to
+# the filesystem blocks starting at `start_block`
+Extent = namedtuple("Extent", "offset start_block block_count unwritten")
+
+def decode_extents(data, count):
+    """Unpack `count` packed bmbt records from `data` into Extents."""
+    count = min(count, len(data) // XFS_BMBT_REC_SIZE)
+    if count <= 0:
+        return []
+
+    if np is not None:
+        recs = np.frombuffer(data, dtype=">u8", count=2 * count).astype(np.uint64).reshape(-1, 2)
+        l0, l1 = recs[:, 0], recs[:, 1]
+        unwritten = (l0 >> np.uint64(63)).astype(bool)
+        offset = (l0 >> np.uint64(9)) & np.uint64(_MASK_STARTOFF)
+        start = ((l0 & np.uint64(_MASK_STARTBLOCK_HI)) << np.uint64(43)) | (l1 >> np.uint64(21))
+        length = l1 & np.uint64(_MASK_BLOCKCOUNT)
+        return list(map(Extent._make, zip(offset.tolist(), start.tolist(),
+                                           length.tolist(), unwritten.tolist())))
+
+    extents = []
+    for l0, l1 in struct.iter_unpack(">QQ", data[:count * XFS_BMBT_REC_SIZE]):
+        extents.append(Extent((l0 >> 9) & _MASK_STARTOFF,
+                              ((l0 & _MASK_STARTBLOCK_HI) << 43) | (l1 >> 21),
+                              l1 & _MASK_BLOCKCOUNT,
+                              bool(l0 >> 63)))
+    return extents
+
+def merge_extents(extents):
+    """Merge extents that are contiguous both in the file and on disk."""
+    merged = []
+    for extent in sorted(extents):
+        if merged:
+            last = merged[-1]
+            if (last.offset + last.block_count == extent.offset
+                    and last.start_block + last.block_count == extent.start_block
+                    and last.unwritten == extent.unwritten):
+                merged[-1] = last._replace(block_count=last.block_count + extent.block_count)
+                continue
+        merged.append(extent)
+    return merged
+
+def valid_prefix(sb, extents):
+    """Return the leading extents that point inside the filesystem.
+
+    Freed inodes keep stale records after their extent count was zeroed, so
+    decoding stops at the first record that cannot be real.
+    """
+    valid = []
+    next_offset = 0
+    for extent in extents:
+        if not fsb_is_valid(sb, extent.start_block, extent.block_count) or extent.offset < next_offset:
+            break
+        valid.append(extent)
+        next_offset = extent.offset + extent.block_count
+    return valid
+
+class BlockCache:
+    """Small LRU cache of filesystem blocks, keyed by block number.
+
+    Carries the optional CRCVerifier that btree walks check blocks with.
+    """
+
+    def __init__(self, reader, sb, capacity=1024, verifier=None):
+        self.reader = reader
+        self.sb = sb
+        self.capacity = capacity
+        self.verifier = verifier
+        self.blocks = OrderedDict()
+
+    def get(self, fsbno):
+        block = self.blocks.get(fsbno)
+        if block is not None:
+            self.blocks.move_to_end(fsbno)
+            return block
+
+        block = self.reader.read(fsb_to_offset(self.sb, fsbno), self.sb.blocksize)
+        self.blocks[fsbno] = block
+        if len(self.blocks) > self.capacity:
+            self.blocks.popitem(last=False)
+        return block
+
+def lbtree_header_size(sb):
+    # v5 long-form blocks add blkno, lsn, uuid, owner, crc and padding
+    return 72 if sb.is_v5() else 24
+
+def data_fork(sb, inode, inode_data):
+    """Return the data fork literal area of an inode."""
+    core_size = 176 if inode.version >= 3 else 100
+    if inode.forkoff:
+        fork_size = inode.forkoff * 8
+    else:
+        fork_size = sb.inodesize - core_size
+    return inode_data[core_size:core_size + fork_size]
+
+def walk_bmbt(cache, sb, root_level, ptrs):
+    """Yield the extent records of every leaf below `ptrs` in key order."""
+    hdr = lbtree_header_size(sb)
+    node_maxrecs = (sb.blocksize - hdr) // 16
+    stack = [(ptr, root_level - 1) for ptr in reversed(ptrs)]
+    seen = set()
+
+    while stack:
+        fsbno, expected_level = stack.pop()
+        if fsbno in seen or not fsb_is_valid(sb, fsbno):
+            continue
+        seen.add(fsbno)
+
+        block = cache.get(fsbno)
+        magic, level, numrecs = struct.unpack_from(">IHH", block, 0)
+        if magic not in XFS_BMAP_MAGICS or level != expected_level:
+            continue
+        if cache.verifier and not cache.verifier.check(block, XFS_BTREE_LBLOCK_CRC_OFF, "bmbt block", fsbno=fsbno):
+            continue
+
+        if level == 0:
+            yield from decode_extents(memoryview(block)[hdr:], numrecs)
+            continue
+
+        numrecs = min(numrecs, node_maxrecs)
+        children = struct.unpack_from(f">{numrecs}Q", block, hdr + node_maxrecs * 8)
+        for ptr in reversed(children):
+            stack.append((ptr, level - 1))
+
+def btree_root_extents(cache, sb, fork):
+    """Decode a bmap btree whose root lives in the inode fork."""
+    if len(fork) < XFS_BMDR_HEADER_SIZE:
+        return []
+    level, numrecs = struct.unpack_from(">HH", fork, 0)
+    maxrecs = (len(fork) - XFS_BMDR_HEADER_SIZE) // 16
+    if not 0 < level < XFS_BTREE_MAXLEVELS or not 0 < numrecs <= maxrecs:
+        return []
+    ptrs = struct.unpack_from(f">{numrecs}Q", fork, XFS_BMDR_HEADER_SIZE + maxrecs * 8)
+    return list(walk_bmbt(cache, sb, level, ptrs))
+
+def extent_map(cache, sb, inode, inode_data):
+    """Return the merged extent map of an inode's data fork.
+
+    Extent-format forks are decoded in place. For freed inodes the extent
+    count has been zeroed, so every record that still looks valid is used.
+    Btree-format forks are walked through the block cache; a freed inode
+    whose format was reset to extents but still holds a btree root is
+    recognised by the magic of the blocks it points to.
+    """
+    fork = data_fork(sb, inode, inode_data)
+    if inode.format == XFS_DINODE_FMT_BTREE:
+        return merge_extents(valid_prefix(sb, sorted(btree_root_extents(cache, sb, fork))))
+
+    if inode.format != XFS_DINODE_FMT_EXTENTS:
+        return []
+
+    count = inode.nextents or len(fork) // XFS_BMBT_REC_SIZE
+    extents = valid_prefix(sb, decode_extents(fork, count))
+    if not extents and not inode.nextents:
+        extents = valid_prefix(sb, sorted(btree_root_extents(cache, sb, fork)))
+    return merge_extents(extents)
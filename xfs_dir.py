@@ -0,0 +1,254 @@
+import struct
+from array import array
+from bisect import bisect_left
+
+from xfs_ag import fsb_to_offset
+from xfs_bmap import data_fork, extent_map
+from xfs_batch import S_IFMT, S_IFDIR
+
+XFS_DINODE_FMT_LOCAL = 1  # Shortform directory inside the inode
+
+# Directory data blocks: block-form (single block with its own leaf) and plain data, v4 and v5
+XFS_DIR2_BLOCK_MAGICS = (0x58443242, 0x58444233)  # "XD2B", "XDB3"
+XFS_DIR2_DATA_MAGICS = (0x58443244, 0x58444433)  # "XD2D", "XDD3"
+XFS_DIR2_DATA_FREE_TAG = 0xffff
+# Leaf, node and free-index blocks live at or above this byte offset of a directory
+XFS_DIR2_LEAF_OFFSET = 32 * 1024 * 1024 * 1024
+
+XFS_SB_VERSION2_FTYPE = 0x200
+XFS_SB_FEAT_INCOMPAT_FTYPE = 0x1
+
+MAX_PATH_DEPTH = 256
+
+def is_directory(inode):
+    return inode.mode & S_IFMT == S_IFDIR
+
+def has_ftype(sb):
+    """True if directory entries carry a file type byte after the name."""
+    if sb.is_v5():
+        return bool(sb.features_incompat & XFS_SB_FEAT_INCOMPAT_FTYPE)
+    return bool(sb.features2 & XFS_SB_VERSION2_FTYPE)
+
+def _valid_name(name):
+    return name not in (b".", b"..") and b"/" not in name and b"\0" not in name
+
+def decode_shortform(fork, ftype):
+    """Return (parent, [(ino, name)]) of a shortform directory fork."""
+    if len(fork) < 6:
+        return None, []
+    count, i8count = fork[0], fork[1]
+    inosize = 8 if i8count else 4
+    fmt = ">Q" if i8count else ">I"
+    parent = struct.unpack_from(fmt, fork, 2)[0]
+    entries = []
+    p = 2 + inosize
+    for _ in range(count):
+        if p + 3 > len(fork):
+            break
+        namelen = fork[p]
+        name = bytes(fork[p + 3:p + 3 + namelen])
+        p += 3 + namelen + ftype
+        if namelen == 0 or p + inosize > len(fork):
+            break
+        ino = struct.unpack_from(fmt, fork, p)[0]
+        p += inosize
+        if _valid_name(name):
+            entries.append((ino, name))
+    return parent, entries
+
+def _entry_size(namelen, ftype):
+    # inumber, namelen, name, optional ftype and the tag, rounded to 8 bytes
+    return (8 + 1 + namelen + ftype + 2 + 7) & ~7
+
+def decode_data_block(block, ftype, v5):
+    """Yield (ino, name, live) for the entries of one directory data block.
+
+    Removing an entry overwrites the first four bytes of its inode number
+    with the free tag and length, but leaves the low 32 bits of the inode
+    number, the name and the trailing tag in place. Such entries are found
+    inside free space by checking that the tag points back at the entry,
+    and are yielded with `live` False and only the low inode bits.
+    """
+    if len(block) < 16:
+        return
+    magic = struct.unpack_from(">I", block, 0)[0]
+    if magic in XFS_DIR2_BLOCK_MAGICS:
+        count = struct.unpack_from(">I", block, len(block) - 8)[0]
+        end = len(block) - 8 - count * 8
+    elif magic in XFS_DIR2_DATA_MAGICS:
+        end = len(block)
+    else:
+        return
+    p = 64 if v5 else 16
+    if end < p:
+        return
+
+    while p + 8 <= end:
+        if struct.unpack_from(">H", block, p)[0] == XFS_DIR2_DATA_FREE_TAG:
+            length = struct.unpack_from(">H", block, p + 2)[0]
+            if length < 8 or length % 8 or p + length > end:
+                return
+            yield from _stale_entries(block, p, p + length, ftype)
+            p += length
+            continue
+        ino = struct.unpack_from(">Q", block, p)[0]
+        namelen = block[p + 8]
+        size = _entry_size(namelen, ftype)
+        if namelen == 0 or p + size > end:
+            return
+        name = bytes(block[p + 9:p + 9 + namelen])
+        if _valid_name(name):
+            yield ino, name, True
+        p += size
+
+def _stale_entries(block, start, end, ftype):
+    p = start
+    while p + 16 <= end:
+        namelen = block[p + 8]
+        size = _entry_size(namelen, ftype)
+        if namelen and p + size <= end and struct.unpack_from(">H", block, p + size - 2)[0] == p:
+            name = bytes(block[p + 9:p + 9 + namelen])
+            ino = struct.unpack_from(">I", block, p + 4)[0]
+            if ino and _valid_name(name):
+                yield ino, name, False
+                p += size
+                continue
+        p += 8
+
+def directory_entries(reader, cache, sb, inode, inode_data):
+    """Return [(ino, name, live)] for a directory inode of any format.
+
+    Shortform directories are decoded from the inode. Block, leaf and node
+    directories keep every entry in their data blocks, below the leaf
+    offset; their leaf, node and free-index blocks only speed up lookups
+    and are not read.
+    """
+    fork = data_fork(sb, inode, inode_data)
+    ftype = int(has_ftype(sb))
+    if inode.format == XFS_DINODE_FMT_LOCAL:
+        _, entries = decode_shortform(fork[:inode.size], ftype)
+        return [(ino, name, True) for ino, name in entries]
+
+    dirblksize = sb.blocksize << sb.dirblklog
+    entries = []
+    for extent in extent_map(cache, sb, inode, inode_data):
+        start = extent.offset * sb.blocksize
+        if start >= XFS_DIR2_LEAF_OFFSET or extent.unwritten:
+            continue
+        length = min(extent.block_count * sb.blocksize, XFS_DIR2_LEAF_OFFSET - start)
+        data = reader.read(fsb_to_offset(sb, extent.start_block), length)
+        for offset in range(0, len(data) - dirblksize + 1, dirblksize):
+            entries.extend(decode_data_block(data[offset:offset + dirblksize], ftype, sb.is_v5()))
+    return entries
+
+class DirectoryIndex:
+    """Compact inode -> (parent, name) index built from directory entries.
+
+    Entries live in flat arrays of integers with the names packed into one
+    bytearray, so millions of entries cost a few dozen bytes each. Entries
+    recovered from free space carry only the low 32 bits of their inode.
+    Lookups sort the arrays once and bisect.
+    """
+
+    def __init__(self):
+        self.inos = array("Q")
+        self.parents = array("Q")
+        self.name_offsets = array("Q")
+        self.live = array("B")
+        self.names = bytearray()
+        self._order = None
+
+    def __len__(self):
+        return len(self.inos)
+
+    def add(self, ino, parent, name, live=True):
+        self.inos.append(ino)
+        self.parents.append(parent)
+        self.name_offsets.append(len(self.names))
+        self.live.append(live)
+        self.names += name
+        self._order = None
+
+    def add_directory(self, parent, entries):
+        for ino, name, live in entries:
+            self.add(ino, parent, name, live)
+
+    def extend(self, other):
+        base = len(self.names)
+        self.inos.extend(other.inos)
+        self.parents.extend(other.parents)
+        self.name_offsets.extend(offset + base for offset in other.name_offsets)
+        self.live.extend(other.live)
+        self.names += other.names
+        self._order = None
+
+    def _name(self, i):
+        end = self.name_offsets[i + 1] if i + 1 < len(self.name_offsets) else len(self.names)
+        return bytes(self.names[self.name_offsets[i]:end])
+
+    def _sorted(self):
+        if self._order is None:
+            # Live entries sort ahead of stale ones for the same inode number
+            self._order = sorted(range(len(self.inos)), key=lambda i: (self.inos[i], not self.live[i]))
+            self._keys = array("Q", (self.inos[i] for i in self._order))
+        return self._order, self._keys
+
+    def _find(self, ino, live):
+        """Return the first entry for `ino` that is live, or removed if not `live`, or None."""
+        order, keys = self._sorted()
+        i = bisect_left(keys, ino)
+        while i < len(keys) and keys[i] == ino:
+            entry = order[i]
+            if self.live[entry] == live:
+                return entry
+            i += 1
+        return None
+
+    def lookup(self, ino):
+        """Return (parent, name) for `ino`, or None.
+
+        Live entries win; otherwise a removed entry with the same low 32
+        bits of the inode number is used.
+        """
+        entry = self._find(ino, live=True)
+        if entry is None:
+            entry = self._find(ino & 0xffffffff, live=False)
+        if entry is None:
+            return None
+        return self.parents[entry], self._name(entry)
+
+    def resolve(self, inos, root):
+        """Return {ino: path} for every inode in `inos` that has a name.
+
+        Paths are relative to the directory `root`. Directory paths are
+        memoised, so resolving every candidate at once walks each directory
+        only once. A parent that cannot be traced back to the root is kept
+        as a `#<ino>` component.
+        """
+        dirs = {root: ""}
+
+        def directory_path(ino):
+            chain = []
+            while ino not in dirs and len(chain) < MAX_PATH_DEPTH:
+                found = self.lookup(ino)
+                if found is None or found[0] == ino:
+                    dirs[ino] = f"#{ino}"
+                    break
+                chain.append((ino, found))
+                ino = found[0]
+            path = dirs.get(ino, f"#{ino}")
+            for child, (_, name) in reversed(chain):
+                path = f"{path}/{name.decode(errors='replace')}" if path else name.decode(errors="replace")
+                dirs[child] = path
+            return path
+
+        paths = {}
+        for ino in inos:
+            found = self.lookup(ino)
+            if found is None:
+                continue
+            parent, name = found
+            base = directory_path(parent)
+            name = name.decode(errors="replace")
+            paths[ino] = f"{base}/{name}" if base else name
+        return paths